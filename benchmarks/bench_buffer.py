@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Memory per point and defer_metric time of the columnar deferred metrics
+buffer, compared with the previous list of payload dictionaries.
+
+    python -m benchmarks.bench_buffer [--points N]
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+
+from benchmarks.fake_kairosdb import fixed_token
+
+SERIES = 100
+
+
+class DictBuffer(object):
+    """
+    The previous representation: one payload dictionary per point.
+    """
+
+    def __init__(self):
+        self.points = []
+
+    def append(self, metric_name, tags, timestamp, value, key=None):
+        self.points.append({'name': metric_name, 'timestamp': timestamp, 'value': value, 'tags': tags})
+        return len(self.points)
+
+
+def fill(writer, points, tags):
+    for i in range(points):
+        writer.defer_metric('benchmark.metric', i, tags[i % SERIES])
+
+
+def measure(new_writer, points, tags):
+    """
+    :return: Bytes allocated per point and nanoseconds per defer_metric call.
+    """
+    writer = new_writer()
+    gc.collect()
+    tracemalloc.start()
+    fill(writer, points, tags)
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del writer
+
+    writer = new_writer()
+    gc.collect()
+    start = time.perf_counter()
+    fill(writer, points, tags)
+    elapsed = time.perf_counter() - start
+    return memory / float(points), elapsed / points * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', type=int, default=1000000)
+    args = parser.parse_args()
+
+    fixed_token()
+    from metricz import MetricWriter
+
+    # tags are new dictionaries for every call, as they are in most applications
+    tags = [{'hostname': 'host-{}'.format(i), 'application': 'benchmark'} for i in range(SERIES)]
+
+    print('{:>10} {:>16} {:>16}'.format('buffer', 'bytes/point', 'ns/defer_metric'))
+
+    def dict_writer():
+        writer = MetricWriter()
+        writer.deferred_metrics = DictBuffer()
+        return writer
+
+    for name, new_writer in (('dicts', dict_writer), ('columnar', MetricWriter)):
+        memory, duration = measure(new_writer, args.points, tags)
+        print('{:>10} {:>16.1f} {:>16.0f}'.format(name, memory, duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Catching up on a backlog of deferred metrics, e.g. after an outage, against a
+server limiting the request body size (like nginx's client_max_body_size).
+
+    python -m benchmarks.bench_catchup [--points N] [--max-body BYTES]
+"""
+
+import argparse
+import time
+
+from benchmarks.fake_kairosdb import FakeKairosDB, fixed_token
+
+SERIES = 500
+# (label, max_request_points, max_request_bytes)
+LIMITS = (
+    ('unlimited', None, None),
+    ('points=20000', 20000, None),
+    ('bytes=1MiB', None, 1024 * 1024),
+    ('default', 20000, 1024 * 1024),
+    ('points=5000', 5000, 1024 * 1024),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', type=int, default=500000)
+    parser.add_argument('--max-body', type=int, default=1024 * 1024, help='server body size limit in bytes')
+    parser.add_argument('--bandwidth', type=float, default=12.5e6,
+                        help='simulated bandwidth in bytes/s (default: 100 Mbit/s)')
+    args = parser.parse_args()
+
+    fixed_token()
+    from metricz import MetricWriter
+
+    print('{:>14} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+        'limits', 'requests', 'rejected', 'written', 'kept', 'points/s'))
+    with FakeKairosDB(bandwidth=args.bandwidth, max_body=args.max_body) as kairosdb:
+        for label, max_points, max_bytes in LIMITS:
+            writer = MetricWriter(kairosdb_url=kairosdb.url, timeout=4, max_request_points=max_points,
+                                  max_request_bytes=max_bytes)
+            for i in range(args.points):
+                writer.defer_metric('benchmark.metric', i, {'series': str(i % SERIES), 'application': 'benchmark'},
+                                    1500000000000 + i)
+            kairosdb.reset()
+            start = time.time()
+            writer.write_deferred()
+            elapsed = time.time() - start
+            kept = len(writer.deferred_metrics)
+            print('{:>14} {:>10} {:>10} {:>10} {:>10} {:>12.0f}'.format(
+                label, kairosdb.requests + kairosdb.rejected, kairosdb.rejected, kairosdb.points, kept,
+                kairosdb.points / elapsed))
+            writer.deferred_metrics.drain()
+            writer.close()
+
+
+if __name__ == '__main__':
+    main()
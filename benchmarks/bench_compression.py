@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""
+Bytes on the wire and write_deferred latency with and without gzip.
+
+    python -m benchmarks.bench_compression [--bandwidth BYTES_PER_SECOND]
+"""
+
+import argparse
+import time
+
+from benchmarks.fake_kairosdb import FakeKairosDB, fixed_token
+
+BATCH_SIZES = (1000, 10000, 100000)
+
+
+def defer_batch(writer, size):
+    for i in range(size):
+        writer.defer_metric('benchmark.metric.{}'.format(i % 10), i,
+                            {'hostname': 'host-{}'.format(i % 5), 'application': 'benchmark'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--bandwidth', type=float, default=12.5e6,
+                        help='simulated bandwidth in bytes/s (default: 100 Mbit/s)')
+    args = parser.parse_args()
+
+    fixed_token()
+    from metricz import MetricWriter
+
+    print('{:>8} {:>10} {:>14} {:>10}'.format('points', 'gzip', 'bytes', 'seconds'))
+    with FakeKairosDB(bandwidth=args.bandwidth) as kairosdb:
+        for size in BATCH_SIZES:
+            for threshold in (None, 0):
+                writer = MetricWriter(kairosdb_url=kairosdb.url, fail_silently=False, timeout=60,
+                                      compress_threshold=threshold)
+                defer_batch(writer, size)
+                kairosdb.reset()
+                start = time.time()
+                writer.write_deferred()
+                elapsed = time.time() - start
+                assert kairosdb.points == size
+                print('{:>8} {:>10} {:>14} {:>10.3f}'.format(
+                    size, 'no' if threshold is None else 'yes', kairosdb.bytes_received, elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+write_deferred throughput with a growing number of concurrent sender workers.
+
+    python -m benchmarks.bench_sender [--points N] [--latency SECONDS]
+"""
+
+import argparse
+import time
+
+from benchmarks.fake_kairosdb import FakeKairosDB, fixed_token
+
+WORKERS = (1, 2, 4, 8, 16)
+SERIES = 256
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', type=int, default=200000)
+    parser.add_argument('--chunk-points', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=0.02, help='server latency per request in seconds')
+    args = parser.parse_args()
+
+    fixed_token()
+    from metricz import MetricWriter
+    from metricz.sender import ConcurrentSender
+
+    print('{:>8} {:>10} {:>14}'.format('workers', 'requests', 'points/s'))
+    with FakeKairosDB(latency=args.latency) as kairosdb:
+        for workers in WORKERS:
+            writer = MetricWriter(kairosdb_url=kairosdb.url, fail_silently=False, timeout=60,
+                                  sender=ConcurrentSender(workers, args.chunk_points))
+            for i in range(args.points):
+                writer.defer_metric('benchmark.metric', i, {'series': str(i % SERIES)}, i)
+            kairosdb.reset()
+            start = time.time()
+            writer.write_deferred()
+            elapsed = time.time() - start
+            writer.close()
+            assert kairosdb.points == args.points
+            print('{:>8} {:>10} {:>14.0f}'.format(workers, kairosdb.requests, args.points / elapsed))
+
+
+if __name__ == '__main__':
+    main()
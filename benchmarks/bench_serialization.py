@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Encode time and peak RSS of a deferred batch with each serialization path:
+json.dumps of the payload (the former path), the fastest installed JSON
+library, and the streaming encoder. Every path runs in its own process so
+the peak RSS is not shared.
+
+    python -m benchmarks.bench_serialization [--points N]
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from benchmarks.fake_kairosdb import FakeKairosDB, fixed_token
+
+SERIES = 100
+PATHS = ('json.dumps', 'serializer', 'streaming')
+
+
+def make_batch(points):
+    from metricz.buffer import MetricBuffer
+    buffer = MetricBuffer()
+    for i in range(points):
+        buffer.append('benchmark.metric', {'series': str(i % SERIES), 'application': 'benchmark'},
+                      1500000000000 + i, i * 0.5)
+    return buffer.drain()
+
+
+def encode(path, points):
+    """
+    Encodes a batch with a path, in this process.
+
+    :return: Seconds spent encoding, encoded bytes and peak RSS increase in MB.
+    """
+    from metricz.serialization import StreamingPayload, dumps
+    batch = make_batch(points)
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    if path == 'json.dumps':
+        size = len(json.dumps(batch.payload()).encode('utf-8'))
+    elif path == 'serializer':
+        size = len(dumps(batch.payload()))
+    else:
+        size = sum(len(chunk) for chunk in StreamingPayload(batch))
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return elapsed, size, (peak - baseline) / 1024.0
+
+
+def write(points, stream_threshold):
+    """
+    Writes a batch to a local fake Kairosdb.
+    """
+    fixed_token()
+    from metricz import MetricWriter
+    with FakeKairosDB() as kairosdb:
+        writer = MetricWriter(kairosdb_url=kairosdb.url, fail_silently=False, timeout=60,
+                              stream_threshold=stream_threshold)
+        writer.deferred_metrics.requeue(make_batch(points))
+        start = time.perf_counter()
+        writer.write_deferred()
+        elapsed = time.perf_counter() - start
+        writer.close()
+        assert kairosdb.points == points
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', type=int, default=100000)
+    parser.add_argument('--encode', choices=PATHS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.encode:
+        print(json.dumps(encode(args.encode, args.points)))
+        return
+
+    from metricz.serialization import dumps
+    print('{} points, serializer: {}'.format(args.points, dumps.__name__))
+    print('{:>12} {:>10} {:>12} {:>14}'.format('path', 'seconds', 'bytes', 'peak RSS (MB)'))
+    for path in PATHS:
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_serialization', '--points',
+                                 str(args.points), '--encode', path], stdout=subprocess.PIPE, check=True).stdout
+        elapsed, size, rss = json.loads(output.decode('utf-8'))
+        print('{:>12} {:>10.3f} {:>12} {:>14.1f}'.format(path, elapsed, size, rss))
+
+    print('write_deferred to a local server: {:.3f}s buffered, {:.3f}s streamed'.format(
+        write(args.points, None), write(args.points, 0)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput, latency, CPU and memory of the writer against a local fake
+Kairosdb, in scenarios covering single writes, deferred batches of growing
+size, concurrent producers and a failing server. Results can be written as
+JSON and compared with those of a previous run to catch regressions.
+
+    python -m benchmarks.bench_suite [--quick] [--scenario NAME ...] [--json FILE]
+                                     [--compare FILE] [--tolerance FRACTION]
+
+For each scenario:
+
+* ``points_per_second``: points written over the wall time of the scenario.
+* ``latency_p50_ms``, ``latency_p99_ms``: of the timed calls, ``write_metric``,
+  ``write_deferred`` or ``defer_metric`` depending on the scenario.
+* ``cpu_us_per_point``: CPU time of the process, minus the time spent by the
+  fake server, per point.
+* ``peak_memory_bytes``: peak of the memory allocated by Python during a
+  second run of the scenario, traced with tracemalloc (which would skew the
+  timings of the first run).
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+import threading
+import time
+import tracemalloc
+
+from benchmarks.fake_kairosdb import FakeKairosDB, fixed_token
+
+SERIES = 100
+BATCH_SIZES = (100, 1000, 10000, 100000)
+# Points written by the deferred scenarios, in as many batches as needed
+DEFERRED_POINTS = 200000
+WRITES = 2000
+PRODUCERS = 8
+PRODUCER_POINTS = 25000
+ERROR_RATE = 0.1
+
+
+def percentile_ms(latencies, percent):
+    from metricz.instruments import percentile
+
+    return round(percentile(sorted(latencies), percent) * 1000, 3) if latencies else None
+
+
+def tags(i):
+    return {'series': str(i % SERIES), 'application': 'benchmark'}
+
+
+def single_writes(kairosdb, scale):
+    """
+    ``write_metric`` of one point at a time, one request each.
+    """
+    from metricz import MetricWriter
+
+    writer = MetricWriter(kairosdb_url=kairosdb.url, fail_silently=False)
+    latencies = []
+    for i in range(WRITES // scale):
+        start = time.perf_counter()
+        writer.write_metric('benchmark.metric', i, tags(i), 1500000000000 + i)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+    return WRITES // scale, latencies
+
+
+def deferred_batches(batch_size, **options):
+    def scenario(kairosdb, scale):
+        """
+        ``defer_metric`` of a batch of points, then ``write_deferred``.
+        """
+        from metricz import MetricWriter
+
+        writer = MetricWriter(kairosdb_url=kairosdb.url, fail_silently=False, timeout=60, **options)
+        batches = max(1, DEFERRED_POINTS // scale // batch_size)
+        latencies = []
+        for batch in range(batches):
+            for i in range(batch * batch_size, (batch + 1) * batch_size):
+                writer.defer_metric('benchmark.metric', i, tags(i), 1500000000000 + i)
+            start = time.perf_counter()
+            writer.write_deferred()
+            latencies.append(time.perf_counter() - start)
+        writer.close()
+        return batches * batch_size, latencies
+
+    return scenario
+
+
+def concurrent_producers(kairosdb, scale):
+    """
+    Threads calling ``defer_metric``, written by the background flusher.
+    """
+    from metricz import MetricWriter
+
+    writer = MetricWriter(kairosdb_url=kairosdb.url, timeout=60, flush_interval=1, flush_size=10000,
+                          buffer_shards=PRODUCERS)
+    points = PRODUCER_POINTS // scale
+    latencies = [[] for _ in range(PRODUCERS)]
+
+    def produce(producer):
+        timed = latencies[producer]
+        for i in range(points):
+            start = time.perf_counter()
+            writer.defer_metric('benchmark.metric', i, {'producer': str(producer)}, 1500000000000 + i)
+            timed.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=produce, args=(producer,)) for producer in range(PRODUCERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.close()
+    return PRODUCERS * points, [latency for timed in latencies for latency in timed]
+
+
+def scenarios():
+    from metricz.retry import RetryPolicy
+
+    # (name, server options, scenario)
+    yield 'write_metric', {}, single_writes
+    for batch_size in BATCH_SIZES:
+        yield 'deferred_{}'.format(batch_size), {}, deferred_batches(batch_size)
+    yield 'concurrent_producers', {}, concurrent_producers
+    yield 'deferred_10000_errors', {'error_rate': ERROR_RATE}, deferred_batches(
+        10000, retry=RetryPolicy(retries=5, backoff=0.001))
+
+
+def run(server_options, scenario, scale, memory):
+    with FakeKairosDB(**server_options) as kairosdb:
+        wall, cpu = time.perf_counter(), time.process_time()
+        points, latencies = scenario(kairosdb, scale)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        result = {
+            'points': points,
+            'seconds': round(wall, 3),
+            'points_per_second': round(points / wall),
+            'latency_p50_ms': percentile_ms(latencies, 50),
+            'latency_p99_ms': percentile_ms(latencies, 99),
+            'cpu_us_per_point': round((cpu - kairosdb.cpu_time) / points * 1e6, 3),
+            'requests': kairosdb.requests + kairosdb.rejected + kairosdb.failed,
+            'failed_requests': kairosdb.failed,
+            'written': kairosdb.points,
+        }
+    if memory:
+        with FakeKairosDB(**server_options) as kairosdb:
+            tracemalloc.start()
+            try:
+                scenario(kairosdb, scale)
+                result['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    return result
+
+
+def compare(results, baseline, tolerance, out=sys.stdout):
+    """
+    Prints the change of each scenario since the baseline.
+
+    :return: The scenarios whose throughput dropped by more than the
+             tolerance.
+    :rtype: list
+    """
+    regressions = []
+    print('\n{:>24} {:>12} {:>12}'.format('vs ' + baseline.get('metricz', '?'), 'points/s', 'p99'), file=out)
+    for name, result in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if not before:
+            continue
+        throughput = result['points_per_second'] / float(before['points_per_second']) - 1
+        p99 = (result['latency_p99_ms'] / before['latency_p99_ms'] - 1) if before['latency_p99_ms'] else 0
+        print('{:>24} {:>+12.1%} {:>+12.1%}'.format(name, throughput, p99), file=out)
+        if throughput < -tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='run with 10 times fewer points')
+    parser.add_argument('--scenario', action='append', help='run only this scenario (repeatable)')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory runs')
+    parser.add_argument('--json', help='write the results to this file ("-" for stdout)')
+    parser.add_argument('--compare', help='results of a previous run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='throughput drop failing the comparison (default: 0.2)')
+    args = parser.parse_args()
+
+    fixed_token()
+    import metricz
+
+    results = {
+        'metricz': metricz.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z',
+        'scenarios': {},
+    }
+    # with --json - the table goes to stderr, so stdout is valid JSON
+    out = sys.stderr if args.json == '-' else sys.stdout
+    print('{:>24} {:>12} {:>10} {:>10} {:>10} {:>12}'.format(
+        'scenario', 'points/s', 'p50 ms', 'p99 ms', 'cpu us/pt', 'peak MiB'), file=out)
+    for name, server_options, scenario in scenarios():
+        if args.scenario and name not in args.scenario:
+            continue
+        result = results['scenarios'][name] = run(server_options, scenario, 10 if args.quick else 1,
+                                                  not args.no_memory)
+        peak = result.get('peak_memory_bytes')
+        print('{:>24} {:>12} {:>10} {:>10} {:>10} {:>12}'.format(
+            name, result['points_per_second'], result['latency_p50_ms'], result['latency_p99_ms'],
+            result['cpu_us_per_point'], '{:.1f}'.format(peak / 1048576.0) if peak is not None else '-'), file=out)
+
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    elif args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, out)
+        if regressions:
+            sys.exit('Throughput regressed by more than {:.0%}: {}'.format(args.tolerance, ', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+defer_metric throughput with many producer threads sharing one writer, with
+a single buffer and with a sharded buffer.
+
+    python -m benchmarks.bench_threads [--points N] [--shards N]
+"""
+
+import argparse
+import threading
+import time
+
+from benchmarks.fake_kairosdb import fixed_token
+
+THREADS = (1, 4, 16, 64)
+SERIES = 100
+
+
+def run(writer, threads, points):
+    """
+    :return: defer_metric calls per second.
+    """
+    per_thread = points // threads
+    tags = [{'hostname': 'host-{}'.format(i), 'application': 'benchmark'} for i in range(SERIES)]
+    barrier = threading.Barrier(threads + 1)
+
+    def produce(offset):
+        barrier.wait()
+        for i in range(offset, offset + per_thread):
+            writer.defer_metric('benchmark.metric', i, tags[i % SERIES], i)
+
+    workers = [threading.Thread(target=produce, args=(n * per_thread,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    assert len(writer.deferred_metrics) == per_thread * threads
+    return per_thread * threads / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', type=int, default=640000)
+    parser.add_argument('--shards', type=int, default=16)
+    parser.add_argument('--max-buffer-points', type=int, default=None)
+    args = parser.parse_args()
+
+    fixed_token()
+    from metricz import MetricWriter
+
+    print('{:>8} {:>14} {:>14}'.format('threads', 'single ops/s', 'sharded ops/s'))
+    for threads in THREADS:
+        single = run(MetricWriter(max_buffer_points=args.max_buffer_points), threads, args.points)
+        sharded = run(MetricWriter(max_buffer_points=args.max_buffer_points, buffer_shards=args.shards),
+                      threads, args.points)
+        print('{:>8} {:>14.0f} {:>14.0f}'.format(threads, single, sharded))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+defer_metric throughput for each accepted timestamp form.
+
+    python -m benchmarks.bench_timestamps [--points N]
+"""
+
+import argparse
+import datetime
+import time
+
+from benchmarks.fake_kairosdb import fixed_token
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--points', type=int, default=500000)
+    args = parser.parse_args()
+
+    fixed_token()
+    from metricz import MetricWriter
+
+    tags = {'hostname': 'benchmark', 'application': 'benchmark'}
+    timestamps = (
+        ('default', lambda: None),
+        ('millis', lambda: int(time.time() * 1000)),
+        ('seconds', time.time),
+        ('datetime', datetime.datetime.utcnow),
+    )
+
+    print('{:>10} {:>14} {:>12}'.format('timestamp', 'points/s', 'ns/point'))
+    for name, clock in timestamps:
+        writer = MetricWriter()
+        # timestamps are created outside of the measured loop
+        values = [clock() for _ in range(args.points)]
+        start = time.perf_counter()
+        for timestamp in values:
+            writer.defer_metric('benchmark.metric', 1, tags, timestamp)
+        elapsed = time.perf_counter() - start
+        print('{:>10} {:>14.0f} {:>12.0f}'.format(name, args.points / elapsed, elapsed / args.points * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+In-process HTTP stand-in for the Kairosdb datapoints endpoint.
+"""
+
+import gzip
+import json
+import os
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class FakeKairosDB(object):
+    """
+    Accepts datapoint writes on a local port and counts what it receives.
+
+    :param bandwidth: Simulated network bandwidth in bytes per second, the
+                      response is delayed by the time the body would take to
+                      transfer. (Default: unlimited)
+    :param latency: Seconds to wait before answering each request.
+    :param status: Response status.
+    :param max_body: Body size limit in bytes, bigger requests are answered
+                     with 413 Request Entity Too Large. (Default: unlimited)
+    :param error_rate: Fraction of the requests answered with 503 Service
+                       Unavailable, chosen at random (seeded, so runs are
+                       comparable). Counted in ``failed``.
+
+    ``cpu_time`` is the CPU time spent handling requests, so benchmarks can
+    tell it apart from the CPU time of the writer in the same process.
+    """
+
+    def __init__(self, bandwidth=None, latency=0, status=204, max_body=None, error_rate=0, seed=0):
+        self.bandwidth = bandwidth
+        self.max_body = max_body
+        self.error_rate = error_rate
+        self.rejected = 0
+        self.failed = 0
+        self._random = random.Random(seed)
+        self.latency = latency
+        self.status = status
+        self.requests = 0
+        self.points = 0
+        self.bytes_received = 0
+        self.cpu_time = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{}:{}/api/v1/datapoints'.format(host, port)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self):
+        with self._lock:
+            self.requests = self.points = self.bytes_received = self.rejected = self.failed = self.cpu_time = 0
+
+    def _record(self, body, encoding):
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        payload = json.loads(body.decode('utf-8'))
+        if isinstance(payload, dict):
+            payload = [payload]
+        points = sum(len(metric.get('datapoints', [None])) for metric in payload)
+        with self._lock:
+            self.requests += 1
+            self.points += points
+
+    def _handler(self):
+        kairosdb = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def read_body(self):
+                if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+                    return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                    chunks.append(self.rfile.read(size))
+                    self.rfile.readline()
+                    if not size:
+                        return b''.join(chunks)
+
+            def handle_one_request(self):
+                # includes parsing the request, not only do_POST
+                start = time.thread_time()
+                BaseHTTPRequestHandler.handle_one_request(self)
+                with kairosdb._lock:
+                    kairosdb.cpu_time += time.thread_time() - start
+
+            def do_POST(self):
+                body = self.read_body()
+                with kairosdb._lock:
+                    kairosdb.bytes_received += len(body)
+                delay = kairosdb.latency
+                if kairosdb.bandwidth:
+                    delay += len(body) / float(kairosdb.bandwidth)
+                if delay:
+                    time.sleep(delay)
+                status = kairosdb.status
+                if kairosdb.max_body is not None and len(body) > kairosdb.max_body:
+                    status = 413
+                    with kairosdb._lock:
+                        kairosdb.rejected += 1
+                elif kairosdb.error_rate:
+                    with kairosdb._lock:
+                        if kairosdb._random.random() < kairosdb.error_rate:
+                            status = 503
+                            kairosdb.failed += 1
+                if 300 > status > 199:
+                    kairosdb._record(body, self.headers.get('Content-Encoding'))
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def fixed_token():
+    """
+    Makes the tokens library use a fixed token instead of reading credentials.
+    """
+    os.environ.setdefault('OAUTH2_ACCESS_TOKENS', 'uid=benchmark')
@@ -1,5 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import sys
+
 __version__ = '0.1.5.2'
 
-from .metricz import MetricWriter, OAUTH2_ACCESS_TOKEN_URL, CREDENTIALS_DIR  # noqa
+from .defaults import OAUTH2_ACCESS_TOKEN_URL, CREDENTIALS_DIR  # noqa
+
+if sys.version_info >= (3, 7):
+    def __getattr__(name):
+        # metricz.metricz imports requests and tokens, which are slow to import, so
+        # it is only imported when the writer is used
+        if name == 'MetricWriter':
+            from . import metricz
+            return metricz.MetricWriter
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+else:  # pragma: no cover
+    from .metricz import MetricWriter  # noqa
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import datetime
+import logging
+import os
+import pprint
+import socket
+import time
+
+import tokens
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+from .buffer import MetricBuffer, DROP_OLDEST, BLOCK
+from .instruments import InstrumentRegistry
+from .registry import MAX_SERIES, SeriesRegistry
+from .serialization import dumps
+from .stats import Tracer, WriterStats
+from .metricz import (BaseMetricWriter, CREDENTIALS_DIR, KAIROSDB_URL, MAX_REQUEST_BYTES, MAX_REQUEST_POINTS,
+                      OAUTH2_ACCESS_TOKEN_URL,
+                      TOKEN_RENEWAL_PERIOD, compress_payload)
+
+logger = logging.getLogger(__name__)
+
+
+async def handle_response_errors(response):
+    """
+    Handles potential errors that were not silenced
+    :type response: aiohttp.ClientResponse
+    """
+    if response.status >= 400:
+        try:
+            error = pprint.pformat(await response.json(content_type=None))
+        except ValueError:
+            error = await response.read()
+        logger.error('Kairosdb error response:\n%s', error)
+        response.raise_for_status()
+
+
+class AsyncMetricWriter(BaseMetricWriter):
+    """
+    Asyncio interface to write metrics to the Bus kairosdb.
+
+    It has the same interface as :class:`metricz.MetricWriter` but
+    :meth:`write_metric`, :meth:`write_deferred` and :meth:`close` are
+    coroutines. Requests are made with a pool of up to ``pool_size`` aiohttp
+    connections and tokens are fetched in the loop's executor.
+
+    With ``flush_interval`` and/or ``flush_size`` deferred metrics are written
+    by a background task, started by the first deferred metric or when
+    entering ``async with``.
+
+    Payloads of at least ``compress_threshold`` bytes are sent gzipped.
+
+    Deferred metrics are written in requests of up to ``max_request_points``
+    points and ``max_request_bytes`` bytes of JSON, one after the other. Only
+    the request that fails and the following ones are kept.
+
+    Requests, flushes and token renewals are counted in :meth:`stats` and
+    traced by ``tracer``, as with the synchronous writer.
+    """
+    def __init__(self,
+                 url=os.environ.get('OAUTH2_ACCESS_TOKEN_URL', OAUTH2_ACCESS_TOKEN_URL),
+                 directory=os.environ.get('CREDENTIALS_DIR', CREDENTIALS_DIR),
+                 kairosdb_url=os.environ.get('KAIROSDB_URL', KAIROSDB_URL),
+                 token_name='uid',
+                 fail_silently=True,
+                 timeout=4,
+                 flush_interval=None,
+                 flush_size=None,
+                 max_buffer_points=None,
+                 max_buffer_bytes=None,
+                 overflow=DROP_OLDEST,
+                 spill=None,
+                 pool_size=10,
+                 compress_threshold=None,
+                 max_request_points=MAX_REQUEST_POINTS,
+                 max_request_bytes=MAX_REQUEST_BYTES,
+                 max_series=MAX_SERIES,
+                 validate_names=True,
+                 guard=None,
+                 self_metrics=False,
+                 tracer=None):
+        if aiohttp is None:
+            raise ImportError('AsyncMetricWriter requires aiohttp, install it with "pip install metricz[async]"')
+        if overflow == BLOCK:
+            raise ValueError('The block overflow policy would block the event loop')
+        tokens.configure(url=url, dir=directory)
+        tokens.manage('uid', ['uid'])
+        tokens.start()
+        self.token_name = token_name
+        self.token_ts = None
+        self.fail_silently = fail_silently
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.compress_threshold = compress_threshold
+        self.max_request_points = max_request_points
+        self.max_request_bytes = max_request_bytes
+        self.deferred_metrics = MetricBuffer(max_buffer_points, max_buffer_bytes, overflow, spill)
+        self.instruments = InstrumentRegistry()
+        self._stats = WriterStats(self.instruments if self_metrics else None, tags={'hostname': socket.gethostname()})
+        self.tracer = tracer or Tracer()
+        self.guard = guard
+        self.series_registry = SeriesRegistry(max_series, validate_names, guard)
+        self.kairosdb_url = kairosdb_url
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._headers = {}
+        self._session = None
+        self._token_lock = None
+        self._flush_task = None
+        self._wakeup = None
+
+    async def __aenter__(self):
+        self._start_flusher()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    def _start_flusher(self):
+        if self._flush_task is not None or not (self.flush_interval or self.flush_size):
+            return
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # the task is started once we are called from the event loop
+            return
+        self._wakeup = asyncio.Event()
+        self._flush_task = asyncio.ensure_future(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.write_deferred()
+            except Exception:
+                logger.exception('Failed to flush deferred metrics')
+
+    async def close(self, timeout=None):
+        """
+        Stops the background flush task, if any, writes the remaining deferred
+        metrics and closes the connection pool.
+
+        :param timeout: Timeout for the final write.
+        :type timeout: float
+        :return: None
+        :rtype: None
+        """
+        if self._flush_task:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        try:
+            await self.write_deferred(timeout)
+        finally:
+            if self._session:
+                await self._session.close()
+                self._session = None
+
+    async def _renew_token(self, token_name='uid'):
+        """
+        Renews the oauth2 token if it's older than the renewal period, without
+        blocking the event loop.
+
+        :param token_name: token_name to get the token for.
+        :return: None
+        :rtype: None
+        """
+        now = datetime.datetime.utcnow()
+        if self.token_ts and (now - TOKEN_RENEWAL_PERIOD) <= self.token_ts:
+            return
+        if self._token_lock is None:
+            self._token_lock = asyncio.Lock()
+        async with self._token_lock:
+            # another task may have renewed it while we waited for the lock
+            if self.token_ts and (now - TOKEN_RENEWAL_PERIOD) <= self.token_ts:
+                return
+            loop = asyncio.get_event_loop()
+            start = time.perf_counter()
+            try:
+                with self.tracer.span('metricz.token', {'token': token_name}):
+                    token = await loop.run_in_executor(None, tokens.get, token_name)
+            except Exception:
+                self._stats.count('token.errors')
+                raise
+            finally:
+                self._stats.observe('token.latency', (time.perf_counter() - start) * 1000)
+            self._stats.count('token.renewals')
+            self._headers = {'Authorization': 'Bearer {}'.format(token)}
+            self.token_ts = now
+
+    async def _post(self, data, timeout=None):
+        await self._renew_token(self.token_name)
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.pool_size))
+        data, headers = compress_payload(data, self.compress_threshold)
+        if headers:
+            headers = dict(self._headers, **headers)
+        self._stats.count('requests')
+        start = time.perf_counter()
+        with self.tracer.span('metricz.request', {'http.url': self.kairosdb_url, 'attempt': 0}) as span:
+            try:
+                response = await self._session.post(
+                    self.kairosdb_url,
+                    data=data,
+                    headers=headers or self._headers,
+                    timeout=aiohttp.ClientTimeout(total=timeout or self.timeout)
+                )
+            except Exception:
+                self._stats.count('errors')
+                raise
+            finally:
+                self._stats.observe('request.latency', (time.perf_counter() - start) * 1000)
+            span.set_attribute('http.status_code', response.status)
+        self._stats.count('http.{}'.format(response.status))
+        async with response:
+            if not self.fail_silently:
+                await handle_response_errors(response)
+            return response
+
+    async def write_metric(self, metric_name, value, tags, timestamp=None, timeout=None):
+        """
+        Writes a metric to kairosdb.
+
+        :param metric_name: The name of the metric.
+        :type metric_name: str
+        :param value: The value of the metric.
+        :type value: int, float or metricz.values.HistogramValue
+        :param tags: Tags to add to the metric.
+        :type tags: dict
+        :param timestamp: The time to register the metric, as milliseconds
+                          since the epoch, seconds since the epoch or a
+                          datetime (IN UTC!). (Default: now)
+        :type timestamp: int, float or datetime.datetime
+        :return: None
+        :rtype: None
+        """
+        series = self._intern(metric_name, tags)
+        if series is None or self.guard is not None and not self.guard.allow(series):
+            return
+        try:
+            payload = self._construct_payload(metric_name, value, series.tags, timestamp)
+        except ValueError as e:
+            self._invalid(metric_name, series.tags, e)
+            return
+        response = await self._post(dumps(payload), timeout)
+        if 300 > response.status > 199:
+            self._stats.count('points.written')
+
+    def defer_metric(self, metric_name, value, tags, timestamp=None):
+        """
+        Defers a metric write to kairosdb.
+
+        :param metric_name: The name of the metric.
+        :type metric_name: str
+        :param value: The value of the metric.
+        :type value: int, float or metricz.values.HistogramValue
+        :param tags: Tags to add to the metric.
+        :type tags: dict
+        :param timestamp: The time to register the metric, as milliseconds
+                          since the epoch, seconds since the epoch or a
+                          datetime (IN UTC!). (Default: now)
+        :type timestamp: int, float or datetime.datetime
+        :return: None
+        :rtype: None
+        """
+        series = self._intern(metric_name, tags)
+        if series is not None:
+            self._record(series, value, timestamp)
+
+    def _record(self, series, value, timestamp=None):
+        size = self._defer(series, value, timestamp)
+        self._start_flusher()
+        if self._wakeup and self.flush_size and size >= self.flush_size:
+            self._wakeup.set()
+
+    async def write_deferred(self, timeout=None):
+        """
+        Writes all deferred metrics to kairosdb, grouping the datapoints of
+        each series.
+
+        Metrics that fail to be written, and the ones after them, are kept to
+        be written on the next call.
+
+        :return: None
+        :rtype: None
+        """
+        start = time.perf_counter()
+        with self.tracer.span('metricz.write_deferred', {}) as span:
+            self._set_gauges()
+            batch = self.deferred_metrics.drain()
+            self._collect_instruments(batch)
+            span.set_attribute('points', len(batch))
+            if not batch:
+                return
+
+            chunks = list(batch.split(self.max_request_points, self.max_request_bytes))
+            try:
+                for index, chunk in enumerate(chunks):
+                    data = dumps(chunk.payload())
+                    self._stats.observe('batch.points', len(chunk))
+                    self._stats.observe('batch.bytes', len(data))
+                    try:
+                        response = await self._post(data, timeout)
+                    except BaseException:
+                        # includes the cancellation of the flush task
+                        self._keep(chunks[index:])
+                        raise
+                    if not 300 > response.status > 199:
+                        self._keep(chunks[index:])
+                        return
+                    self._stats.count('points.written', len(chunk))
+            finally:
+                self._stats.count('flushes')
+                self._stats.observe('flush.latency', (time.perf_counter() - start) * 1000)
+
+    def _keep(self, chunks):
+        """
+        Puts the batches that were not written back in the buffer.
+
+        :param chunks: The batches, in order.
+        :type chunks: list
+        """
+        # each batch is put back in front of the buffer, so the last one goes first
+        for chunk in reversed(chunks):
+            self.deferred_metrics.requeue(chunk)
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import inspect
+import logging
+import threading
+import weakref
+
+logger = logging.getLogger(__name__)
+
+# Seconds between token renewals. Renewing is cheap until the token is close to
+# expiring, when the tokens library fetches a new one.
+TOKEN_REFRESH_INTERVAL = 60
+# Seconds before retrying a failed renewal
+TOKEN_RETRY_INTERVAL = 5
+
+
+class TokenUnavailableError(Exception):
+    """
+    Raised instead of writing when no token was fetched yet.
+    """
+
+
+class TokenRefresher(threading.Thread):
+    """
+    Daemon thread renewing a token in the background.
+
+    ``renew`` is called right away and then every ``interval`` seconds, or
+    ``retry_interval`` seconds after a failure. It fetches the token and
+    makes it available to the writer, so writes never wait for a token
+    fetch.
+
+    A bound method is only weakly referenced: the thread does not keep its
+    writer alive and stops once the writer is collected.
+    """
+
+    def __init__(self, renew, interval=TOKEN_REFRESH_INTERVAL, retry_interval=TOKEN_RETRY_INTERVAL):
+        """
+        :param renew: Function fetching and installing the token.
+        :type renew: callable
+        :param interval: Seconds between renewals.
+        :type interval: float
+        :param retry_interval: Seconds between renewals after a failure.
+        :type retry_interval: float
+        """
+        super(TokenRefresher, self).__init__(name='metricz-token')
+        self.daemon = True
+        self.interval = interval
+        self.retry_interval = retry_interval
+        if inspect.ismethod(renew):
+            self._renew = weakref.WeakMethod(renew)
+        else:
+            self._renew = lambda: renew
+        self._ready = threading.Event()
+        self._stopped = threading.Event()
+
+    @property
+    def ready(self):
+        """
+        Whether a token was fetched.
+        """
+        return self._ready.is_set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            renew = self._renew()
+            if renew is None:
+                # the writer was collected
+                return
+            try:
+                renew()
+            except Exception:
+                logger.exception('Failed to renew the token')
+                interval = self.retry_interval
+            else:
+                self._ready.set()
+                interval = self.interval
+            # not to keep the writer alive while waiting
+            del renew
+            self._stopped.wait(interval)
+
+    def wait(self, timeout=None):
+        """
+        Waits for the first token.
+
+        :param timeout: Maximum seconds to wait.
+        :type timeout: float
+        :return: Whether a token is available.
+        :rtype: bool
+        """
+        return self._ready.wait(timeout)
+
+    def stop(self, timeout=None):
+        """
+        Stops the thread.
+
+        :param timeout: Maximum seconds to wait for the thread.
+        :type timeout: float
+        """
+        self._stopped.set()
+        # the writer may be collected by the thread itself
+        if self.is_alive() and self is not threading.current_thread():
+            self.join(timeout)
@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+import re
+import socket
+import struct
+
+import requests
+
+from .buffer import Batch, Series, series_key
+from .serialization import dumps
+from .values import HISTOGRAM, HistogramValue
+
+try:
+    import snappy
+except ImportError:  # pragma: no cover
+    snappy = None
+
+GRAPHITE_PORT = 2003
+
+
+def point_batch(metric_name, tags, timestamp, value):
+    """
+    Returns a batch with a single point, to write it like deferred metrics.
+
+    :rtype: metricz.buffer.Batch
+    """
+    data_type = HISTOGRAM if isinstance(value, HistogramValue) else None
+    series = Series(series_key(metric_name, tags), metric_name, tags, data_type)
+    series.append(timestamp, value)
+    return Batch([series])
+
+
+def histogram_fields(histogram):
+    """
+    Summary of a histogram for backends without native histograms.
+
+    :type histogram: metricz.values.HistogramValue
+    :return: List of (field name, value) tuples.
+    :rtype: list
+    """
+    return [('count', histogram.count), ('sum', histogram.sum), ('min', histogram.min), ('max', histogram.max)]
+
+
+class Backend(object):
+    """
+    A time series database metrics are written to.
+
+    Backends encode a whole batch at once, working on the columns of its
+    series, and send it in a single request.
+    """
+
+    def __init__(self):
+        self.written = 0
+        self.failures = 0
+
+    def encode(self, batch):
+        """
+        Serializes a batch in the backend's format.
+
+        :type batch: metricz.buffer.Batch
+        :rtype: bytes
+        """
+        raise NotImplementedError
+
+    def send(self, data, timeout=None):
+        """
+        Sends serialized metrics, raising an exception if they were not
+        written.
+
+        :type data: bytes
+        :param timeout: Timeout in seconds.
+        :type timeout: float
+        """
+        raise NotImplementedError
+
+    def write(self, batch, timeout=None):
+        """
+        Writes a batch.
+
+        :type batch: metricz.buffer.Batch
+        :param timeout: Timeout in seconds.
+        :type timeout: float
+        :return: None
+        :rtype: None
+        """
+        self.send(self.encode(batch), timeout)
+        self.written += len(batch)
+
+    def close(self):
+        pass
+
+
+class HTTPBackend(Backend):
+    """
+    Backend written to with HTTP POST requests.
+    """
+
+    content_headers = {}
+
+    def __init__(self, url, headers=None, params=None):
+        """
+        :param url: The URL metrics are posted to.
+        :type url: str
+        :param headers: Extra request headers, e.g. for authentication.
+        :type headers: dict
+        :param params: Query parameters of the request.
+        :type params: dict
+        """
+        super(HTTPBackend, self).__init__()
+        self.url = url
+        self.params = params
+        self.session = requests.session()
+        self.session.headers.update(self.content_headers)
+        self.session.headers.update(headers or {})
+
+    def send(self, data, timeout=None):
+        response = self.session.post(self.url, data=data, params=self.params, timeout=timeout)
+        response.raise_for_status()
+
+    def close(self):
+        self.session.close()
+
+
+class KairosDB(HTTPBackend):
+    """
+    Kairosdb, e.g. a second cluster to dual-write to.
+    """
+
+    content_headers = {'Content-Type': 'application/json'}
+
+    def encode(self, batch):
+        return dumps(batch.payload())
+
+
+def _influx_escape(value, special=',= '):
+    value = str(value)
+    for character in special:
+        value = value.replace(character, '\\' + character)
+    return value
+
+
+class InfluxDB(HTTPBackend):
+    """
+    InfluxDB, written with the line protocol to ``url`` (e.g.
+    ``http://influxdb:8086/write``) in ``database``.
+
+    Metric values are written in the ``value`` field. Histograms are written
+    as their count, sum, min and max fields.
+    """
+
+    content_headers = {'Content-Type': 'text/plain; charset=utf-8'}
+
+    def __init__(self, url, database, headers=None):
+        super(InfluxDB, self).__init__(url, headers, {'db': database, 'precision': 'ms'})
+        self.database = database
+
+    def encode(self, batch):
+        lines = []
+        for series in batch.series:
+            # the measurement and tags are encoded once per series
+            prefix = _influx_escape(series.name, ', ') + ''.join(
+                ',{}={}'.format(_influx_escape(tag_name), _influx_escape(tag_value))
+                for tag_name, tag_value in sorted(series.tags.items()))
+            series.compact()
+            if series.type == HISTOGRAM:
+                lines.extend('{} count={}i,sum={!r},min={!r},max={!r} {}'.format(
+                    prefix, value.count, float(value.sum), float(value.min), float(value.max), timestamp)
+                    for timestamp, value in zip(series.timestamps, series.values))
+            elif series.values.typecode == 'd':
+                lines.extend('%s value=%r %d' % (prefix, value, timestamp)
+                             for timestamp, value in zip(series.timestamps, series.values))
+            else:
+                lines.extend('%s value=%di %d' % (prefix, value, timestamp)
+                             for timestamp, value in zip(series.timestamps, series.values))
+        return '\n'.join(lines).encode('utf-8')
+
+
+def _graphite_clean(value):
+    return re.sub(r'[\s;~!^=]', '_', str(value))
+
+
+class Graphite(Backend):
+    """
+    Graphite (carbon), written with the plaintext protocol over TCP.
+
+    Tags are written as Graphite tags (``name;tag=value``) and timestamps are
+    truncated to seconds. Histograms are written as ``<name>.count``,
+    ``<name>.sum``, ``<name>.min`` and ``<name>.max``.
+    """
+
+    def __init__(self, host, port=GRAPHITE_PORT, prefix=''):
+        super(Graphite, self).__init__()
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self._socket = None
+
+    def encode(self, batch):
+        lines = []
+        for series in batch.series:
+            tags = ''.join(';{}={}'.format(_graphite_clean(tag_name), _graphite_clean(tag_value))
+                           for tag_name, tag_value in sorted(series.tags.items()))
+            name = _graphite_clean(self.prefix + series.name)
+            series.compact()
+            if series.type == HISTOGRAM:
+                for timestamp, value in zip(series.timestamps, series.values):
+                    for field, field_value in histogram_fields(value):
+                        lines.append('{}.{}{} {!r} {}'.format(name, field, tags, field_value, timestamp // 1000))
+            else:
+                path = name + tags
+                lines.extend('%s %r %d' % (path, value, timestamp // 1000)
+                             for timestamp, value in zip(series.timestamps, series.values))
+        lines.append('')
+        return '\n'.join(lines).encode('utf-8')
+
+    def send(self, data, timeout=None):
+        for attempt in range(2):
+            if self._socket is None:
+                self._socket = socket.create_connection((self.host, self.port), timeout)
+            try:
+                self._socket.settimeout(timeout)
+                self._socket.sendall(data)
+                return
+            except OSError:
+                # the connection may have been closed by the server since the last write
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+
+def _varint(value):
+    value &= 0xffffffffffffffff
+    data = bytearray()
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def _field(tag, data):
+    """
+    Encodes a length delimited protobuf field.
+    """
+    return tag + _varint(len(data)) + data
+
+
+def snappy_compress(data):
+    """
+    Compresses data with Snappy, using python-snappy if it is installed.
+
+    Without it the data is framed as literals: a valid Snappy block that
+    is not compressed.
+
+    :type data: bytes
+    :rtype: bytes
+    """
+    if snappy is not None:
+        return snappy.compress(data)
+    chunks = [_varint(len(data))]
+    for start in range(0, len(data), 65536):
+        chunk = data[start:start + 65536]
+        length = len(chunk) - 1
+        if length < 60:
+            chunks.append(struct.pack('<B', length << 2))
+        else:
+            chunks.append(struct.pack('<BH', 61 << 2, length))
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+PROMETHEUS_NAME = re.compile(r'[^a-zA-Z0-9_:]')
+PROMETHEUS_LABEL = re.compile(r'[^a-zA-Z0-9_]')
+
+
+def _prometheus_name(name, pattern):
+    name = pattern.sub('_', name)
+    return '_' + name if name[:1].isdigit() else name
+
+
+class PrometheusRemoteWrite(HTTPBackend):
+    """
+    Prometheus remote write endpoint (e.g. of Cortex, Thanos, Mimir or
+    VictoriaMetrics).
+
+    Metric names and tag names are converted to valid Prometheus names
+    (``some.metric`` becomes ``some_metric``). Tags converted to the same
+    label name are merged, their values joined with ``;``, and a tag cannot
+    replace the ``__name__`` label. Histograms are written as
+    ``<name>_count``, ``<name>_sum``, ``<name>_min`` and ``<name>_max``.
+
+    Payloads are compressed with python-snappy if it is installed
+    (``pip install metricz[prometheus]``), otherwise they are sent in an
+    uncompressed Snappy block.
+    """
+
+    content_headers = {
+        'Content-Type': 'application/x-protobuf',
+        'Content-Encoding': 'snappy',
+        'X-Prometheus-Remote-Write-Version': '0.1.0',
+    }
+
+    def _timeseries(self, name, tags, samples):
+        labels = {}
+        for tag_name, tag_value in sorted((str(tag_name), str(tag_value)) for tag_name, tag_value in tags.items()):
+            label = _prometheus_name(tag_name, PROMETHEUS_LABEL)
+            labels[label] = labels[label] + ';' + tag_value if label in labels else tag_value
+        labels['__name__'] = name
+        # remote write requires unique labels sorted by name
+        data = b''.join(_field(b'\x0a', _field(b'\x0a', label.encode('utf-8')) + _field(b'\x12', value.encode('utf-8')))
+                        for label, value in sorted(labels.items()))
+        # Sample: double value = 1; int64 timestamp = 2;
+        data += b''.join(_field(b'\x12', b'\x09' + struct.pack('<d', value) + b'\x10' + _varint(timestamp))
+                         for timestamp, value in samples)
+        return _field(b'\x0a', data)
+
+    def encode(self, batch):
+        timeseries = []
+        for series in batch.series:
+            name = _prometheus_name(series.name, PROMETHEUS_NAME)
+            series.compact()
+            if series.type == HISTOGRAM:
+                fields = {}
+                for timestamp, value in zip(series.timestamps, series.values):
+                    for field, field_value in histogram_fields(value):
+                        fields.setdefault(field, []).append((timestamp, float(field_value)))
+                for field, samples in sorted(fields.items()):
+                    timeseries.append(self._timeseries('{}_{}'.format(name, field), series.tags, samples))
+            else:
+                timeseries.append(self._timeseries(name, series.tags, zip(series.timestamps, series.values)))
+        return snappy_compress(b''.join(timeseries))
@@ -0,0 +1,651 @@
+# -*- coding: utf-8 -*-
+
+import array
+import collections
+import itertools
+import threading
+
+from .serialization import dumps_json
+from .values import HISTOGRAM, HistogramValue
+
+# Overflow policies, used when a bounded buffer is full
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+BLOCK = 'block'
+SPILL = 'spill'
+
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK, SPILL)
+
+# Default seconds writers wait for room in the buffer with the block policy
+BLOCK_TIMEOUT = 1
+
+# Rough memory cost of a series: the Series object, its arrays, name and tags dict
+SERIES_OVERHEAD = 600
+# Memory cost of a point: its timestamp and value in the series arrays (histograms are bigger, but rare)
+POINT_SIZE = 16
+# Extra cost of a point in bounded buffers, which keep a reference to its series in arrival order
+ORDERED_POINT_SIZE = POINT_SIZE + 8
+
+# Longest JSON representation of a double, e.g. -2.2250738585072014e-308
+DOUBLE_JSON_SIZE = 24
+# JSON around a series' name and tags ('"type":"histogram",' and '"datapoints":[]},') and a point ('[,],')
+SERIES_JSON_OVERHEAD = 40
+POINT_JSON_OVERHEAD = 4
+
+# Columns are compacted once this many points were removed from their start
+COMPACT_THRESHOLD = 1024
+
+# Default number of shards of a sharded buffer
+SHARDS = 16
+
+
+def series_key(metric_name, tags):
+    """
+    Key identifying a series by metric name and tags.
+
+    :rtype: tuple
+    """
+    return metric_name, frozenset(tags.items())
+
+
+def series_overhead(metric_name, tags):
+    """
+    Estimates the memory used by a series, excluding its points.
+
+    :rtype: int
+    """
+    size = SERIES_OVERHEAD + len(metric_name)
+    for tag_name, tag_value in tags.items():
+        size += len(str(tag_name)) + len(str(tag_value))
+    return size
+
+
+class Series(object):
+    """
+    Datapoints of a metric name and tags, stored in timestamp and value columns.
+
+    Values are stored as longs until a float, or an int out of the range of
+    longs, is added, which turns the whole series into doubles. Histogram
+    series keep their values in a list.
+    """
+
+    __slots__ = ('key', 'name', 'tags', 'type', 'timestamps', 'values', 'start')
+
+    def __init__(self, key, name, tags, data_type=None):
+        self.key = key
+        self.name = name
+        self.tags = tags
+        self.type = data_type
+        self.timestamps = array.array('q')
+        self.values = [] if data_type == HISTOGRAM else array.array('q')
+        # points before start were removed but the columns not yet compacted
+        self.start = 0
+
+    def __len__(self):
+        return len(self.timestamps) - self.start
+
+    def append(self, timestamp, value):
+        try:
+            self.values.append(value)
+        except (TypeError, OverflowError):
+            self.promote()
+            try:
+                self.values.append(value)
+            except OverflowError:
+                raise ValueError('Value {} is out of the range of doubles'.format(value))
+        try:
+            self.timestamps.append(timestamp)
+        except OverflowError:
+            self.values.pop()
+            raise ValueError('Timestamp {} is out of the range of longs'.format(timestamp))
+
+    def promote(self):
+        """
+        Converts the values of the series to doubles.
+        """
+        if self.values.typecode != 'd':
+            self.values = array.array('d', self.values)
+
+    def popleft(self):
+        index = self.start
+        point = self.timestamps[index], self.values[index]
+        self.start += 1
+        if self.start >= COMPACT_THRESHOLD and self.start * 2 >= len(self.timestamps):
+            self.compact()
+        return point
+
+    def pop(self):
+        return self.timestamps.pop(), self.values.pop()
+
+    def compact(self):
+        if self.start:
+            del self.timestamps[:self.start]
+            del self.values[:self.start]
+            self.start = 0
+
+    def prepend(self, series):
+        """
+        Adds the points of another series with the same key before this
+        series' points.
+        """
+        series.compact()
+        self.compact()
+        if self.type != HISTOGRAM and self.values.typecode != series.values.typecode:
+            self.promote()
+            series.promote()
+        self.timestamps = series.timestamps + self.timestamps
+        self.values = series.values + self.values
+
+    def slice(self, start, end):
+        """
+        Returns a series with the points from ``start`` to ``end``.
+
+        :rtype: Series
+        """
+        if start == 0 and end >= len(self):
+            return self
+        series = Series(self.key, self.name, self.tags, self.type)
+        series.timestamps = self.timestamps[self.start + start:self.start + end]
+        series.values = self.values[self.start + start:self.start + end]
+        return series
+
+    def point(self, index):
+        """
+        Returns a point as a metric payload dictionary.
+
+        :param index: Position of the point in the series.
+        :type index: int
+        :rtype: dict
+        """
+        index += self.start
+        return {'name': self.name, 'timestamp': self.timestamps[index], 'value': self.values[index], 'tags': self.tags}
+
+    def json_size(self):
+        """
+        Estimates the size of the series serialized in the grouped Kairosdb
+        format, never below the actual size.
+
+        All points are counted as big as the biggest one, so this is cheap
+        to compute and proportional to the number of points.
+
+        :return: Size in bytes of the series without points and of a point.
+        :rtype: tuple
+        """
+        # the standard library escapes non ascii characters, which no other serializer makes longer
+        header = len(dumps_json([self.name, self.tags])) + SERIES_JSON_OVERHEAD
+        if not len(self):
+            return header, 0
+        timestamps = self.timestamps[self.start:]
+        point = max(len(str(min(timestamps))), len(str(max(timestamps)))) + POINT_JSON_OVERHEAD
+        values = self.values[self.start:]
+        if self.type == HISTOGRAM:
+            point += max(len(dumps_json(value.payload())) for value in values)
+        elif self.values.typecode == 'd':
+            point += DOUBLE_JSON_SIZE
+        else:
+            point += max(len(str(min(values))), len(str(max(values))))
+        return header, point
+
+    def payload(self):
+        """
+        Returns the series in the grouped Kairosdb format.
+
+        :rtype: dict
+        """
+        self.compact()
+        if self.type == HISTOGRAM:
+            return {
+                'name': self.name,
+                'type': HISTOGRAM,
+                'tags': self.tags,
+                'datapoints': [[timestamp, value.payload()] for timestamp, value in zip(self.timestamps, self.values)],
+            }
+        return {
+            'name': self.name,
+            'tags': self.tags,
+            'datapoints': [[timestamp, value] for timestamp, value in zip(self.timestamps, self.values)],
+        }
+
+
+class Batch(object):
+    """
+    Points drained from a buffer, grouped by series.
+    """
+
+    def __init__(self, series=(), order=None):
+        """
+        :param series: The series in the batch.
+        :type series: list
+        :param order: The series of each point in arrival order, if tracked.
+        :type order: collections.deque
+        """
+        self.series = [s for s in series if len(s)]
+        self.order = order
+
+    def __len__(self):
+        return sum(len(series) for series in self.series)
+
+    def __bool__(self):
+        return bool(self.series)
+
+    __nonzero__ = __bool__
+
+    def __iter__(self):
+        return iter(self.points())
+
+    def points(self):
+        """
+        Returns the points as metric payload dictionaries, in arrival order if
+        it was tracked and by series otherwise.
+
+        :rtype: list
+        """
+        if self.order is None:
+            return [series.point(index) for series in self.series for index in range(len(series))]
+        cursors = collections.defaultdict(int)
+        points = []
+        for series in self.order:
+            points.append(series.point(cursors[series.key]))
+            cursors[series.key] += 1
+        return points
+
+    def extend(self, batch):
+        """
+        Adds the points of another batch after the points of this batch.
+
+        :type batch: Batch
+        :return: None
+        :rtype: None
+        """
+        if self.order is not None:
+            # the points of this batch keep their series, which still hold them at the same positions
+            self.order.extend(batch.order if batch.order is not None else
+                              [series for series in batch.series for _ in range(len(series))])
+        positions = {series.key: index for index, series in enumerate(self.series)}
+        for series in batch.series:
+            index = positions.get(series.key)
+            if index is None:
+                positions[series.key] = len(self.series)
+                self.series.append(series)
+            else:
+                series.prepend(self.series[index])
+                self.series[index] = series
+
+    def split(self, max_points=None, max_bytes=None):
+        """
+        Splits the batch in batches of up to ``max_points`` points and
+        ``max_bytes`` bytes once serialized (as estimated by
+        :meth:`Series.json_size`), keeping the points of each series in order.
+
+        A point bigger than ``max_bytes`` on its own is still a batch.
+
+        :param max_points: Maximum points per batch, None for no limit.
+        :type max_points: int
+        :param max_bytes: Maximum serialized size per batch, None for no limit.
+        :type max_bytes: int
+        :rtype: generator
+        """
+        chunk, points, size = [], 0, 2
+        for series in self.series:
+            header, point = series.json_size() if max_bytes else (0, 0)
+            start = 0
+            while start < len(series):
+                room = len(series) - start
+                if max_points:
+                    room = min(room, max_points - points)
+                if max_bytes:
+                    room = min(room, (max_bytes - size - header) // point)
+                if room <= 0:
+                    if chunk:
+                        yield Batch(chunk)
+                        chunk, points, size = [], 0, 2
+                        continue
+                    room = 1
+                chunk.append(series.slice(start, start + room))
+                points += room
+                size += header + room * point
+                start += room
+        if chunk:
+            yield Batch(chunk)
+
+    def payload(self):
+        """
+        Returns the batch in the grouped Kairosdb format, one entry per series.
+
+        :rtype: list
+        """
+        return [series.payload() for series in self.series]
+
+
+class MetricBuffer(object):
+    """
+    Thread safe buffer holding deferred metrics until they are written.
+
+    Points are stored in compact per series columns, so buffered metrics cost
+    a few dozen bytes each instead of a dictionary per point.
+
+    The buffer can be bounded by number of points and/or approximate size in
+    bytes. What happens when it is full is defined by the ``overflow`` policy:
+
+    * ``drop_oldest``: the oldest points are discarded to make room.
+    * ``drop_newest``: the new point is discarded.
+    * ``block``: the caller waits for room, up to ``block_timeout`` seconds,
+      and the new point is discarded if there is still no room.
+    * ``spill``: the oldest points are handed to the ``spill`` function, as a
+      list of metric payload dictionaries.
+    """
+
+    def __init__(self, max_points=None, max_bytes=None, overflow=DROP_OLDEST, spill=None, block_timeout=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Invalid overflow policy {}. Use one of {}'.format(
+                overflow, ', '.join(OVERFLOW_POLICIES)))
+        if overflow == SPILL and spill is None:
+            raise ValueError('The spill overflow policy requires a spill function')
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.spill = spill
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self.spilled = 0
+        # the arrival order of points is only needed by bounded buffers, to evict the oldest ones
+        self._ordered = max_points is not None or max_bytes is not None
+        self._point_size = ORDERED_POINT_SIZE if self._ordered else POINT_SIZE
+        self._lock = threading.Lock()
+        self._not_full = threading.Condition(self._lock)
+        self._reset()
+
+    def _reset(self):
+        self._series = {}
+        self._order = collections.deque() if self._ordered else None
+        self._count = 0
+        self._bytes = 0
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        with self._lock:
+            points = Batch(self._series.values(), self._order).points()
+        return iter(points)
+
+    @property
+    def size(self):
+        """
+        Approximate memory used by the buffered points in bytes.
+        """
+        return self._bytes
+
+    def _fits(self, size):
+        if self.max_points is not None and self._count + 1 > self.max_points:
+            return False
+        if self.max_bytes is not None and self._bytes + size > self.max_bytes:
+            return False
+        return True
+
+    def _over_capacity(self):
+        if self.max_points is not None and self._count > self.max_points:
+            return True
+        if self.max_bytes is not None and self._bytes > self.max_bytes:
+            return True
+        return False
+
+    def _evict(self, newest=False):
+        series = self._order.pop() if newest else self._order.popleft()
+        timestamp, value = series.pop() if newest else series.popleft()
+        self._count -= 1
+        self._bytes -= self._point_size
+        if not len(series):
+            del self._series[series.key]
+            self._bytes -= series_overhead(series.name, series.tags)
+        return {'name': series.name, 'timestamp': timestamp, 'value': value, 'tags': series.tags}
+
+    def _shrink(self, newest=False):
+        """
+        Evicts points until the buffer is within its bounds.
+
+        :return: The points to spill.
+        :rtype: list
+        """
+        spilled = []
+        while self._over_capacity() and self._count > 1:
+            point = self._evict(newest)
+            if self.overflow == SPILL:
+                spilled.append(point)
+            else:
+                self.dropped += 1
+        return spilled
+
+    def append(self, metric_name, tags, timestamp, value, key=None):
+        """
+        Adds a point to the buffer, applying the overflow policy if the buffer
+        is full.
+
+        :param metric_name: The name of the metric.
+        :type metric_name: str
+        :param tags: Tags of the metric.
+        :type tags: dict
+        :param timestamp: The timestamp in milliseconds.
+        :type timestamp: int
+        :param value: The value of the metric.
+        :type value: int, float or metricz.values.HistogramValue
+        :param key: The :func:`series_key` of the metric name and tags, if
+                    already known.
+        :type key: tuple
+        :return: The number of buffered points after the append.
+        :rtype: int
+        """
+        if key is None:
+            key = series_key(metric_name, tags)
+        data_type = None
+        if isinstance(value, HistogramValue):
+            data_type = HISTOGRAM
+            key += (HISTOGRAM,)
+        return self._append(key, data_type, metric_name, tags, timestamp, value)
+
+    def _append(self, key, data_type, metric_name, tags, timestamp, value):
+        with self._lock:
+            series = self._series.get(key)
+            if self._ordered:
+                size = self._point_size if series is not None else self._point_size + series_overhead(metric_name, tags)
+                if not self._fits(size):
+                    if self.overflow == DROP_NEWEST:
+                        self.dropped += 1
+                        return self._count
+                    elif self.overflow == BLOCK:
+                        self._not_full.wait_for(lambda: self._fits(size), self.block_timeout)
+                        if not self._fits(size):
+                            self.dropped += 1
+                            return self._count
+                        # the buffer was drained while waiting
+                        series = self._series.get(key)
+
+            if series is None:
+                series = Series(key, metric_name, dict(tags), data_type)
+                # not to keep an empty series if the point is invalid
+                series.append(timestamp, value)
+                self._series[key] = series
+                self._bytes += series_overhead(metric_name, tags)
+            else:
+                series.append(timestamp, value)
+            self._count += 1
+            self._bytes += self._point_size
+            if not self._ordered:
+                return self._count
+
+            self._order.append(series)
+            spilled = self._shrink()
+            count = self._count
+
+        if spilled:
+            self._spill(spilled)
+        return count
+
+    def drain(self):
+        """
+        Removes and returns all buffered points.
+
+        :rtype: Batch
+        """
+        with self._lock:
+            batch = Batch(self._series.values(), self._order)
+            self._reset()
+            self._not_full.notify_all()
+        return batch
+
+    def requeue(self, batch):
+        """
+        Puts points that could not be written back at the front of the buffer.
+
+        If the buffer cannot hold them all the oldest points are dropped (or
+        spilled), except with the ``drop_newest`` policy which keeps the oldest.
+
+        :param batch: Points previously returned by :meth:`drain`.
+        :type batch: Batch
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            merged = {}
+            for series in batch.series:
+                current = self._series.get(series.key)
+                if current is None:
+                    current = self._series[series.key] = series
+                    self._bytes += series_overhead(series.name, series.tags)
+                else:
+                    current.prepend(series)
+                merged[series.key] = current
+                self._count += len(series)
+                self._bytes += self._point_size * len(series)
+            if self._ordered:
+                if batch.order is None:
+                    order = [merged[series.key] for series in batch.series for _ in range(len(series))]
+                else:
+                    order = [merged[series.key] for series in batch.order]
+                self._order.extendleft(reversed(order))
+
+            spilled = self._shrink(newest=self.overflow == DROP_NEWEST)
+
+        if spilled:
+            self._spill(spilled)
+
+    def _spill(self, points):
+        self.spilled += len(points)
+        self.spill(points)
+
+
+class ShardedBuffer(object):
+    """
+    Thread safe buffer made of ``shards`` independent :class:`MetricBuffer`
+    shards, each with its own lock.
+
+    Series are assigned to shards by the hash of their metric name and tags,
+    so threads deferring different series rarely wait for each other. All the
+    points of a series are in the same shard, which keeps them in order.
+
+    Bounds are split evenly between the shards and the overflow policy is
+    applied per shard, so when the buffer is full the points evicted are the
+    oldest (or newest) of their shard rather than of the whole buffer.
+    """
+
+    def __init__(self, shards=SHARDS, max_points=None, max_bytes=None, overflow=DROP_OLDEST, spill=None,
+                 block_timeout=None):
+        if shards < 1:
+            raise ValueError('A sharded buffer needs at least one shard')
+        self.max_points = max_points
+        self.max_bytes = max_bytes
+        self.overflow = overflow
+        self.spill = spill
+        self.block_timeout = block_timeout
+        # counting the appends is much cheaper than adding up the shards' lengths on every append
+        self._appended = itertools.count(1)
+        self._drained = 0
+        self.shards = [MetricBuffer(self._share(max_points, shards), self._share(max_bytes, shards), overflow, spill,
+                                    block_timeout) for _ in range(shards)]
+
+    @staticmethod
+    def _share(bound, shards):
+        if bound is None:
+            return None
+        return max(1, -(-bound // shards))
+
+    def __len__(self):
+        return sum(map(len, self.shards))
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.shards)
+
+    @property
+    def size(self):
+        """
+        Approximate memory used by the buffered points in bytes.
+        """
+        return sum(shard.size for shard in self.shards)
+
+    @property
+    def dropped(self):
+        return sum(shard.dropped for shard in self.shards)
+
+    @property
+    def spilled(self):
+        return sum(shard.spilled for shard in self.shards)
+
+    def _index(self, key):
+        return hash(key) % len(self.shards)
+
+    def append(self, metric_name, tags, timestamp, value, key=None):
+        """
+        Adds a point to the shard of its series (see :meth:`MetricBuffer.append`).
+
+        :return: The number of points appended since the last drain, which
+                 is the number of buffered points unless some were dropped
+                 or requeued.
+        :rtype: int
+        """
+        if key is None:
+            key = series_key(metric_name, tags)
+        data_type = None
+        if isinstance(value, HistogramValue):
+            data_type = HISTOGRAM
+            key += (HISTOGRAM,)
+        self.shards[self._index(key)]._append(key, data_type, metric_name, tags, timestamp, value)
+        return next(self._appended) - self._drained
+
+    def drain(self):
+        """
+        Removes and returns all buffered points, merging the shards.
+
+        :rtype: Batch
+        """
+        self._drained = next(self._appended)
+        series, order = [], None
+        for shard in self.shards:
+            batch = shard.drain()
+            series.extend(batch.series)
+            if batch.order is not None:
+                if order is None:
+                    order = collections.deque()
+                order.extend(batch.order)
+        return Batch(series, order)
+
+    def requeue(self, batch):
+        """
+        Puts points that could not be written back at the front of their
+        shards (see :meth:`MetricBuffer.requeue`).
+
+        :param batch: Points previously returned by :meth:`drain`.
+        :type batch: Batch
+        :return: None
+        :rtype: None
+        """
+        shards = [[] for _ in self.shards]
+        for series in batch.series:
+            shards[self._index(series.key)].append(series)
+        orders = None
+        if batch.order is not None:
+            orders = [collections.deque() for _ in self.shards]
+            for series in batch.order:
+                orders[self._index(series.key)].append(series)
+        for index, shard in enumerate(self.shards):
+            if shards[index]:
+                shard.requeue(Batch(shards[index], orders[index] if orders is not None else None))
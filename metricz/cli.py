@@ -2,11 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import click
+import json
+import os
+import signal
 import socket
-import requests
-from clickclick import AliasedGroup, fatal_error
+import sys
+import time
+from clickclick import AliasedGroup, fatal_error, info, warning
 from environmental import Str
-from metricz import MetricWriter, OAUTH2_ACCESS_TOKEN_URL, CREDENTIALS_DIR
+from metricz import OAUTH2_ACCESS_TOKEN_URL, CREDENTIALS_DIR
+from metricz.protocol import decode, decode_any, decode_json, LINE, JSON
+from metricz.registry import SeriesRegistry
+from metricz.relay import Relay, RelayClient, RELAY_SOCKET
+from metricz.retry import RetryPolicy, CircuitOpenError
+from metricz.values import HistogramValue
+
+# The HTTP stack (requests, tokens and metricz.metricz) is imported by the commands that
+# write to Kairosdb, so that --help and writes through the relay start fast.
 
 main = AliasedGroup(context_settings=dict(help_option_names=['-h', '--help']))
 
@@ -14,6 +26,75 @@ main = AliasedGroup(context_settings=dict(help_option_names=['-h', '--help']))
 class Configuration:
     token_url = Str('OAUTH2_ACCESS_TOKEN_URL', OAUTH2_ACCESS_TOKEN_URL)
     credentials_dir = Str('CREDENTIALS_DIR', CREDENTIALS_DIR)
+    relay_socket = Str('METRICZ_RELAY', RELAY_SOCKET)
+
+
+class MetricValue(click.ParamType):
+    """
+    Metric value: an integer, a float or a JSON histogram
+    (e.g. '{"bins": {"1.0": 3}, "min": 1, "max": 1, "sum": 3}').
+    """
+    name = 'value'
+
+    def convert(self, value, param, ctx):
+        if not isinstance(value, str):
+            return value
+        for number_type in (int, float):
+            try:
+                return number_type(value)
+            except ValueError:
+                pass
+        try:
+            return HistogramValue.from_payload(json.loads(value))
+        except ValueError:
+            self.fail('{} is not a number or a JSON histogram'.format(value), param, ctx)
+
+
+class Address(click.ParamType):
+    """
+    Network address as host:port or port (listening on localhost).
+    """
+    name = 'address'
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, tuple):
+            return value
+        host, _, port = value.rpartition(':')
+        try:
+            return host or 'localhost', int(port)
+        except ValueError:
+            self.fail('{} is not a valid address, use host:port or port'.format(value), param, ctx)
+
+
+DECODERS = {'auto': decode_any, LINE: decode, JSON: decode_json}
+
+
+def read_lines(files):
+    """
+    Yields the lines of the files, one at a time.
+
+    :return: Generator of (file name, line number, line) tuples.
+    """
+    for input_file in files:
+        for number, line in enumerate(input_file, 1):
+            yield input_file.name, number, line
+
+
+def parse_metrics(lines, decoder, errors):
+    """
+    Decodes lines, skipping blank ones and reporting the invalid ones.
+
+    :param errors: Function called with the file name, line number and
+                   error of each invalid line.
+    :return: Generator of (metric name, tags, timestamp, value) tuples.
+    """
+    for file_name, number, line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield decoder(line)
+        except ValueError as e:
+            errors(file_name, number, e)
 
 
 def parse_tags(ctx, param, value):
@@ -28,24 +109,150 @@ def parse_tags(ctx, param, value):
     return tags
 
 
+def is_valid(metric_name, tags):
+    try:
+        SeriesRegistry().intern(metric_name, tags)
+    except ValueError:
+        return False
+    return True
+
+
 @main.command()
 @click.argument('metric_name')
-@click.argument('value', type=int)
+@click.argument('value', type=MetricValue())
 @click.argument('tags', nargs=-1, callback=parse_tags)
-def write(metric_name: str, value: int, tags: dict):
+@click.option('--relay/--no-relay', default=True,
+              help='Send the metric to the local relay, if one is running (default: yes).')
+def write(metric_name: str, value, tags: dict, relay: bool):
     config = Configuration()
+    # default tag the hostname
+    tags['hostname'] = socket.gethostname()
+    # the relay would only log and drop an invalid metric, the writer reports why it is invalid
+    if relay and os.path.exists(config.relay_socket) and is_valid(metric_name, tags):
+        with RelayClient(config.relay_socket) as client:
+            client.defer_metric(metric_name, value, tags)
+        if not client.dropped:
+            return
+    import requests
+    from metricz.metricz import MetricWriter
     metric_writer = MetricWriter(
         config.token_url,
         config.credentials_dir,
         fail_silently=False
     )
-    # default tag the hostname
-    tags['hostname'] = socket.gethostname()
     try:
         metric_writer.write_metric(metric_name, value, tags)
+    except ValueError as e:
+        fatal_error(str(e))
     except requests.ConnectionError as e:
         reason = e.args[0].reason   # type: requests.packages.urllib3.exceptions.NewConnectionError
         _, pretty_reason = str(reason).split(':', 1)
         fatal_error(pretty_reason)
     except requests.HTTPError as e:
         fatal_error('HTTP {0} {1}'.format(e.response.status_code, e.response.text))
+
+
+@main.command('relay')
+@click.option('--socket', 'socket_path', help='Unix socket to listen on (default: $METRICZ_RELAY or {}).'.format(
+    RELAY_SOCKET))
+@click.option('--no-socket', is_flag=True, help='Do not listen on a Unix socket.')
+@click.option('--udp', type=Address(), help='Address to receive metrics on over UDP, as host:port or port.')
+@click.option('--tcp', type=Address(), help='Address to receive metrics on over TCP, as host:port or port.')
+@click.option('--flush-interval', type=float, default=10, show_default=True,
+              help='Seconds between writes to Kairosdb.')
+@click.option('--flush-size', type=int, default=10000, show_default=True,
+              help='Number of received metrics that triggers a write.')
+def relay_command(socket_path, no_socket, udp, tcp, flush_interval, flush_size):
+    """
+    Receive metrics from local programs and write them to Kairosdb in batches.
+
+    Metrics are received one per line, as "put <name> <timestamp in ms> <value> <tag>=<value> ...".
+    """
+    from metricz.metricz import MetricWriter
+    config = Configuration()
+    if no_socket:
+        socket_path = None
+    elif socket_path is None:
+        socket_path = config.relay_socket
+    metric_writer = MetricWriter(
+        config.token_url,
+        config.credentials_dir,
+        flush_interval=flush_interval,
+        flush_size=flush_size,
+    )
+    try:
+        relay = Relay(metric_writer, socket_path, udp, tcp)
+    except OSError as e:
+        fatal_error('Cannot listen: {}'.format(e))
+    # stop cleanly, writing what was received, when terminated
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    info('Relaying metrics received on {}'.format(', '.join(map(str, relay.addresses))))
+    relay.start()
+    try:
+        while relay.is_alive():
+            relay.join(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.stop()
+        metric_writer.close()
+
+
+@main.command('import')
+@click.argument('files', nargs=-1, type=click.File('r'))
+@click.option('--format', 'input_format', type=click.Choice(sorted(DECODERS)), default='auto', show_default=True,
+              help='Input format, "auto" detects it on every line.')
+@click.option('--batch-size', type=int, default=50000, show_default=True,
+              help='Number of metrics written per batch.')
+@click.option('--workers', type=int, default=1, show_default=True,
+              help='Number of concurrent requests writing each batch.')
+def import_command(files, input_format, batch_size, workers):
+    """
+    Write the metrics read from files (or stdin), one per line.
+
+    Lines are either in the relay format, "put <name> <timestamp in ms> <value> <tag>=<value> ...", or JSON
+    objects like {"name": "some.metric", "timestamp": 1000, "value": 1, "tags": {"some": "tag"}}.
+    """
+    import requests
+    from metricz.metricz import MetricWriter
+    from metricz.sender import ConcurrentSender
+    config = Configuration()
+    metric_writer = MetricWriter(
+        config.token_url,
+        config.credentials_dir,
+        fail_silently=False,
+        retry=RetryPolicy(),
+        sender=ConcurrentSender(workers, batch_size // workers + 1) if workers > 1 else None,
+    )
+    invalid = 0
+
+    def report(file_name, number, error):
+        nonlocal invalid
+        invalid += 1
+        warning('{}:{}: {}'.format(file_name, number, error), err=True)
+
+    metrics = parse_metrics(read_lines(files or [click.open_file('-')]), DECODERS[input_format], report)
+    imported = deferred = 0
+    start = time.time()
+    try:
+        for metric_name, tags, timestamp, value in metrics:
+            try:
+                metric_writer.defer_metric(metric_name, value, tags, timestamp)
+            except ValueError as e:
+                invalid += 1
+                warning(str(e), err=True)
+                continue
+            deferred += 1
+            if deferred >= batch_size:
+                metric_writer.write_deferred()
+                imported += deferred
+                deferred = 0
+        metric_writer.close()
+        imported += deferred
+    except (requests.RequestException, CircuitOpenError) as e:
+        fatal_error('Failed to write metrics after importing {}: {}'.format(imported, e))
+    elapsed = time.time() - start
+    info('Imported {} metrics in {:.1f}s ({:.0f} metrics/s), {} invalid lines'.format(
+        imported, elapsed, imported / elapsed if elapsed else 0, invalid))
+    if invalid:
+        sys.exit(1)
@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+
+# Kept apart from metricz.metricz, which imports the HTTP stack, so they can be
+# used (e.g. by the CLI) without importing it.
+CREDENTIALS_DIR = '/meta/credentials'
+OAUTH2_ACCESS_TOKEN_URL = 'https://token.auth.example.com'
+
+KAIROSDB_URL = 'https://kairosdb.example.com'
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Flusher(threading.Thread):
+    """
+    Daemon thread that periodically calls a flush function.
+
+    The flush runs every ``interval`` seconds and whenever :meth:`wake` is
+    called, e.g. because the buffer reached its size trigger.
+    """
+
+    def __init__(self, flush, interval=None):
+        """
+        :param flush: Function to call on every flush.
+        :type flush: callable
+        :param interval: Seconds between flushes. (Default: only flush when
+                         woken up)
+        :type interval: float
+        """
+        super(Flusher, self).__init__(name='metricz-flusher')
+        self.daemon = True
+        self.interval = interval
+        self._flush = flush
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            try:
+                self._flush()
+            except Exception:
+                logger.exception('Failed to flush deferred metrics')
+
+    def wake(self):
+        """
+        Triggers a flush without waiting for the interval to elapse.
+        """
+        self._wakeup.set()
+
+    def stop(self, timeout=None):
+        """
+        Stops the thread, waiting for an in-progress flush to finish.
+
+        :param timeout: Maximum seconds to wait for the thread.
+        :type timeout: float
+        """
+        self._stopped.set()
+        self._wakeup.set()
+        if self.is_alive():
+            self.join(timeout)
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# What happens to new series of a metric name over the cardinality limit
+REJECT = 'reject'
+COLLAPSE = 'collapse'
+
+CARDINALITY_POLICIES = (REJECT, COLLAPSE)
+
+# Default maximum number of series per metric name
+MAX_SERIES_PER_METRIC = 1000
+
+# Value replacing the values of a collapsed tag
+COLLAPSED_VALUE = 'other'
+
+
+class CardinalityError(ValueError):
+    """
+    Raised for the new series of a metric name over the cardinality limit
+    when they are rejected.
+    """
+
+
+class MetricCardinality(object):
+    """
+    Distinct series and tag values of a metric name, each kept up to the
+    limit, so the memory used is bounded.
+    """
+
+    __slots__ = ('series', 'values', 'full')
+
+    def __init__(self):
+        self.series = set()
+        self.values = {}
+        self.full = False
+
+
+class CardinalityGuard(object):
+    """
+    Protects Kairosdb from series explosions, e.g. request ids in tags, and
+    from series written too often.
+
+    Up to ``max_series`` distinct tag sets are accepted per metric name. The
+    new series of a metric name over the limit are:
+
+    * ``reject``: dropped.
+    * ``collapse``: written with the values of the tag with most distinct
+      values replaced by ``other``, so ``request_id=0c5f...`` is written as
+      ``request_id=other``.
+
+    The series and tag values are counted exactly up to the limit, in sets
+    capped at ``max_series`` entries per metric name and tag name.
+
+    With ``max_rate`` each series may write up to ``max_rate`` points per
+    second on average, in bursts of up to ``burst`` points (default: one
+    second worth of points, at least one). Points over the rate are dropped.
+
+    ``rejected_points`` (points of rejected series), ``collapsed_series`` and
+    ``rate_limited_points`` count what was dropped or changed. Rejected series
+    are not remembered, to bound memory, so their points are all counted.
+    """
+
+    def __init__(self, max_series=MAX_SERIES_PER_METRIC, policy=REJECT, max_rate=None, burst=None):
+        """
+        :param max_series: Maximum distinct series per metric name, None for
+                           no limit.
+        :type max_series: int
+        :param policy: ``reject`` or ``collapse``.
+        :type policy: str
+        :param max_rate: Maximum points per second per series, None for no
+                         limit.
+        :type max_rate: float
+        :param burst: Maximum points written at once by a series.
+        :type burst: float
+        """
+        if policy not in CARDINALITY_POLICIES:
+            raise ValueError('Invalid cardinality policy {}. Use one of {}'.format(
+                policy, ', '.join(CARDINALITY_POLICIES)))
+        self.max_series = max_series
+        self.policy = policy
+        self.max_rate = max_rate
+        self.burst = burst if burst is not None else max(max_rate or 0, 1)
+        self.rejected_points = 0
+        self.collapsed_series = 0
+        self.rate_limited_points = 0
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def admit(self, metric_name, tags):
+        """
+        Checks a series seen for the first time (or again after being
+        forgotten by the series registry).
+
+        :param metric_name: The name of the metric.
+        :type metric_name: str
+        :param tags: Tags of the metric.
+        :type tags: dict
+        :return: The tags to write the series with.
+        :rtype: dict
+        :raises CardinalityError: If the series is rejected.
+        """
+        if self.max_series is None:
+            return tags
+        tag_set = frozenset(tags.items())
+        with self._lock:
+            metric = self._metrics.get(metric_name)
+            if metric is None:
+                metric = self._metrics[metric_name] = MetricCardinality()
+            if tag_set in metric.series:
+                return tags
+            if len(metric.series) < self.max_series:
+                metric.series.add(tag_set)
+                for tag_name, tag_value in tags.items():
+                    values = metric.values.setdefault(tag_name, set())
+                    if len(values) < self.max_series:
+                        values.add(tag_value)
+                return tags
+
+            if not metric.full:
+                metric.full = True
+                logger.warning('Metric %s reached %d series, new series are %s', metric_name, self.max_series,
+                               'rejected' if self.policy == REJECT else 'collapsed')
+            if self.policy == REJECT or not tags:
+                self.rejected_points += 1
+                raise CardinalityError('Metric {} has more than {} series, rejecting {!r}'.format(
+                    metric_name, self.max_series, tags))
+            self.collapsed_series += 1
+            # the tag with most distinct values is the one making new series
+            collapsed = max(tags, key=lambda tag_name: len(metric.values.get(tag_name, ())))
+        return dict(tags, **{collapsed: COLLAPSED_VALUE})
+
+    def allow(self, series):
+        """
+        Takes a point from the rate limit of a series.
+
+        The token bucket is not locked: concurrent points of the same series
+        may be counted approximately.
+
+        :type series: metricz.registry.RegisteredSeries
+        :return: Whether the point can be written.
+        :rtype: bool
+        """
+        if self.max_rate is None:
+            return True
+        now = time.monotonic()
+        if series.refilled is None:
+            tokens = self.burst
+        else:
+            tokens = min(self.burst, series.tokens + (now - series.refilled) * self.max_rate)
+        series.refilled = now
+        if tokens < 1:
+            series.tokens = tokens
+            self.rate_limited_points += 1
+            return False
+        series.tokens = tokens - 1
+        return True
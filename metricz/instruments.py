@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+
+from .values import HistogramValue
+
+# Percentiles reported by histograms and timers
+PERCENTILES = (50, 90, 99)
+
+# Samples kept per histogram and interval, more samples are reservoir sampled
+MAX_SAMPLES = 1024
+
+
+def percentile(samples, percent):
+    """
+    Nearest-rank percentile of sorted samples.
+
+    :param samples: Sorted samples, at least one.
+    :type samples: list
+    :param percent: The percentile, between 0 and 100.
+    :type percent: float
+    """
+    return samples[max(0, int(round(percent / 100.0 * len(samples))) - 1)]
+
+
+class Instrument(object):
+    """
+    Base class of metrics aggregated in-process between writes.
+    """
+
+    def __init__(self, name, tags):
+        self.name = name
+        self.tags = dict(tags)
+        self._lock = threading.Lock()
+
+    def collect(self):
+        """
+        Returns the aggregated points since the last collection and resets the
+        instrument.
+
+        :return: List of (metric name, value) tuples.
+        :rtype: list
+        """
+        raise NotImplementedError
+
+
+class Counter(Instrument):
+    """
+    Counts events, writing the total of each interval (if not zero).
+    """
+
+    def __init__(self, name, tags):
+        super(Counter, self).__init__(name, tags)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def collect(self):
+        with self._lock:
+            value, self.value = self.value, 0
+        return [(self.name, value)] if value else []
+
+
+class Gauge(Instrument):
+    """
+    Holds the current value of something, written on every interval once set.
+    """
+
+    def __init__(self, name, tags):
+        super(Gauge, self).__init__(name, tags)
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def collect(self):
+        value = self.value
+        return [(self.name, value)] if value is not None else []
+
+
+class Histogram(Instrument):
+    """
+    Summarizes the distribution of values recorded in each interval.
+
+    The summary is written as ``<name>.count``, ``<name>.min``, ``<name>.max``,
+    ``<name>.mean`` and ``<name>.p<percentile>`` for each of the
+    ``percentiles``. Percentiles are calculated from at most ``max_samples``
+    values per interval.
+
+    With ``native`` the whole distribution is written as a single Kairosdb
+    histogram datapoint instead (see :class:`metricz.values.HistogramValue`).
+    """
+
+    def __init__(self, name, tags, percentiles=PERCENTILES, max_samples=MAX_SAMPLES, native=False):
+        super(Histogram, self).__init__(name, tags)
+        self.percentiles = percentiles
+        self.max_samples = max_samples
+        self.native = native
+        self._reset()
+
+    def _reset(self):
+        self.distribution = HistogramValue() if self.native else None
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.samples = []
+
+    def record(self, value):
+        with self._lock:
+            if self.native:
+                self.distribution.add(value)
+                return
+            self.count += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+            if len(self.samples) < self.max_samples:
+                self.samples.append(value)
+            else:
+                index = random.randrange(self.count)
+                if index < self.max_samples:
+                    self.samples[index] = value
+
+    def collect(self):
+        with self._lock:
+            count, total, minimum, maximum, samples = self.count, self.total, self.min, self.max, self.samples
+            distribution = self.distribution
+            self._reset()
+        if self.native:
+            return [(self.name, distribution)] if distribution.count else []
+        if not count:
+            return []
+
+        samples.sort()
+        points = [
+            (self.name + '.count', count),
+            (self.name + '.min', minimum),
+            (self.name + '.max', maximum),
+            (self.name + '.mean', total / count),
+        ]
+        for percent in self.percentiles:
+            points.append(('{}.p{}'.format(self.name, percent), percentile(samples, percent)))
+        return points
+
+
+class Timer(Histogram):
+    """
+    Histogram of durations in milliseconds.
+
+    Use it as a context manager to time a block of code::
+
+        with writer.timer('some.operation', {'some': 'tag'}):
+            ...
+    """
+
+    def __init__(self, name, tags, percentiles=PERCENTILES, max_samples=MAX_SAMPLES, native=False):
+        super(Timer, self).__init__(name, tags, percentiles, max_samples, native)
+        self._starts = threading.local()
+
+    def __enter__(self):
+        starts = getattr(self._starts, 'stack', None)
+        if starts is None:
+            starts = self._starts.stack = []
+        starts.append(time.time())
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        start = self._starts.stack.pop()
+        self.record((time.time() - start) * 1000)
+
+
+class InstrumentRegistry(object):
+    """
+    Keeps one instrument per type, metric name and tags.
+    """
+
+    def __init__(self):
+        self._instruments = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._instruments)
+
+    def get(self, instrument_class, name, tags, **kwargs):
+        """
+        Returns the instrument for the name and tags, creating it if needed.
+
+        :param instrument_class: The instrument type.
+        :type instrument_class: type
+        :param name: The metric name.
+        :type name: str
+        :param tags: The metric tags.
+        :type tags: dict
+        :rtype: Instrument
+        """
+        key = (instrument_class, name, frozenset(tags.items()))
+        instrument = self._instruments.get(key)
+        if instrument is None:
+            with self._lock:
+                instrument = self._instruments.get(key)
+                if instrument is None:
+                    instrument = self._instruments[key] = instrument_class(name, tags, **kwargs)
+        return instrument
+
+    def collect(self):
+        """
+        Collects the aggregated points of all instruments.
+
+        :return: List of (metric name, value, tags) tuples.
+        :rtype: list
+        """
+        with self._lock:
+            instruments = list(self._instruments.values())
+        points = []
+        for instrument in instruments:
+            for name, value in instrument.collect():
+                points.append((name, value, instrument.tags))
+        return points
@@ -3,20 +3,43 @@
 from __future__ import print_function
 
 import datetime
+import gzip
 import json
+import logging
 import pprint
 import os
+import socket
+import time
+import weakref
 
 import requests
 import tokens
 
-CREDENTIALS_DIR = '/meta/credentials'
-OAUTH2_ACCESS_TOKEN_URL = 'https://token.auth.example.com'
+from .backends import point_batch
+from .buffer import Batch, MetricBuffer, ShardedBuffer, BLOCK, BLOCK_TIMEOUT, DROP_OLDEST
+from .defaults import CREDENTIALS_DIR, OAUTH2_ACCESS_TOKEN_URL, KAIROSDB_URL
+from .flusher import Flusher
+from .guard import CardinalityError
+from .instruments import Counter, Gauge, Histogram, InstrumentRegistry, Timer
+from .registry import MAX_SERIES, SeriesHandle, SeriesRegistry
+from .auth import TokenRefresher, TokenUnavailableError
+from .retry import CircuitOpenError
+from .sender import send_chunks
+from .serialization import GZIP_HEADERS, GZIP_LEVEL, STREAM_THRESHOLD, StreamingPayload, get_serializer
+from .stats import SELF_PREFIX, Tracer, WriterStats
+from .timestamps import EPOCH, time_ns, timestamp_millis  # noqa
+from .values import HISTOGRAM, HistogramValue, normalize_value
+
 TOKEN_RENEWAL_PERIOD = datetime.timedelta(hours=1)
 
-KAIROSDB_URL = 'https://kairosdb.example.com'
+# Limits of the requests writing deferred metrics. 1 MiB is the default body size limit of nginx.
+MAX_REQUEST_POINTS = 20000
+MAX_REQUEST_BYTES = 1024 * 1024
+
+logger = logging.getLogger(__name__)
 
-EPOCH = datetime.datetime.utcfromtimestamp(0)
+# Errors raised instead of writing, the metrics are kept when failing silently
+UNAVAILABLE_ERRORS = (CircuitOpenError, TokenUnavailableError)
 
 
 def handle_request_errors(response):
@@ -32,13 +55,360 @@ def handle_request_errors(response):
             error = pprint.pformat(response.json())
         except json.JSONDecodeError:
             error = response.content
-        print("Response: \n", error)
+        logger.error('Kairosdb error response:\n%s', error)
         raise
 
 
-class MetricWriter(object):
+def compress_payload(data, threshold=None):
+    """
+    Gzips a serialized payload if it is at least ``threshold`` bytes long.
+
+    :param data: The serialized payload.
+    :type data: str or bytes
+    :param threshold: Minimum size to compress, None to never compress.
+    :type threshold: int
+    :return: The request body and the extra request headers, if any.
+    :rtype: tuple
+    """
+    if threshold is None or len(data) < threshold:
+        return data, None
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+    return gzip.compress(data, GZIP_LEVEL), GZIP_HEADERS
+
+
+class BaseMetricWriter(object):
+    """
+    Payload construction, buffer accounting and instruments shared by the
+    metric writers.
+
+    Instruments (counters, gauges, histograms and timers) aggregate values
+    in-process and are written as deferred metrics on every deferred write.
+
+    Metric names and tags are interned by a
+    :class:`metricz.registry.SeriesRegistry`, which validates them once per
+    series. Invalid metrics raise a ValueError, or are counted in
+    ``invalid_metrics`` and dropped when failing silently.
+
+    With a ``guard`` (a :class:`metricz.guard.CardinalityGuard`) the series
+    per metric name and the points per series are limited. Rejected series
+    raise a :class:`metricz.guard.CardinalityError` unless failing silently,
+    points over the rate are dropped. Both are counted by the guard.
+
+    :meth:`stats` describes what the writer did. With ``self_metrics`` the
+    writer also writes its stats as metrics named ``metricz.<stat>``, a
+    prefix reserved for them, tagged with the hostname.
+    """
+
+    invalid_metrics = 0
+
+    def series(self, metric_name, tags):
+        """
+        Returns a handle deferring points of the metric name and tags, for
+        hot paths: its ``record(value, timestamp=None)`` skips the lookup
+        of the name and tags.
+
+        :rtype: metricz.registry.SeriesHandle
+        :raises ValueError: If the name or a tag is invalid.
+        """
+        return SeriesHandle(self, self.series_registry.intern(metric_name, tags))
+
+    def counter(self, metric_name, tags):
+        """
+        Returns the counter for the metric name and tags.
+
+        :rtype: metricz.instruments.Counter
+        """
+        return self.instruments.get(Counter, metric_name, tags)
+
+    def gauge(self, metric_name, tags):
+        """
+        Returns the gauge for the metric name and tags.
+
+        :rtype: metricz.instruments.Gauge
+        """
+        return self.instruments.get(Gauge, metric_name, tags)
+
+    def histogram(self, metric_name, tags, **kwargs):
+        """
+        Returns the histogram for the metric name and tags.
+
+        :rtype: metricz.instruments.Histogram
+        """
+        return self.instruments.get(Histogram, metric_name, tags, **kwargs)
+
+    def timer(self, metric_name, tags, **kwargs):
+        """
+        Returns the timer for the metric name and tags.
+
+        :rtype: metricz.instruments.Timer
+        """
+        return self.instruments.get(Timer, metric_name, tags, **kwargs)
+
+    def stats(self):
+        """
+        Returns the writer's stats: counters and distributions since it was
+        created, and the current state of its buffer, e.g.::
+
+            {'requests': 12, 'http.204': 12, 'buffer.depth': 120,
+             'flush.latency': {'count': 12, 'min': 8.1, 'max': 23.4,
+                               'mean': 11.2, 'p50': 9.8, 'p90': 17.0, 'p99': 23.4},
+             ...}
+
+        Distributions are in milliseconds (``*.latency``), points or bytes,
+        their percentiles are calculated over the most recent values.
+
+        :rtype: dict
+        """
+        stats = self._stats.snapshot()
+        stats.update(self._gauges())
+        return stats
+
+    def _gauges(self):
+        """
+        Returns the stats describing the current state of the writer.
+
+        :rtype: dict
+        """
+        gauges = {
+            'buffer.depth': len(self.deferred_metrics),
+            'buffer.dropped': self.dropped_metrics,
+            'buffer.spilled': self.spilled_metrics,
+            'invalid': self.invalid_metrics,
+        }
+        if self.guard is not None:
+            gauges.update({
+                'guard.rejected': self.guard.rejected_points,
+                'guard.collapsed': self.guard.collapsed_series,
+                'guard.rate_limited': self.guard.rate_limited_points,
+            })
+        return gauges
+
+    def _set_gauges(self):
+        """
+        Sets the self-metric gauges to the current state of the writer.
+        """
+        if self._stats.instruments is not None:
+            for name, value in self._gauges().items():
+                self.instruments.get(Gauge, SELF_PREFIX + name, self._stats.tags).set(value)
+
+    def _collect_instruments(self, batch):
+        """
+        Adds the points aggregated by the instruments since the last call to
+        a batch drained from the deferred metrics buffer.
+
+        They are not added to the buffer: with the block overflow policy they
+        would wait for the room only a write makes.
+
+        :type batch: metricz.buffer.Batch
+        :return: None
+        :rtype: None
+        """
+        if not self.instruments:
+            return
+        collected = MetricBuffer()
+        timestamp = time_ns() // 1000000
+        for metric_name, value, tags in self.instruments.collect():
+            series = self._intern(metric_name, tags)
+            if series is not None and (self.guard is None or self.guard.allow(series)):
+                self._buffer(collected, series, value, timestamp)
+        batch.extend(collected.drain())
+
+    @property
+    def dropped_metrics(self):
+        """
+        Number of deferred metrics discarded because the buffer was full.
+        """
+        return self.deferred_metrics.dropped
+
+    @property
+    def spilled_metrics(self):
+        """
+        Number of deferred metrics handed to the spill function.
+        """
+        return self.deferred_metrics.spilled
+
+    def _intern(self, metric_name, tags):
+        """
+        Returns the registered series of a metric name and tags, or None if
+        they are invalid and the writer fails silently.
+
+        :rtype: metricz.registry.RegisteredSeries
+        """
+        try:
+            return self.series_registry.intern(metric_name, tags)
+        except ValueError as e:
+            self._invalid(metric_name, tags, e)
+            return None
+
+    def _invalid(self, metric_name, tags, error):
+        """
+        Handles an invalid metric: raises the error, or counts and logs the
+        metric when failing silently.
+        """
+        if not self.fail_silently:
+            raise error
+        # rejected series are counted by the guard, and not logged not to flood the logs
+        if not isinstance(error, CardinalityError):
+            self.invalid_metrics += 1
+            logger.warning('Dropping invalid metric %s %r', metric_name, tags)
+
+    def _defer(self, series, value, timestamp=None):
+        """
+        Adds a point of a registered series to the deferred metrics buffer.
+
+        :type series: metricz.registry.RegisteredSeries
+        :return: The number of deferred metrics, 0 if the point was dropped
+                 by the guard.
+        :rtype: int
+        """
+        if self.guard is not None and not self.guard.allow(series):
+            return 0
+        return self._buffer(self.deferred_metrics, series, value, timestamp)
+
+    def _buffer(self, buffer, series, value, timestamp=None):
+        """
+        Adds a point of a registered series to a buffer, without the guard's
+        checks.
+
+        :type buffer: metricz.buffer.MetricBuffer
+        :type series: metricz.registry.RegisteredSeries
+        :return: The number of points in the buffer, 0 if the point is invalid.
+        :rtype: int
+        """
+        if timestamp is None:
+            timestamp = time_ns() // 1000000
+        elif not isinstance(timestamp, int):
+            timestamp = self._timestamp_millis(timestamp)
+        try:
+            return buffer.append(series.name, series.tags, timestamp, normalize_value(value), series.key)
+        except ValueError as e:
+            self._invalid(series.name, series.tags, e)
+            return 0
+
+    def _record(self, series, value, timestamp=None):
+        """
+        Defers a point of a registered series, as :meth:`defer_metric` does.
+
+        :type series: metricz.registry.RegisteredSeries
+        """
+        raise NotImplementedError
+
+    def _construct_payload(self, metric_name, value, tags, timestamp=None):
+        """
+        Constructs a metric payload.
+
+        :param metric_name: The name of the metric.
+        :type metric_name: str
+        :param value: The value of the metric.
+        :type value: int, float or metricz.values.HistogramValue
+        :param tags: Tags to add to the metric.
+        :type tags: dict
+        :param timestamp: The time to register the metric, as milliseconds
+                          since the epoch, seconds since the epoch or a
+                          datetime (IN UTC!). (Default: now)
+        :type timestamp: int, float or datetime.datetime
+        :return: A payload dictionary.
+        :rtype: dict
+        """
+        value = normalize_value(value)
+        payload = {
+            'name': metric_name,
+            'timestamp': self._timestamp_millis(timestamp),
+            'value': value,
+            'tags': tags,
+        }
+        if isinstance(value, HistogramValue):
+            payload['type'] = HISTOGRAM
+            payload['value'] = value.payload()
+
+        return payload
+
+    @classmethod
+    def _timestamp_millis(cls, timestamp=None):
+        """
+        Converts a timestamp to milliseconds since the epoch.
+
+        :param timestamp: The timestamp as milliseconds since the epoch (int),
+                          seconds since the epoch (float) or a datetime in
+                          UTC. (Default: now)
+        :type timestamp: int, float or datetime.datetime
+        :return: The timestamp in millis.
+        :rtype: int
+        """
+        if timestamp is None:
+            return time_ns() // 1000000
+        return timestamp_millis(timestamp)
+
+
+class MetricWriter(BaseMetricWriter):
     """
     Interface class to write metrics to the Bus kairosdb.
+
+    Deferred metrics can be written by a background thread by setting
+    ``flush_interval`` (seconds between writes) and/or ``flush_size`` (number
+    of deferred metrics that triggers a write). Call :meth:`close` or use the
+    writer as a context manager to stop the thread and write what is left.
+
+    The deferred metrics buffer is unbounded by default. ``max_buffer_points``
+    and ``max_buffer_bytes`` limit it and ``overflow`` selects what happens
+    when it is full (see :class:`metricz.buffer.MetricBuffer`). The ``block``
+    policy waits up to ``block_timeout`` seconds for the flusher to make room,
+    so it requires ``flush_interval`` or ``flush_size``. When many
+    threads defer metrics, ``buffer_shards`` splits the buffer in that many
+    independently locked shards (see :class:`metricz.buffer.ShardedBuffer`).
+
+    The last ``max_series`` metric names and tags used are kept validated
+    and interned. ``validate_names=False`` skips the check of the characters
+    Kairosdb allows, for servers accepting more.
+
+    The oauth2 token is fetched and renewed ahead of expiry by a background
+    thread (see :class:`metricz.auth.TokenRefresher`), so neither the
+    constructor nor writes wait for the token endpoint. Until the first token
+    is fetched :meth:`write_metric` waits for it up to its timeout. Deferred
+    writes are refused when failing silently, keeping the metrics, otherwise
+    they wait too. :class:`metricz.auth.TokenUnavailableError` is raised if
+    there is still no token (or the metric kept when failing silently).
+
+    Failed writes are retried according to ``retry`` (a
+    :class:`metricz.retry.RetryPolicy`, default: no retries). With a
+    ``circuit_breaker`` (a :class:`metricz.retry.CircuitBreaker`) writes are
+    refused while Kairosdb is failing: :class:`metricz.retry.CircuitOpenError`
+    is raised, or, if failing silently, the metrics are kept in the deferred
+    metrics buffer.
+
+    Payloads of at least ``compress_threshold`` bytes are sent gzipped (use 0
+    to always compress).
+
+    Payloads are serialized by ``serializer``: the name of a JSON library
+    (``orjson``, ``ujson`` or ``json``) or a function returning JSON bytes,
+    by default the fastest library installed. Batches of at least
+    ``stream_threshold`` points are encoded while they are sent, with
+    chunked transfer encoding, so the serialized batch is never in memory
+    (see :class:`metricz.serialization.StreamingPayload`). They are gzipped
+    whenever ``compress_threshold`` is set. Use None to never stream.
+
+    With a ``spool`` (a :class:`metricz.spool.DiskSpool`) deferred metrics
+    that fail to be written are saved to disk instead of kept in memory, and
+    replayed after the next successful write. It is also used as the spill
+    function of the ``spill`` overflow policy.
+
+    Metrics written to Kairosdb are also written to the ``backends`` (see
+    :mod:`metricz.backends`), e.g. to dual-write while migrating. Each batch
+    is encoded once per backend. Kairosdb decides which metrics are kept:
+    failed writes to the other backends are only logged and counted, and
+    metrics replayed from the spool are only written to Kairosdb.
+
+    Deferred metrics are written in requests of up to ``max_request_points``
+    points and ``max_request_bytes`` bytes of (uncompressed) JSON, so a
+    backlog built during an outage is written in requests that fit the
+    server's limits and timeouts. Only the requests that fail are kept:
+    after a failure the remaining requests are not sent and kept too. Use
+    None to not limit requests.
+
+    With a ``sender`` (a :class:`metricz.sender.ConcurrentSender`) deferred
+    metrics are written in chunks of up to ``chunk_points`` points and
+    ``max_request_bytes`` bytes over several concurrent connections.
     """
     def __init__(self,
                  url=os.environ.get('OAUTH2_ACCESS_TOKEN_URL', OAUTH2_ACCESS_TOKEN_URL),
@@ -46,34 +416,151 @@ class MetricWriter(object):
                  kairosdb_url=os.environ.get('KAIROSDB_URL', KAIROSDB_URL),
                  token_name='uid',
                  fail_silently=True,
-                 timeout=4):
+                 timeout=4,
+                 flush_interval=None,
+                 flush_size=None,
+                 max_buffer_points=None,
+                 max_buffer_bytes=None,
+                 overflow=DROP_OLDEST,
+                 spill=None,
+                 block_timeout=BLOCK_TIMEOUT,
+                 retry=None,
+                 circuit_breaker=None,
+                 compress_threshold=None,
+                 spool=None,
+                 sender=None,
+                 buffer_shards=None,
+                 backends=None,
+                 serializer=None,
+                 stream_threshold=STREAM_THRESHOLD,
+                 max_request_points=MAX_REQUEST_POINTS,
+                 max_request_bytes=MAX_REQUEST_BYTES,
+                 max_series=MAX_SERIES,
+                 validate_names=True,
+                 guard=None,
+                 self_metrics=False,
+                 tracer=None):
+        if overflow == BLOCK and not (flush_interval or flush_size):
+            # nothing would ever make room in the buffer
+            raise ValueError('The block overflow policy requires a flush_interval or flush_size')
         tokens.configure(url=url, dir=directory)
         tokens.manage('uid', ['uid'])
         tokens.start()
         self.token_name = token_name
-        self.token_ts = None
         self.fail_silently = fail_silently
         self.requests = requests.session()
+        if sender:
+            # one keep-alive connection per concurrent request
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=sender.workers)
+            self.requests.mount('http://', adapter)
+            self.requests.mount('https://', adapter)
+        self.sender = sender
+        self.backends = list(backends or ())
         self.timeout = timeout
-        self._renew_token(token_name)
-        self.deferred_metrics = []
+        self.instruments = InstrumentRegistry()
+        self._stats = WriterStats(self.instruments if self_metrics else None, tags={'hostname': socket.gethostname()})
+        self.tracer = tracer or Tracer()
+        # tokens are fetched in the background, not to block the constructor nor writes
+        self.token_refresher = TokenRefresher(self._fetch_token)
+        self.token_refresher.start()
+        # writers that are never closed do not leave their thread behind
+        weakref.finalize(self, self.token_refresher.stop)
+        if spool is not None and spill is None:
+            spill = spool.spill
+        if buffer_shards:
+            self.deferred_metrics = ShardedBuffer(buffer_shards, max_buffer_points, max_buffer_bytes, overflow, spill,
+                                                  block_timeout)
+        else:
+            self.deferred_metrics = MetricBuffer(max_buffer_points, max_buffer_bytes, overflow, spill, block_timeout)
+        self.guard = guard
+        self.series_registry = SeriesRegistry(max_series, validate_names, guard)
+        self.spool = spool
         self.kairosdb_url = kairosdb_url
+        self.retry = retry
+        self.circuit_breaker = circuit_breaker
+        self.compress_threshold = compress_threshold
+        self.serializer = serializer if callable(serializer) else get_serializer(serializer)
+        self.stream_threshold = stream_threshold
+        self.max_request_points = max_request_points
+        self.max_request_bytes = max_request_bytes
+        self.flush_size = flush_size
+        self.flusher = None
+        if flush_interval or flush_size:
+            self.flusher = Flusher(self.write_deferred, flush_interval)
+            self.flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-    def _renew_token(self, token_name='uid'):
+    def close(self, timeout=None):
         """
-        Renews the oauth2 token if it's older than the renewal period.
+        Stops the background flusher, if any, and writes the remaining
+        deferred metrics.
 
-        :param token_name: token_name to get the token for.
+        :param timeout: Timeout for the final write.
+        :type timeout: float
         :return: None
         :rtype: None
         """
-        now = datetime.datetime.utcnow()
-        if not self.token_ts or (now - TOKEN_RENEWAL_PERIOD) > self.token_ts:
-            token = tokens.get(token_name)
-            self.token_ts = now
-            self.requests.headers.update({
-                'Authorization': 'Bearer {}'.format(token)
-            })
+        if self.flusher:
+            self.flusher.stop()
+            self.flusher = None
+        try:
+            self.write_deferred(timeout)
+        finally:
+            self.token_refresher.stop()
+            for backend in self.backends:
+                backend.close()
+            if self.sender:
+                self.sender.close()
+            if self.spool is not None:
+                self.spool.close()
+
+    def _fetch_token(self):
+        """
+        Gets the oauth2 token, fetching a new one if it is about to expire,
+        and sets it in the session headers. Called by the token refresher.
+
+        The headers are replaced rather than updated, so concurrent requests
+        see either the old or the new token.
+
+        :return: None
+        :rtype: None
+        """
+        start = time.perf_counter()
+        try:
+            with self.tracer.span('metricz.token', {'token': self.token_name}):
+                token = tokens.get(self.token_name)
+        except Exception:
+            self._stats.count('token.errors')
+            raise
+        finally:
+            self._stats.observe('token.latency', (time.perf_counter() - start) * 1000)
+        self._stats.count('token.renewals')
+        headers = requests.structures.CaseInsensitiveDict(self.requests.headers)
+        headers['Authorization'] = 'Bearer {}'.format(token)
+        self.requests.headers = headers
+
+    def _renew_token(self, timeout=None, wait=False):
+        """
+        Makes sure the session has a token before writing.
+
+        Tokens are renewed in the background. Until the first one is fetched,
+        writes wait for it up to ``timeout`` seconds if ``wait`` is set or
+        not failing silently, and are refused otherwise (the flusher's writes,
+        which must not stall, and the metrics kept).
+
+        :raises TokenUnavailableError: If there is no token.
+        :return: None
+        :rtype: None
+        """
+        if self.token_refresher.ready:
+            return
+        if self.fail_silently and not wait or not self.token_refresher.wait(timeout or self.timeout):
+            raise TokenUnavailableError('No token to write to {} yet'.format(self.kairosdb_url))
 
     def write_metric(self, metric_name, value, tags, timestamp=None, timeout=None):
         """
@@ -82,21 +569,39 @@ class MetricWriter(object):
         :param metric_name: The name of the metric.
         :type metric_name: str
         :param value: The value of the metric.
-        :type value: int
+        :type value: int, float or metricz.values.HistogramValue
         :param tags: Tags to add to the metric.
         :type tags: dict
-        :param timestamp: The time (IN UTC!) to register the metric. (Default:
-                          now)
-        :type timestamp: datetime.datetime
+        :param timestamp: The time to register the metric, as milliseconds
+                          since the epoch, seconds since the epoch or a
+                          datetime (IN UTC!). (Default: now)
+        :type timestamp: int, float or datetime.datetime
         :return: None
         :rtype: None
         """
-        self._renew_token(self.token_name)
-        payload = self._construct_payload(metric_name, value, tags, timestamp)
-        response = self.requests.post(self.kairosdb_url, data=json.dumps(payload), timeout=timeout or self.timeout)
+        series = self._intern(metric_name, tags)
+        if series is None or self.guard is not None and not self.guard.allow(series):
+            return
+        try:
+            payload = self._construct_payload(metric_name, value, series.tags, timestamp)
+        except ValueError as e:
+            self._invalid(metric_name, series.tags, e)
+            return
+        try:
+            response = self._post(self.serializer(payload), timeout, wait_token=True)
+        except UNAVAILABLE_ERRORS:
+            if not self.fail_silently:
+                raise
+            # the guard already allowed the point
+            self._buffer(self.deferred_metrics, series, value, timestamp)
+            return
 
         if not self.fail_silently:
             handle_request_errors(response)
+        if 300 > response.status_code > 199:
+            self._stats.count('points.written')
+        if self.backends and 300 > response.status_code > 199:
+            self._fan_out(point_batch(metric_name, series.tags, payload['timestamp'], normalize_value(value)), timeout)
 
     def defer_metric(self, metric_name, value, tags, timestamp=None):
         """
@@ -105,71 +610,235 @@ class MetricWriter(object):
         :param metric_name: The name of the metric.
         :type metric_name: str
         :param value: The value of the metric.
-        :type value: int
+        :type value: int, float or metricz.values.HistogramValue
         :param tags: Tags to add to the metric.
         :type tags: dict
-        :param timestamp: The time to register the metric. (Default: now)
-        :type timestamp: datetime.datetime
+        :param timestamp: The time to register the metric, as milliseconds
+                          since the epoch, seconds since the epoch or a
+                          datetime (IN UTC!). (Default: now)
+        :type timestamp: int, float or datetime.datetime
         :return: None
         :rtype: None
         """
-        payload = self._construct_payload(metric_name, value, tags, timestamp)
-        self.deferred_metrics.append(payload)
+        # the hot path, calls are inlined
+        try:
+            series = self.series_registry.intern(metric_name, tags)
+        except ValueError as e:
+            self._invalid(metric_name, tags, e)
+            return
+        size = self._defer(series, value, timestamp)
+        if self.flusher and self.flush_size and size >= self.flush_size:
+            self.flusher.wake()
+
+    def _record(self, series, value, timestamp=None):
+        size = self._defer(series, value, timestamp)
+        if self.flusher and self.flush_size and size >= self.flush_size:
+            self.flusher.wake()
 
     def write_deferred(self, timeout=None):
         """
-        Writes all deferred metrics to kairosdb.
+        Writes all deferred metrics to kairosdb, grouping the datapoints of
+        each series.
+
+        Metrics that fail to be written are kept to be written on the next call,
+        in the spool if the writer has one. Spooled metrics are replayed once
+        the deferred metrics are written.
 
         :return: None
         :rtype: None
         """
-        if self.deferred_metrics:
-            self._renew_token(self.token_name)
-            response = self.requests.post(
-                self.kairosdb_url,
-                data=json.dumps(self.deferred_metrics),
-                timeout=timeout or self.timeout
-            )
+        start = time.perf_counter()
+        with self.tracer.span('metricz.write_deferred', {}) as span:
+            self._set_gauges()
+            batch = self.deferred_metrics.drain()
+            self._collect_instruments(batch)
+            span.set_attribute('points', len(batch))
+            try:
+                self._write_deferred(batch, timeout)
+            finally:
+                # empty writes, e.g. of an idle flusher, would only skew the latency
+                if batch:
+                    self._stats.count('flushes')
+                    self._stats.observe('flush.latency', (time.perf_counter() - start) * 1000)
 
-            if 300 > response.status_code > 199:
-                self.deferred_metrics = []
+    def _write_deferred(self, batch, timeout=None):
+        if batch:
+            if self.sender:
+                results = self.sender.send(batch, lambda chunk: self._write_batch(chunk, timeout),
+                                           self.max_request_bytes)
+            else:
+                results = send_chunks(batch.split(self.max_request_points, self.max_request_bytes),
+                                      lambda chunk: self._write_batch(chunk, timeout))
 
-            if not self.fail_silently:
-                handle_request_errors(response)
+            failures = [(chunk, error) for chunk, error in results if error is not None]
+            self._keep([chunk for chunk, _ in failures])
+            if self.backends:
+                # the other backends get what was written to Kairosdb, so kept metrics are not written twice
+                self._fan_out(Batch([series for chunk, error in results if error is None for series in chunk.series]),
+                              timeout)
+            if failures:
+                error = failures[0][1]
+                if isinstance(error, UNAVAILABLE_ERRORS):
+                    if not self.fail_silently:
+                        raise error
+                elif isinstance(error, Exception):
+                    raise error
+                elif not self.fail_silently:
+                    handle_request_errors(error)
+                return
 
-    def _construct_payload(self, metric_name, value, tags, timestamp=None):
+        if self.spool is not None and len(self.spool):
+            self.spool.replay(lambda data: self._replay(data, timeout), self.max_request_points,
+                              self.max_request_bytes)
+
+    def _write_batch(self, batch, timeout=None):
         """
-        Constructs a metric payload.
+        Writes a batch of deferred metrics.
 
-        :param metric_name: The name of the metric.
-        :type metric_name: str
-        :param value: The value of the metric.
-        :type value: int
-        :param tags: Tags to add to the metric.
-        :type tags: dict
-        :param timestamp: The time to register the metric. (Default: now)
-        :type timestamp: datetime.datetime
-        :return: A payload dictionary.
-        :rtype: dict
+        :type batch: metricz.buffer.Batch
+        :return: None if the batch was written, otherwise the exception raised
+                 or the error response.
+        :rtype: None, Exception or requests.Response
         """
-        ts = timestamp if timestamp else datetime.datetime.utcnow()
-        payload = {
-            'name': metric_name,
-            'timestamp': self._datetime_to_millis(ts),
-            'value': int(value),
-            'tags': tags,
-        }
+        if self.stream_threshold is not None and len(batch) >= self.stream_threshold:
+            data = StreamingPayload(batch, self.serializer, compress=self.compress_threshold is not None)
+        else:
+            data = self.serializer(batch.payload())
+        try:
+            response = self._post(data, timeout)
+        except Exception as e:
+            return e
+        finally:
+            self._stats.observe('batch.points', len(batch))
+            self._stats.observe('batch.bytes', data.size if isinstance(data, StreamingPayload) else len(data))
+        if not 300 > response.status_code > 199:
+            return response
+        self._stats.count('points.written', len(batch))
+        return None
 
-        return payload
+    def _fan_out(self, batch, timeout=None):
+        """
+        Writes a batch to the other backends. Failures are logged and counted
+        by each backend, the metrics are not kept for them.
 
-    @staticmethod
-    def _datetime_to_millis(dt):
+        :type batch: metricz.buffer.Batch
         """
-        Converts a datetime object to timestamp in milliseconds.
+        if not batch:
+            return
+        for backend in self.backends:
+            try:
+                backend.write(batch, timeout or self.timeout)
+            except Exception:
+                backend.failures += 1
+                logger.exception('Failed to write %d metrics to %s', len(batch), backend.__class__.__name__)
 
-        :param dt: The datetime object.
-        :type dt: datetime.datetime
-        :return: The timestamp in millis.
-        :rtype: int
+    def _keep(self, chunks):
+        """
+        Keeps metrics that could not be written, in the spool or the buffer.
+
+        :param chunks: The batches that were not written, in order.
+        :type chunks: list
+        """
+        if self.spool is not None:
+            for chunk in chunks:
+                self.spool.append(chunk.payload())
+        else:
+            # each batch is put back in front of the buffer, so the last one goes first
+            for chunk in reversed(chunks):
+                self.deferred_metrics.requeue(chunk)
+
+    def _replay(self, data, timeout=None):
+        """
+        Writes a batch of spooled metrics.
+
+        :return: If the metrics were written.
+        :rtype: bool
+        """
+        try:
+            response = self._post(data, timeout)
+        except UNAVAILABLE_ERRORS + (requests.RequestException,):
+            return False
+        return 300 > response.status_code > 199
+
+    def _post(self, data, timeout=None, wait_token=False):
+        """
+        Posts data to kairosdb, retrying and tracking failures according to
+        the writer's retry policy and circuit breaker.
+
+        :param data: The serialized payload.
+        :type data: bytes, str or metricz.serialization.StreamingPayload
+        :param wait_token: Whether to wait for the first token even when
+                           failing silently.
+        :type wait_token: bool
+        :return: The last response.
+        :rtype: requests.Response
+        """
+        self._renew_token(timeout, wait_token)
+        breaker = self.circuit_breaker
+        if breaker and not breaker.allow():
+            raise CircuitOpenError('Circuit breaker open, not writing to {}'.format(self.kairosdb_url))
+
+        if isinstance(data, StreamingPayload):
+            headers = data.headers
+        else:
+            data, headers = compress_payload(data, self.compress_threshold)
+        request = {'data': data, 'timeout': timeout or self.timeout}
+        if headers:
+            request['headers'] = headers
+
+        retries = self.retry.retries if self.retry else 0
+        attempt = 0
+        while True:
+            try:
+                response = self._send(request, attempt)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt < retries:
+                    time.sleep(self.retry.delay(attempt))
+                    attempt += 1
+                    self._stats.count('retries')
+                    continue
+                if breaker:
+                    breaker.record_failure()
+                raise
+            except Exception:
+                # e.g. an invalid response or an error encoding a streamed payload
+                if breaker:
+                    breaker.record_failure()
+                raise
+
+            if attempt < retries and self.retry.should_retry(response.status_code):
+                time.sleep(self.retry.delay(attempt))
+                attempt += 1
+                self._stats.count('retries')
+                continue
+
+            if breaker:
+                if response.status_code >= 500 or response.status_code == 429:
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+            return response
+
+    def _send(self, request, attempt):
+        """
+        Makes one request to kairosdb, counted in the writer's stats.
+
+        :param request: Keyword arguments of the request.
+        :type request: dict
+        :param attempt: Number of the previous attempts of the request.
+        :type attempt: int
+        :rtype: requests.Response
         """
-        return int((dt - EPOCH).total_seconds() * 1000)
+        self._stats.count('requests')
+        start = time.perf_counter()
+        with self.tracer.span('metricz.request', {'http.url': self.kairosdb_url, 'attempt': attempt}) as span:
+            try:
+                response = self.requests.post(self.kairosdb_url, **request)
+            except Exception:
+                self._stats.count('errors')
+                raise
+            finally:
+                self._stats.observe('request.latency', (time.perf_counter() - start) * 1000)
+            span.set_attribute('http.status_code', response.status_code)
+        self._stats.count('http.{}'.format(response.status_code))
+        return response
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import json
+import re
+
+from .values import HistogramValue
+
+# Lines are in the telnet format understood by Kairosdb and OpenTSDB:
+#     put <metric name> <timestamp in milliseconds> <value> <tag>=<value> ...
+# Histogram values are written as their Kairosdb representation in compact JSON.
+COMMAND = 'put'
+
+# Fields are separated by whitespace, and tag names from their values by "="
+FIELD = re.compile(r'\S+')
+TAG_NAME = re.compile(r'[^\s=]+')
+
+# Line formats
+LINE = 'line'
+JSON = 'json'
+
+
+def encode(metric_name, tags, timestamp, value):
+    """
+    Encodes a metric as a protocol line, without the line terminator.
+
+    :param metric_name: The name of the metric.
+    :type metric_name: str
+    :param tags: Tags of the metric.
+    :type tags: dict
+    :param timestamp: The timestamp in milliseconds.
+    :type timestamp: int
+    :param value: The value of the metric.
+    :type value: int, float or metricz.values.HistogramValue
+    :rtype: str
+    :raises ValueError: If the name or a tag is empty or contains whitespace,
+                        or a tag name contains "=".
+    """
+    if not isinstance(metric_name, str) or not FIELD.fullmatch(metric_name):
+        raise ValueError('Invalid metric name {!r}: it must not be empty nor contain whitespace'.format(metric_name))
+    if isinstance(value, HistogramValue):
+        value = json.dumps(value.payload(), separators=(',', ':'))
+    elif isinstance(value, float):
+        value = repr(value)
+    # %-formatting is noticeably faster than str.format on this hot path
+    line = '%s %s %d %s' % (COMMAND, metric_name, timestamp, value)
+    for tag_name, tag_value in tags.items():
+        tag = ' %s=%s' % (tag_name, tag_value)
+        if not TAG_NAME.fullmatch(str(tag_name)) or not FIELD.fullmatch(str(tag_value)):
+            raise ValueError('Invalid tag {!r} of metric {!r}: names and values must not be empty nor contain '
+                             'whitespace, and names "="'.format(tag[1:], metric_name))
+        line += tag
+    return line
+
+
+def decode_value(value):
+    """
+    Decodes a metric value written by :func:`encode`.
+
+    :type value: str
+    :rtype: int, float or metricz.values.HistogramValue
+    """
+    if value.startswith('{'):
+        return HistogramValue.from_payload(json.loads(value))
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def decode(line):
+    """
+    Decodes a protocol line.
+
+    :param line: The line, with or without its terminator.
+    :type line: str
+    :return: The metric name, tags, timestamp and value.
+    :rtype: tuple
+    :raises ValueError: If the line is not a valid metric.
+    """
+    parts = line.split()
+    if len(parts) < 4 or parts[0] != COMMAND:
+        raise ValueError('Invalid metric line {!r}'.format(line))
+    tags = {}
+    for tag in parts[4:]:
+        tag_name, separator, tag_value = tag.partition('=')
+        if not separator or not tag_name:
+            raise ValueError('Invalid tag {!r} in metric line {!r}'.format(tag, line))
+        tags[tag_name] = tag_value
+    try:
+        return parts[1], tags, int(parts[2]), decode_value(parts[3])
+    except ValueError as e:
+        raise ValueError('Invalid metric line {!r}: {}'.format(line, e))
+
+
+def decode_json(line):
+    """
+    Decodes a metric in the single datapoint JSON format of Kairosdb's
+    ``/api/v1/datapoints`` endpoint::
+
+        {"name": "some.metric", "timestamp": 1000, "value": 1, "tags": {"some": "tag"}}
+
+    The timestamp is optional and histogram values are their Kairosdb
+    representation.
+
+    :param line: The JSON object.
+    :type line: str
+    :return: The metric name, tags, timestamp (or None) and value.
+    :rtype: tuple
+    :raises ValueError: If the line is not a valid metric.
+    """
+    try:
+        payload = json.loads(line)
+        metric_name, value, tags = payload['name'], payload['value'], payload.get('tags', {})
+        timestamp = payload.get('timestamp')
+        if timestamp is not None:
+            timestamp = int(timestamp)
+        if isinstance(value, dict):
+            value = HistogramValue.from_payload(value)
+        elif not isinstance(value, (int, float)) or isinstance(value, bool):
+            raise ValueError('{!r} is not a number'.format(value))
+        if not isinstance(metric_name, str) or not isinstance(tags, dict):
+            raise ValueError('name must be a string and tags an object')
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError('Invalid metric {!r}: {}'.format(line, e))
+    return metric_name, tags, timestamp, value
+
+
+def decode_any(line):
+    """
+    Decodes a metric in either format: JSON objects start with ``{``.
+
+    :rtype: tuple
+    :raises ValueError: If the line is not a valid metric.
+    """
+    if line.lstrip().startswith('{'):
+        return decode_json(line)
+    return decode(line)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import itertools
+import re
+import threading
+import weakref
+
+from .buffer import series_key
+
+# Series kept by a registry, the least recently used ones are forgotten first
+MAX_SERIES = 10000
+
+# Characters Kairosdb allows in metric names and tag names and values
+VALID_NAME = re.compile(r'[A-Za-z0-9_./-]+')
+
+
+class RegisteredSeries(object):
+    """
+    A metric name and tags, validated and interned by a
+    :class:`SeriesRegistry`.
+
+    ``tokens`` and ``refilled`` are the rate limit state of the series (see
+    :meth:`metricz.guard.CardinalityGuard.allow`).
+    """
+
+    __slots__ = ('id', 'key', 'name', 'tags', 'tokens', 'refilled', '__weakref__')
+
+    def __init__(self, series_id, key, name, tags):
+        self.id = series_id
+        self.key = key
+        self.name = name
+        self.tags = tags
+        self.tokens = 0
+        self.refilled = None
+
+
+class SeriesRegistry(object):
+    """
+    Interns series: (metric name, tags) pairs get a small stable id, their
+    own copy of the tags, with names and values as strings, and are
+    validated once instead of on every point.
+
+    Up to ``max_series`` series are kept, the least recently used ones are
+    forgotten (and validated again if they come back).
+
+    New series are also checked by the ``guard``, if any (see
+    :class:`metricz.guard.CardinalityGuard`).
+    """
+
+    def __init__(self, max_series=MAX_SERIES, validate=True, guard=None):
+        """
+        :param max_series: Maximum number of series kept.
+        :type max_series: int
+        :param validate: Whether to check names against the characters
+                         Kairosdb allows.
+        :type validate: bool
+        :param guard: Cardinality guard of new series.
+        :type guard: metricz.guard.CardinalityGuard
+        """
+        self.max_series = max_series
+        self.validate = validate
+        self.guard = guard
+        self._series = collections.OrderedDict()
+        # series by series key, while in use, so tags in any order get the same id
+        self._registered = weakref.WeakValueDictionary()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._series)
+
+    def intern(self, metric_name, tags):
+        """
+        Returns the registered series of a metric name and tags.
+
+        :param metric_name: The name of the metric.
+        :type metric_name: str
+        :param tags: Tags of the metric.
+        :type tags: dict
+        :rtype: RegisteredSeries
+        :raises ValueError: If the name or a tag is invalid.
+        :raises metricz.guard.CardinalityError: If the guard rejects the series.
+        """
+        # cheaper than the series key, tags in another order are looked up again. With their types, as equal
+        # values of different types, e.g. True, 1 and 1.0, are different tags
+        items = tuple(tags.items())
+        key = (metric_name, items, tuple(map(type, itertools.chain.from_iterable(items))))
+        try:
+            series = self._series.get(key)
+        except TypeError:
+            raise ValueError('Invalid metric {!r} {!r}: the name and tags must be hashable'.format(metric_name, tags))
+        if series is not None:
+            try:
+                self._series.move_to_end(key)
+            except KeyError:
+                # forgotten by another thread meanwhile, it is still valid
+                pass
+            return series
+        series = self._register(metric_name, tags)
+        with self._lock:
+            # another thread may have registered the same series meanwhile
+            series = self._registered.setdefault(series.key, series)
+            self._series[key] = series
+            while len(self._series) > self.max_series:
+                self._series.popitem(last=False)
+        return series
+
+    def _register(self, metric_name, tags):
+        tags = {str(tag_name): str(tag_value) for tag_name, tag_value in tags.items()}
+        if self.validate:
+            for name in itertools.chain([metric_name], tags, tags.values()):
+                if not isinstance(name, str) or not VALID_NAME.fullmatch(name):
+                    raise ValueError('Invalid name or tag {!r} of metric {!r}: only letters, digits and ".", "/", '
+                                     '"-" and "_" are allowed'.format(name, metric_name))
+        if self.guard is not None:
+            tags = self.guard.admit(metric_name, tags)
+        # the key of the normalized tags, which is also the key of the buffered series
+        return RegisteredSeries(next(self._ids), series_key(metric_name, tags), metric_name, tags)
+
+
+class SeriesHandle(object):
+    """
+    A series of a writer, to defer its points without looking up its name
+    and tags. Returned by the writers' ``series`` method.
+    """
+
+    __slots__ = ('writer', 'series')
+
+    def __init__(self, writer, series):
+        """
+        :type writer: metricz.metricz.BaseMetricWriter
+        :type series: RegisteredSeries
+        """
+        self.writer = writer
+        self.series = series
+
+    @property
+    def name(self):
+        return self.series.name
+
+    @property
+    def tags(self):
+        return self.series.tags
+
+    def record(self, value, timestamp=None):
+        """
+        Defers a point of the series, like the writer's ``defer_metric``.
+
+        :param value: The value of the metric.
+        :type value: int, float or metricz.values.HistogramValue
+        :param timestamp: The time to register the metric, as milliseconds
+                          since the epoch, seconds since the epoch or a
+                          datetime (IN UTC!). (Default: now)
+        :type timestamp: int, float or datetime.datetime
+        :return: None
+        :rtype: None
+        """
+        self.writer._record(self.series, value, timestamp)
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+import errno
+import logging
+import os
+import selectors
+import socket
+import stat
+import threading
+import time
+
+from .protocol import encode, decode
+from .timestamps import timestamp_millis
+from .values import normalize_value
+
+logger = logging.getLogger(__name__)
+
+RELAY_SOCKET = '/tmp/metricz.sock'
+
+# Biggest datagram read by the relay, bigger than what clients send
+MAX_DATAGRAM = 65536
+# Receive buffer requested for the relay socket, to absorb bursts (the kernel may cap it)
+RECEIVE_BUFFER = 4 * 1024 * 1024
+
+
+def remove_stale_socket(path):
+    """
+    Removes the Unix socket left at a path by a relay that is no longer
+    running, if any.
+
+    :raises OSError: If something else than a socket is at the path, or a
+                     relay is still listening on it.
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError(errno.EADDRINUSE, 'Address in use by something else than a socket', path)
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        # nothing listens on it anymore
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise OSError(errno.EADDRINUSE, 'Address in use', path)
+
+
+class RelayClient(object):
+    """
+    Sends metrics to a :class:`Relay` over a Unix datagram socket.
+
+    It is meant for the workers of pre-fork servers: it does not fetch tokens
+    nor connect to Kairosdb. Deferred metrics are encoded in memory and sent
+    to the relay in datagrams of up to ``datagram_size`` bytes, when a
+    datagram is full, when the oldest pending metric is ``flush_interval``
+    seconds old (checked when a metric is deferred) and on :meth:`flush`.
+    Call :meth:`flush` at the end of each request to send its metrics right
+    away.
+
+    Sending never blocks: metrics are dropped, and counted in
+    :attr:`dropped`, when the relay is not running or cannot keep up.
+    """
+
+    def __init__(self, path=RELAY_SOCKET, datagram_size=16384, flush_interval=1.0):
+        self.path = path
+        self.datagram_size = datagram_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._lines = []
+        self._size = 0
+        self._oldest = None
+        self._lock = threading.Lock()
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.setblocking(False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def defer_metric(self, metric_name, value, tags, timestamp=None):
+        """
+        Queues a metric to be sent to the relay, which writes it with its next
+        deferred write.
+
+        :param metric_name: The name of the metric.
+        :type metric_name: str
+        :param value: The value of the metric.
+        :type value: int, float or metricz.values.HistogramValue
+        :param tags: Tags to add to the metric.
+        :type tags: dict
+        :param timestamp: The time to register the metric, as milliseconds
+                          since the epoch, seconds since the epoch or a
+                          datetime (IN UTC!). (Default: now)
+        :type timestamp: int, float or datetime.datetime
+        :return: None
+        :rtype: None
+        :raises ValueError: If the metric cannot be written as a protocol line
+                            (see :func:`metricz.protocol.encode`).
+        """
+        line = encode(metric_name, tags, timestamp_millis(timestamp), normalize_value(value)).encode('utf-8')
+        now = time.monotonic()
+        with self._lock:
+            if self._lines and self._size + len(line) + 1 > self.datagram_size:
+                self._send()
+            self._lines.append(line)
+            self._size += len(line) + 1
+            if self._oldest is None:
+                self._oldest = now
+            elif now - self._oldest >= self.flush_interval:
+                self._send()
+
+    def flush(self):
+        """
+        Sends the pending metrics to the relay.
+        """
+        with self._lock:
+            self._send()
+
+    def _send(self):
+        if not self._lines:
+            return
+        lines = self._lines
+        self._lines, self._size, self._oldest = [], 0, None
+        try:
+            self._socket.sendto(b'\n'.join(lines), self.path)
+        except OSError:
+            # the relay is not running (ENOENT, ECONNREFUSED) or its queue is full (EAGAIN)
+            self.dropped += len(lines)
+
+    def close(self):
+        self.flush()
+        self._socket.close()
+
+
+class Relay(threading.Thread):
+    """
+    Daemon thread receiving metrics and deferring them on a single writer.
+
+    Metrics are received, one per line in the format of
+    :func:`metricz.protocol.encode`, on a Unix datagram socket at ``path``
+    (used by :class:`RelayClient`) and optionally on a UDP address and/or a
+    TCP address, so any program can send them (e.g. with ``nc``).
+
+    Run one relay per host (e.g. in the master process of a pre-fork server
+    or with ``metricz relay``) with a writer that flushes in the background,
+    so only that process fetches tokens and talks to Kairosdb::
+
+        writer = MetricWriter(flush_interval=10, flush_size=10000)
+        relay = Relay(writer)
+        relay.start()
+
+    Lines that are not valid metrics are logged and counted in
+    :attr:`invalid`.
+    """
+
+    def __init__(self, writer, path=RELAY_SOCKET, udp_address=None, tcp_address=None):
+        """
+        :param writer: Writer deferring the received metrics.
+        :type writer: metricz.MetricWriter
+        :param path: Path of the Unix socket to listen on, None to not listen
+                     on one. A stale socket left at the path is replaced, but
+                     :class:`OSError` is raised if a relay is listening on it or
+                     it is not a socket.
+        :type path: str
+        :param udp_address: (host, port) to receive UDP datagrams on.
+        :type udp_address: tuple
+        :param tcp_address: (host, port) to accept TCP connections on.
+        :type tcp_address: tuple
+        """
+        super(Relay, self).__init__(name='metricz-relay')
+        self.daemon = True
+        self.writer = writer
+        self.path = path
+        self.received = 0
+        self.invalid = 0
+        self._stopped = threading.Event()
+        self._selector = selectors.DefaultSelector()
+        # partial lines received on each TCP connection
+        self._pending = {}
+        if path is not None:
+            remove_stale_socket(path)
+            self._listen(socket.AF_UNIX, socket.SOCK_DGRAM, path, self._receive_datagram)
+        if udp_address is not None:
+            self._listen(socket.AF_INET, socket.SOCK_DGRAM, udp_address, self._receive_datagram)
+        if tcp_address is not None:
+            self._listen(socket.AF_INET, socket.SOCK_STREAM, tcp_address, self._accept)
+
+    def _listen(self, family, socket_type, address, handler):
+        listener = socket.socket(family, socket_type)
+        if socket_type == socket.SOCK_DGRAM:
+            try:
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER)
+            except OSError:
+                pass
+        else:
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(address)
+        if socket_type == socket.SOCK_STREAM:
+            listener.listen(128)
+        listener.setblocking(False)
+        self._selector.register(listener, selectors.EVENT_READ, handler)
+
+    @property
+    def addresses(self):
+        """
+        Addresses the relay listens on.
+
+        :rtype: list
+        """
+        return [key.fileobj.getsockname() for key in self._selector.get_map().values()
+                if key.fileobj not in self._pending]
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def run(self):
+        while not self._stopped.is_set():
+            # wake up regularly to notice when the relay is stopped
+            for key, _ in self._selector.select(0.2):
+                try:
+                    key.data(key.fileobj)
+                except Exception:
+                    logger.exception('Failed to receive metrics')
+
+    def _receive_datagram(self, listener):
+        try:
+            data = listener.recv(MAX_DATAGRAM)
+        except BlockingIOError:
+            return
+        self.receive(data)
+
+    def _accept(self, listener):
+        try:
+            connection, _ = listener.accept()
+        except BlockingIOError:
+            return
+        connection.setblocking(False)
+        self._pending[connection] = b''
+        self._selector.register(connection, selectors.EVENT_READ, self._read)
+
+    def _read(self, connection):
+        try:
+            data = connection.recv(MAX_DATAGRAM)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            # the connection was closed, its last line may lack the terminator
+            self.receive(self._pending[connection])
+            self._close_connection(connection)
+            return
+        lines, _, rest = (self._pending[connection] + data).rpartition(b'\n')
+        self.receive(lines)
+        if len(rest) > MAX_DATAGRAM:
+            self.invalid += 1
+            logger.warning('Discarding metric line longer than %d bytes', MAX_DATAGRAM)
+            rest = b''
+        self._pending[connection] = rest
+
+    def _close_connection(self, connection):
+        self._selector.unregister(connection)
+        del self._pending[connection]
+        connection.close()
+
+    def receive(self, data):
+        """
+        Defers the metrics of a datagram.
+
+        :param data: Metrics encoded with :func:`metricz.protocol.encode`, one per line.
+        :type data: bytes
+        """
+        for line in data.decode('utf-8', 'replace').splitlines():
+            if not line.strip():
+                continue
+            try:
+                metric_name, tags, timestamp, value = decode(line)
+            except ValueError as e:
+                self.invalid += 1
+                logger.warning('Discarding metric: %s', e)
+                continue
+            self.writer.defer_metric(metric_name, value, tags, timestamp)
+            self.received += 1
+
+    def stop(self, timeout=None):
+        """
+        Stops receiving metrics and removes the Unix socket. The writer is
+        left open, close it to write the last metrics.
+
+        :param timeout: Maximum seconds to wait for the thread.
+        :type timeout: float
+        """
+        self._stopped.set()
+        if self.is_alive():
+            self.join(timeout)
+        for key in list(self._selector.get_map().values()):
+            key.fileobj.close()
+        self._selector.close()
+        self._pending.clear()
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
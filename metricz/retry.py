@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+import random
+import threading
+import time
+
+# Responses that are worth retrying, the request is assumed not to have been processed
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised when a write is refused because the circuit breaker is open.
+    """
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with jitter for failed writes.
+
+    Connection errors, timeouts and responses with one of the ``statuses`` are
+    retried up to ``retries`` times. The n-th retry waits a random time between
+    0 and ``min(max_backoff, backoff * 2 ** n)`` seconds ("full jitter"), or
+    exactly that upper bound if ``jitter`` is disabled.
+    """
+
+    def __init__(self, retries=3, backoff=0.1, max_backoff=5, jitter=True, statuses=RETRY_STATUSES):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.statuses = frozenset(statuses)
+
+    def delay(self, attempt):
+        """
+        Time to wait before a retry.
+
+        :param attempt: The number of the retry, starting at 0.
+        :type attempt: int
+        :return: The delay in seconds.
+        :rtype: float
+        """
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def should_retry(self, status_code):
+        """
+        Checks if a response status is worth retrying.
+
+        :param status_code: The HTTP response status.
+        :type status_code: int
+        :rtype: bool
+        """
+        return status_code in self.statuses
+
+
+class CircuitBreaker(object):
+    """
+    Stops writes to an unavailable Kairosdb.
+
+    After ``failure_threshold`` consecutive failures the circuit opens and
+    writes are refused for ``reset_timeout`` seconds. After that a single write
+    is let through: if it succeeds the circuit closes, otherwise it opens again.
+    If the trial write records no result, another one is let through after
+    ``reset_timeout`` seconds.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._state = self.CLOSED
+        self._opened_at = None
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == self.OPEN and self._clock() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self):
+        """
+        Checks if a write can be attempted.
+
+        :rtype: bool
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            now = self._clock()
+            if now - self._opened_at >= self.reset_timeout:
+                # let a single trial write through, until it fails or times out
+                self._state = self.HALF_OPEN
+                self._opened_at = now
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._state = self.OPEN
+                self._opened_at = self._clock()
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+from .buffer import Batch
+
+
+def send_chunks(chunks, write):
+    """
+    Writes chunks one after the other, stopping at the first failure so the
+    points of a series are never written out of order.
+
+    :param chunks: The chunks to write.
+    :type chunks: iterable
+    :param write: Function writing a chunk, returning None on success or
+                  what went wrong otherwise.
+    :type write: callable
+    :return: List of (chunk, error) tuples, the chunks that were not written
+             after a failure have the error of the failed one.
+    :rtype: list
+    """
+    results = []
+    error = None
+    for chunk in chunks:
+        if error is None:
+            error = write(chunk)
+        results.append((chunk, error))
+    return results
+
+
+class ConcurrentSender(object):
+    """
+    Writes big batches as several requests in parallel.
+
+    Series are distributed over ``workers`` lanes by their key. Each lane is
+    split in chunks of up to ``chunk_points`` points that are written one
+    after the other, so the points of a series are always written in order,
+    while the lanes are written concurrently.
+
+    When a chunk fails the following chunks of its lane are not written.
+
+    Chunks are also limited to ``max_bytes`` once serialized, when passed to
+    :meth:`send`.
+    """
+
+    def __init__(self, workers=4, chunk_points=5000):
+        self.workers = workers
+        self.chunk_points = chunk_points
+        # imported here, so writers without a sender do not import concurrent.futures
+        from concurrent.futures import ThreadPoolExecutor
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='metricz-sender')
+
+    def send(self, batch, write, max_bytes=None):
+        """
+        Writes a batch.
+
+        :param batch: The batch to write.
+        :type batch: metricz.buffer.Batch
+        :param write: Function writing a chunk, returning None on success or
+                      what went wrong otherwise.
+        :type write: callable
+        :param max_bytes: Maximum serialized size of a chunk.
+        :type max_bytes: int
+        :return: List of (chunk, error) tuples, error is None for the chunks
+                 that were written.
+        :rtype: list
+        """
+        lanes = [[] for _ in range(self.workers)]
+        for series in batch.series:
+            lanes[hash(series.key) % self.workers].append(series)
+        futures = [self._executor.submit(send_chunks, list(Batch(lane).split(self.chunk_points, max_bytes)), write)
+                   for lane in lanes if lane]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def close(self):
+        self._executor.shutdown()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+import json
+import zlib
+
+from .values import HISTOGRAM
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None
+
+# Batches of at least this many points are encoded while they are sent
+STREAM_THRESHOLD = 10000
+# Points encoded at once by the streaming encoder, bounding the memory used
+# by serialization to a few hundred kilobytes whatever the size of the batch
+STREAM_CHUNK_POINTS = 2000
+# Bytes of encoded fragments sent in one chunk of the request body
+STREAM_CHUNK_BYTES = 65536
+GZIP_LEVEL = 6
+GZIP_HEADERS = {'Content-Encoding': 'gzip'}
+
+
+def dumps_json(obj):
+    """
+    Serializes to compact JSON with the standard library.
+
+    :rtype: bytes
+    """
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def dumps_ujson(obj):
+    """
+    Serializes to JSON with ujson.
+
+    :rtype: bytes
+    """
+    return ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+
+def dumps_orjson(obj):
+    """
+    Serializes to JSON with orjson.
+
+    :rtype: bytes
+    """
+    return orjson.dumps(obj)
+
+
+SERIALIZERS = {'json': dumps_json}
+if ujson is not None:
+    SERIALIZERS['ujson'] = dumps_ujson
+if orjson is not None:
+    SERIALIZERS['orjson'] = dumps_orjson
+
+# The fastest JSON library installed
+dumps = dumps_orjson if orjson is not None else dumps_ujson if ujson is not None else dumps_json
+
+
+def get_serializer(name=None):
+    """
+    Returns a JSON serializer by library name.
+
+    :param name: ``orjson``, ``ujson`` or ``json``, None for the fastest
+                 one installed.
+    :type name: str
+    :return: Function serializing an object to JSON bytes.
+    :rtype: callable
+    :raises ValueError: If the library is not installed.
+    """
+    if name is None:
+        return dumps
+    try:
+        return SERIALIZERS[name]
+    except KeyError:
+        raise ValueError('Invalid serializer {}. Use one of {}'.format(name, ', '.join(sorted(SERIALIZERS))))
+
+
+def encode_batch(batch, serializer=dumps, chunk_points=STREAM_CHUNK_POINTS):
+    """
+    Encodes a batch in the grouped Kairosdb format, the same JSON as
+    ``serializer(batch.payload())``, a few points at a time.
+
+    The datapoints are serialized from the columns of each series in slices
+    of ``chunk_points``, so neither the payload nor the whole JSON document
+    are ever in memory.
+
+    :type batch: metricz.buffer.Batch
+    :param serializer: Function serializing an object to JSON bytes.
+    :type serializer: callable
+    :param chunk_points: Points serialized at once.
+    :type chunk_points: int
+    :return: Generator of JSON fragments.
+    :rtype: generator
+    """
+    separator = b'['
+    for series in batch.series:
+        series.compact()
+        header = {'name': series.name, 'tags': series.tags}
+        if series.type == HISTOGRAM:
+            header['type'] = HISTOGRAM
+        # the header object, left open for the datapoints
+        yield separator + serializer(header)[:-1] + b',"datapoints":['
+        separator = b''
+        for start in range(0, len(series.timestamps), chunk_points):
+            timestamps = series.timestamps[start:start + chunk_points]
+            values = series.values[start:start + chunk_points]
+            if series.type == HISTOGRAM:
+                values = [value.payload() for value in values]
+            # strip the brackets of the list, the slices are joined in the datapoints list
+            yield separator + serializer(list(zip(timestamps, values)))[1:-1]
+            separator = b','
+        yield b']}'
+        separator = b','
+    yield b'[]' if separator == b'[' else b']'
+
+
+class StreamingPayload(object):
+    """
+    Request body encoding a batch while it is sent, with chunked transfer
+    encoding.
+
+    The body can be iterated more than once, e.g. to retry a request, and is
+    encoded again each time. ``size`` is the size of the JSON encoded by the
+    last iteration, before compression.
+    """
+
+    def __init__(self, batch, serializer=dumps, compress=False, chunk_points=STREAM_CHUNK_POINTS):
+        """
+        :type batch: metricz.buffer.Batch
+        :param serializer: Function serializing an object to JSON bytes.
+        :type serializer: callable
+        :param compress: Whether to gzip the body.
+        :type compress: bool
+        :param chunk_points: Points serialized at once.
+        :type chunk_points: int
+        """
+        self.batch = batch
+        self.serializer = serializer
+        self.compress = compress
+        self.chunk_points = chunk_points
+        self.size = 0
+
+    @property
+    def headers(self):
+        """
+        Extra request headers of the body, if any.
+
+        :rtype: dict or None
+        """
+        return GZIP_HEADERS if self.compress else None
+
+    def __iter__(self):
+        self.size = 0
+        fragments = self._count(encode_batch(self.batch, self.serializer, self.chunk_points))
+        if not self.compress:
+            # series headers and small series are joined, not to send tiny chunks
+            pending, size = [], 0
+            for fragment in fragments:
+                pending.append(fragment)
+                size += len(fragment)
+                if size >= STREAM_CHUNK_BYTES:
+                    yield b''.join(pending)
+                    pending, size = [], 0
+            yield b''.join(pending)
+            return
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        for fragment in fragments:
+            data = compressor.compress(fragment)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def _count(self, fragments):
+        for fragment in fragments:
+            self.size += len(fragment)
+            yield fragment
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import struct
+import threading
+import time
+import zlib
+
+from .buffer import MetricBuffer
+from .serialization import dumps
+
+logger = logging.getLogger(__name__)
+
+# Record header: payload length, payload crc32 and number of datapoints
+HEADER = struct.Struct('>III')
+SEGMENT_SUFFIX = '.spool'
+
+# fsync policies
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+
+class Segment(object):
+    """
+    A spool file and what is known about its records.
+    """
+
+    def __init__(self, sequence, path, size=0, points=0):
+        self.sequence = sequence
+        self.path = path
+        self.size = size
+        self.points = points
+        # records before offset were already replayed
+        self.offset = 0
+        self.replayed = 0
+
+
+def read_records(path, offset=0):
+    """
+    Reads the valid records of a segment.
+
+    Reading stops at the first incomplete or corrupted record, which is what
+    is left at the end of a segment by a torn write.
+
+    :param path: The segment path.
+    :type path: str
+    :param offset: Position of the first record to read.
+    :type offset: int
+    :return: List of (offset after the record, points, payload) tuples, and
+             the position where the valid records end.
+    :rtype: tuple
+    """
+    records = []
+    with open(path, 'rb') as segment_file:
+        segment_file.seek(offset)
+        data = segment_file.read()
+    position = 0
+    while position + HEADER.size <= len(data):
+        length, crc, points = HEADER.unpack_from(data, position)
+        start = position + HEADER.size
+        payload = data[start:start + length]
+        if len(payload) < length or zlib.crc32(payload) & 0xffffffff != crc:
+            break
+        position = start + length
+        records.append((offset + position, points, payload))
+    return records, offset + position
+
+
+class DiskSpool(object):
+    """
+    Append-only on-disk spool of metrics that could not be written.
+
+    Payloads are appended to segment files in ``directory``; a new segment is
+    started when the current one reaches ``segment_bytes``. When the spool
+    grows over ``max_bytes`` its oldest segments are deleted, and the points
+    they held are counted in :attr:`dropped`.
+
+    ``fsync`` selects when appended data is forced to disk: after every
+    append (``always``), at most every ``fsync_interval`` seconds
+    (``interval``) or never, leaving it to the operating system (``never``).
+
+    Incomplete records left by a crash are discarded when the spool is opened.
+    Records are deleted only after they were replayed successfully, so points
+    may be written twice if the process dies while replaying.
+    """
+
+    def __init__(self, directory, segment_bytes=8 * 1024 * 1024, max_bytes=512 * 1024 * 1024,
+                 fsync=FSYNC_INTERVAL, fsync_interval=1.0):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError('Invalid fsync policy {}. Use one of {}'.format(fsync, ', '.join(FSYNC_POLICIES)))
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.dropped = 0
+        self._lock = threading.Lock()
+        # replays read records outside of _lock, not to block appends, so they must not overlap
+        self._replay_lock = threading.Lock()
+        self._file = None
+        self._last_fsync = 0
+        self._segments = []
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._recover()
+
+    def __len__(self):
+        """
+        Number of spooled points that were not replayed yet.
+        """
+        return sum(segment.points - segment.replayed for segment in self._segments)
+
+    @property
+    def size(self):
+        """
+        Size of the spool on disk in bytes.
+        """
+        return sum(segment.size for segment in self._segments)
+
+    def _recover(self):
+        for file_name in sorted(os.listdir(self.directory)):
+            if not file_name.endswith(SEGMENT_SUFFIX):
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                sequence = int(file_name[:-len(SEGMENT_SUFFIX)])
+            except ValueError:
+                continue
+            records, end = read_records(path)
+            if end < os.path.getsize(path):
+                logger.warning('Discarding incomplete records at the end of %s', path)
+                with open(path, 'r+b') as segment_file:
+                    segment_file.truncate(end)
+            if not records:
+                os.remove(path)
+                continue
+            self._segments.append(Segment(sequence, path, end, sum(points for _, points, _ in records)))
+
+    def _open_segment(self):
+        sequence = self._segments[-1].sequence + 1 if self._segments else 0
+        path = os.path.join(self.directory, '{:020d}{}'.format(sequence, SEGMENT_SUFFIX))
+        self._file = open(path, 'ab')
+        self._segments.append(Segment(sequence, path))
+
+    def _close_segment(self):
+        if self._file:
+            self._file.flush()
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
+
+    def append(self, payload):
+        """
+        Appends metrics in the grouped Kairosdb format to the spool.
+
+        :param payload: List of series, as returned by
+                        :meth:`metricz.buffer.Batch.payload`.
+        :type payload: list
+        :return: None
+        :rtype: None
+        """
+        points = sum(len(series['datapoints']) for series in payload)
+        if not points:
+            return
+        data = dumps(payload)
+        record = HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff, points) + data
+
+        with self._lock:
+            if self._file is None or self._segments[-1].size >= self.segment_bytes:
+                self._close_segment()
+                self._open_segment()
+            self._file.write(record)
+            self._file.flush()
+            segment = self._segments[-1]
+            segment.size += len(record)
+            segment.points += points
+
+            now = time.time()
+            if self.fsync == FSYNC_ALWAYS or (self.fsync == FSYNC_INTERVAL and
+                                              now - self._last_fsync >= self.fsync_interval):
+                os.fsync(self._file.fileno())
+                self._last_fsync = now
+
+            self._enforce_max_bytes()
+
+    def spill(self, points):
+        """
+        Appends metric payload dictionaries to the spool. Use it as the spill
+        function of a buffer with the ``spill`` overflow policy.
+
+        :param points: Metric payloads.
+        :type points: list
+        :return: None
+        :rtype: None
+        """
+        buffer = MetricBuffer()
+        for point in points:
+            buffer.append(point['name'], point['tags'], point['timestamp'], point['value'])
+        self.append(buffer.drain().payload())
+
+    def _enforce_max_bytes(self):
+        while self.max_bytes is not None and self.size > self.max_bytes and len(self._segments) > 1:
+            segment = self._segments.pop(0)
+            self.dropped += segment.points - segment.replayed
+            logger.warning('Spool is full, deleting %s with %d points', segment.path, segment.points - segment.replayed)
+            os.remove(segment.path)
+
+    def replay(self, send, max_points=10000, max_bytes=None):
+        """
+        Sends the spooled metrics, oldest first, in batches of up to
+        ``max_points`` points and ``max_bytes`` bytes (or a single record if
+        it is bigger).
+
+        Replaying stops at the first batch that could not be sent, which is
+        kept to be replayed next time. Concurrent replays wait for each other,
+        so no batch is sent twice.
+
+        :param send: Function called with each batch, serialized as a JSON
+                     list in the grouped Kairosdb format. It returns whether
+                     the batch was written.
+        :type send: callable
+        :param max_points: Maximum points per batch, None for no limit.
+        :type max_points: int
+        :param max_bytes: Maximum size of a batch, None for no limit.
+        :type max_bytes: int
+        :return: Number of points replayed.
+        :rtype: int
+        """
+        with self._replay_lock:
+            return self._replay(send, max_points, max_bytes)
+
+    def _replay(self, send, max_points, max_bytes):
+        with self._lock:
+            if self._file is not None:
+                # the segment being written is closed so it can be replayed
+                self._close_segment()
+            segments = list(self._segments)
+
+        replayed = 0
+        for segment in segments:
+            try:
+                records, _ = read_records(segment.path, segment.offset)
+            except FileNotFoundError:
+                # deleted meanwhile as the spool was full
+                continue
+            index = 0
+            while index < len(records):
+                # the size of the brackets, less the comma before the first record
+                batch, points, size = [], 0, 1
+                while index < len(records):
+                    record_end, record_points, data = records[index]
+                    # records are JSON lists, joined into a single one, with a comma between them
+                    record_size = len(data) - 1
+                    if batch and (max_points is not None and points + record_points > max_points or
+                                  max_bytes is not None and size + record_size > max_bytes):
+                        break
+                    end = record_end
+                    batch.append(data[1:-1])
+                    points += record_points
+                    size += record_size
+                    index += 1
+                if not send(b'[' + b','.join(batch) + b']'):
+                    return replayed
+                replayed += points
+                with self._lock:
+                    if segment not in self._segments:
+                        # deleted while the batch was sent, its points were counted as dropped
+                        self.dropped -= points
+                        break
+                    segment.offset = end
+                    segment.replayed += points
+            with self._lock:
+                if segment in self._segments:
+                    self._segments.remove(segment)
+                    os.remove(segment.path)
+        return replayed
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
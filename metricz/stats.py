@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+
+from .instruments import PERCENTILES, Counter, Histogram, percentile
+
+# Prefix of the metrics a writer emits about itself, reserved for them
+SELF_PREFIX = 'metricz.'
+
+# Most recent values of a distribution its percentiles are calculated from
+WINDOW = 1024
+
+
+class Distribution(object):
+    """
+    Count, sum, minimum and maximum of all the values observed, and
+    percentiles of the most recent ones.
+    """
+
+    def __init__(self, window=WINDOW):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        self.recent.append(value)
+
+    def summary(self):
+        """
+        :return: Dictionary with the count, min, max, mean and percentiles.
+        :rtype: dict
+        """
+        summary = {'count': self.count, 'min': self.min, 'max': self.max,
+                   'mean': self.total / self.count if self.count else None}
+        samples = sorted(self.recent)
+        for percent in PERCENTILES:
+            summary['p{}'.format(percent)] = percentile(samples, percent) if samples else None
+        return summary
+
+
+class WriterStats(object):
+    """
+    Counters and distributions of what a writer does, e.g. ``requests``,
+    ``http.503`` or ``flush.latency``, kept since the writer was created.
+
+    With ``instruments`` (the writer's
+    :class:`metricz.instruments.InstrumentRegistry`) they are also recorded
+    in counters and histograms named ``<prefix><name>``, written with the
+    writer's deferred metrics.
+    """
+
+    def __init__(self, instruments=None, prefix=SELF_PREFIX, tags=None):
+        """
+        :param instruments: Registry to record the stats in, if they are
+                            written as metrics.
+        :type instruments: metricz.instruments.InstrumentRegistry
+        :param prefix: Prefix of the metric names.
+        :type prefix: str
+        :param tags: Tags of the metrics.
+        :type tags: dict
+        """
+        self.instruments = instruments
+        self.prefix = prefix
+        self.tags = tags or {}
+        self._counters = collections.defaultdict(int)
+        self._distributions = collections.defaultdict(Distribution)
+        self._lock = threading.Lock()
+
+    def count(self, name, amount=1):
+        """
+        Adds to a counter.
+
+        :type name: str
+        :type amount: int
+        """
+        with self._lock:
+            self._counters[name] += amount
+        if self.instruments is not None:
+            self.instruments.get(Counter, self.prefix + name, self.tags).inc(amount)
+
+    def observe(self, name, value):
+        """
+        Adds a value to a distribution.
+
+        :type name: str
+        :type value: float
+        """
+        with self._lock:
+            self._distributions[name].observe(value)
+        if self.instruments is not None:
+            self.instruments.get(Histogram, self.prefix + name, self.tags).record(value)
+
+    def snapshot(self):
+        """
+        :return: Dictionary of the counters, and of the summaries of the
+                 distributions (see :meth:`Distribution.summary`).
+        :rtype: dict
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            stats.update((name, distribution.summary()) for name, distribution in self._distributions.items())
+        return stats
+
+
+class Span(object):
+    """
+    No-op span of a :class:`Tracer`.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def set_attribute(self, key, value):
+        pass
+
+
+class Tracer(object):
+    """
+    Hook tracing the send path of a writer, which does nothing by default.
+
+    Writers open spans named ``metricz.write_deferred`` around each deferred
+    write, ``metricz.request`` around each HTTP request (including retries)
+    and ``metricz.token`` around each token renewal. Subclasses return a
+    context manager from :meth:`span` whose value has a
+    ``set_attribute(key, value)`` method, e.g. with OpenTelemetry::
+
+        class OpenTelemetryTracer(Tracer):
+            def __init__(self, tracer):
+                self.tracer = tracer
+
+            def span(self, name, attributes):
+                return self.tracer.start_as_current_span(name, attributes=attributes)
+    """
+
+    def span(self, name, attributes):
+        """
+        Starts a span, used as a context manager.
+
+        :param name: The name of the span.
+        :type name: str
+        :param attributes: Attributes known when the span starts.
+        :type attributes: dict
+        :rtype: Span
+        """
+        return Span()
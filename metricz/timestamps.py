@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import time
+
+EPOCH = datetime.datetime.utcfromtimestamp(0)
+
+try:
+    time_ns = time.time_ns
+except AttributeError:  # pragma: no cover
+    def time_ns():
+        return int(time.time() * 1e9)
+
+
+def timestamp_millis(timestamp=None):
+    """
+    Converts a timestamp to milliseconds since the epoch.
+
+    :param timestamp: The timestamp as milliseconds since the epoch (int),
+                      seconds since the epoch (float) or a datetime in
+                      UTC. (Default: now)
+    :type timestamp: int, float or datetime.datetime
+    :return: The timestamp in millis.
+    :rtype: int
+    """
+    if timestamp is None:
+        return time_ns() // 1000000
+    if isinstance(timestamp, int):
+        return timestamp
+    if isinstance(timestamp, float):
+        return int(timestamp * 1000)
+    return datetime_to_millis(timestamp)
+
+
+def datetime_to_millis(dt):
+    """
+    Converts a datetime object to timestamp in milliseconds.
+
+    :param dt: The datetime object.
+    :type dt: datetime.datetime
+    :return: The timestamp in millis.
+    :rtype: int
+    """
+    return int((dt - EPOCH).total_seconds() * 1000)
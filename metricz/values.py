@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+import decimal
+import math
+import numbers
+
+HISTOGRAM = 'histogram'
+
+# Range of the longs Kairosdb (and the serializers) store, bigger ints are written as doubles
+LONG_MIN = -2 ** 63
+LONG_MAX = 2 ** 63 - 1
+
+# Mantissa bits kept by histogram bins, the Kairosdb default
+HISTOGRAM_PRECISION = 7
+
+
+class HistogramValue(object):
+    """
+    A distribution of values written as a single Kairosdb histogram datapoint.
+
+    Values are counted in bins keeping ``precision`` bits of their mantissa,
+    so the relative error of a bin is at most ``2 ** -precision``.
+    """
+
+    def __init__(self, precision=HISTOGRAM_PRECISION):
+        self.precision = precision
+        self.bins = {}
+        self.count = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+
+    @classmethod
+    def from_samples(cls, samples, precision=HISTOGRAM_PRECISION):
+        """
+        Builds a histogram with all the samples.
+
+        :rtype: HistogramValue
+        """
+        histogram = cls(precision)
+        for sample in samples:
+            histogram.add(sample)
+        return histogram
+
+    @classmethod
+    def from_payload(cls, payload):
+        """
+        Builds a histogram from its Kairosdb representation.
+
+        :param payload: Dictionary with bins, min, max, sum and optionally precision.
+        :type payload: dict
+        :rtype: HistogramValue
+        """
+        try:
+            histogram = cls(int(payload.get('precision', HISTOGRAM_PRECISION)))
+            histogram.bins = {float(bin_value): int(count) for bin_value, count in payload['bins'].items()}
+            histogram.min = float(payload['min'])
+            histogram.max = float(payload['max'])
+            histogram.sum = float(payload['sum'])
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            raise ValueError('Invalid histogram {!r}: {}'.format(payload, e))
+        histogram.count = sum(histogram.bins.values())
+        return histogram
+
+    def _bin(self, value):
+        mantissa, exponent = math.frexp(value)
+        scale = 1 << self.precision
+        return math.ldexp(round(mantissa * scale) / scale, exponent)
+
+    def add(self, value, count=1):
+        """
+        Adds a value to the histogram.
+
+        :param value: The value.
+        :type value: float
+        :param count: Number of times the value was seen.
+        :type count: int
+        """
+        bin_value = self._bin(value)
+        self.bins[bin_value] = self.bins.get(bin_value, 0) + count
+        self.count += count
+        self.sum += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def payload(self):
+        """
+        Returns the Kairosdb representation of the histogram.
+
+        :rtype: dict
+        """
+        return {
+            'bins': {repr(float(bin_value)): count for bin_value, count in self.bins.items()},
+            'min': self.min,
+            'max': self.max,
+            'sum': self.sum,
+            'precision': self.precision,
+        }
+
+    def __eq__(self, other):
+        return isinstance(other, HistogramValue) and self.payload() == other.payload()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'HistogramValue({!r})'.format(self.payload())
+
+
+def normalize_value(value):
+    """
+    Converts a metric value to a type Kairosdb stores natively: long (int),
+    double (float) or histogram. Ints out of the range of longs are converted
+    to doubles.
+
+    :param value: The value of the metric.
+    :type value: int, float or HistogramValue
+    :rtype: int, float or HistogramValue
+    :raises ValueError: If the value is out of the range of doubles.
+    """
+    if not isinstance(value, (int, float, HistogramValue)) or isinstance(value, bool):
+        if isinstance(value, numbers.Integral):
+            value = int(value)
+        elif isinstance(value, (numbers.Real, decimal.Decimal)):
+            value = float(value)
+        else:
+            try:
+                value = int(value)
+            except ValueError:
+                value = float(value)
+    if isinstance(value, int) and not LONG_MIN <= value <= LONG_MAX:
+        try:
+            return float(value)
+        except OverflowError:
+            raise ValueError('Value {} is out of the range of doubles'.format(value))
+    return value
@@ -17,6 +17,12 @@ requirements = [
     'environmental>=1.0',
 ]
 
+extra_requirements = {
+    'async': ['aiohttp'],
+    'prometheus': ['python-snappy'],
+    'orjson': ['orjson'],
+}
+
 test_requirements = [
     'pytest',
     'mock'
@@ -37,6 +43,7 @@ setup(
                  'metricz'},
     include_package_data=True,
     install_requires=requirements,
+    extras_require=extra_requirements,
     zip_safe=False,
     keywords='metricz',
     classifiers=[
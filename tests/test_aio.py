@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import json
+
+from mock import MagicMock
+import pytest
+
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web  # noqa
+from aiohttp.test_utils import TestServer  # noqa
+
+from metricz.aio import AsyncMetricWriter  # noqa
+
+
+@pytest.fixture(autouse=True)
+def mock_token(monkeypatch):
+    mocked_tokens_gen = MagicMock(name='Token Gen')
+    mocked_tokens_gen.get = MagicMock(return_value='ABCabc')
+    monkeypatch.setattr('metricz.aio.tokens', mocked_tokens_gen)
+    return mocked_tokens_gen
+
+
+class FakeKairosDB(object):
+    def __init__(self, status=204):
+        self.status = status
+        self.requests = []
+
+    async def handle(self, request):
+        self.requests.append((request.headers.get('Authorization'), json.loads(await request.text())))
+        return web.Response(status=self.status)
+
+    def points(self):
+        points = []
+        for _, body in self.requests:
+            if isinstance(body, dict):
+                points.append(body)
+                continue
+            for metric in body:
+                points.extend({'name': metric['name'], 'timestamp': timestamp, 'value': value, 'tags': metric['tags']}
+                              for timestamp, value in metric['datapoints'])
+        return points
+
+
+def run_with_server(kairosdb, test):
+    async def main():
+        app = web.Application()
+        app.router.add_post('/api/v1/datapoints', kairosdb.handle)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            await test(str(server.make_url('/api/v1/datapoints')))
+        finally:
+            await server.close()
+    asyncio.run(main())
+
+
+def test_write_metric():
+    kairosdb = FakeKairosDB()
+
+    async def test(url):
+        metric_writer = AsyncMetricWriter(kairosdb_url=url)
+        await metric_writer.write_metric('foobar', 1, {"foo": "bar"})
+        await metric_writer.close()
+
+    run_with_server(kairosdb, test)
+    authorization, payload = kairosdb.requests[0]
+    assert authorization == 'Bearer ABCabc'
+    assert payload['name'] == 'foobar'
+    assert payload['value'] == 1
+    assert payload['tags'] == {"foo": "bar"}
+
+
+def test_write_deferred_keeps_metrics_on_failure():
+    kairosdb = FakeKairosDB(status=503)
+
+    async def test(url):
+        metric_writer = AsyncMetricWriter(kairosdb_url=url)
+        metric_writer.defer_metric('foobar', 1, {"foo": "bar"})
+        await metric_writer.write_deferred()
+        assert len(metric_writer.deferred_metrics) == 1
+        kairosdb.status = 204
+        await metric_writer.close()
+        assert len(metric_writer.deferred_metrics) == 0
+
+    run_with_server(kairosdb, test)
+    assert len(kairosdb.requests) == 2
+
+
+def test_background_flush():
+    kairosdb = FakeKairosDB()
+
+    async def test(url):
+        async with AsyncMetricWriter(kairosdb_url=url, flush_size=2) as metric_writer:
+            metric_writer.defer_metric('foobar', 1, {"foo": "bar"})
+            metric_writer.defer_metric('foobar', 2, {"foo": "bar"})
+            for _ in range(100):
+                if kairosdb.requests:
+                    break
+                await asyncio.sleep(0.01)
+            assert [point['value'] for point in kairosdb.points()] == [1, 2]
+            metric_writer.defer_metric('foobar', 3, {"foo": "bar"})
+
+    run_with_server(kairosdb, test)
+    assert [point['value'] for point in kairosdb.points()] == [1, 2, 3]
+
+
+def test_fail_loudly():
+    kairosdb = FakeKairosDB(status=400)
+
+    async def test(url):
+        metric_writer = AsyncMetricWriter(kairosdb_url=url, fail_silently=False)
+        with pytest.raises(aiohttp.ClientResponseError):
+            await metric_writer.write_metric('foobar', 1, {"foo": "bar"})
+        await metric_writer.close()
+
+    run_with_server(kairosdb, test)
+
+
+def test_compress_large_payloads():
+    kairosdb = FakeKairosDB()
+
+    async def test(url):
+        metric_writer = AsyncMetricWriter(kairosdb_url=url, compress_threshold=0)
+        for i in range(100):
+            metric_writer.defer_metric('foobar', i, {"foo": "bar"})
+        await metric_writer.close()
+
+    run_with_server(kairosdb, test)
+    assert len(kairosdb.points()) == 100
+
+
+def test_write_deferred_in_limited_requests():
+    kairosdb = FakeKairosDB()
+
+    async def handle(request):
+        body = json.loads(await request.text())
+        kairosdb.requests.append((request.headers.get('Authorization'), body))
+        return web.Response(status=503 if body[0]['tags'] == {'series': '2'} else 204)
+    kairosdb.handle = handle
+
+    async def test(url):
+        metric_writer = AsyncMetricWriter(kairosdb_url=url, max_request_points=5)
+        for i in range(5):
+            for series in range(4):
+                metric_writer.defer_metric('foobar', i, {"series": str(series)}, i)
+        await metric_writer.write_deferred()
+        # the failed request and the next one are kept
+        assert sorted(point['tags']['series'] for point in metric_writer.deferred_metrics) == ['2'] * 5 + ['3'] * 5
+        metric_writer.deferred_metrics.drain()
+        await metric_writer.close()
+
+    run_with_server(kairosdb, test)
+    assert len(kairosdb.requests) == 3
+    assert {point['tags']['series'] for point in kairosdb.points()} == {'0', '1', '2'}
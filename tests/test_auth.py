@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from mock import MagicMock
+
+from metricz.auth import TokenRefresher
+
+
+def test_refresher_renews_periodically():
+    renew = MagicMock()
+    refresher = TokenRefresher(renew, interval=0.01)
+    assert not refresher.ready
+    refresher.start()
+    assert refresher.wait(1)
+    refresher.stop(1)
+    assert not refresher.is_alive()
+    assert renew.call_count >= 1
+
+
+def test_refresher_retries_failures():
+    renew = MagicMock(side_effect=[Exception('token endpoint unavailable'), None])
+    refresher = TokenRefresher(renew, interval=10, retry_interval=0.01)
+    refresher.start()
+    assert refresher.wait(1)
+    refresher.stop(1)
+    assert renew.call_count == 2
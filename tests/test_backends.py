@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import socket
+import struct
+import threading
+
+from mock import MagicMock
+
+from metricz.backends import (Graphite, InfluxDB, KairosDB, PrometheusRemoteWrite, point_batch, snappy_compress,
+                              _varint)
+from metricz.buffer import MetricBuffer
+from metricz.values import HistogramValue
+
+
+def make_batch():
+    buffer = MetricBuffer()
+    buffer.append('some.metric', {'host': 'a b', 'app': 'x'}, 1000, 1)
+    buffer.append('some.metric', {'host': 'a b', 'app': 'x'}, 2000, 2)
+    buffer.append('float.metric', {}, 1000, 1.5)
+    buffer.append('latency', {'app': 'x'}, 3000, HistogramValue.from_samples([1, 2, 3]))
+    return buffer.drain()
+
+
+def read_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, position
+
+
+def parse_protobuf(data):
+    """
+    Parses the fields of a protobuf message: list of (field number, value),
+    values are bytes for length delimited fields.
+    """
+    fields, position = [], 0
+    while position < len(data):
+        key, position = read_varint(data, position)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = read_varint(data, position)
+        elif wire_type == 1:
+            value, = struct.unpack_from('<d', data, position)
+            position += 8
+        else:
+            length, position = read_varint(data, position)
+            value = data[position:position + length]
+            position += length
+        fields.append((number, value))
+    return fields
+
+
+def snappy_decompress(data):
+    """
+    Decompresses Snappy blocks made of literals only.
+    """
+    length, position = read_varint(data, 0)
+    chunks = []
+    while position < len(data):
+        tag = data[position] >> 2
+        position += 1
+        if tag < 60:
+            size = tag + 1
+        else:
+            size = int.from_bytes(data[position:position + tag - 59], 'little') + 1
+            position += tag - 59
+        chunks.append(data[position:position + size])
+        position += size
+    result = b''.join(chunks)
+    assert len(result) == length
+    return result
+
+
+def test_influxdb_encode():
+    lines = InfluxDB('http://influxdb:8086/write', 'metrics').encode(make_batch()).decode('utf-8').split('\n')
+    assert lines == [
+        'some.metric,app=x,host=a\\ b value=1i 1000',
+        'some.metric,app=x,host=a\\ b value=2i 2000',
+        'float.metric value=1.5 1000',
+        'latency,app=x count=3i,sum=6.0,min=1.0,max=3.0 3000',
+    ]
+
+
+def test_graphite_encode():
+    data = Graphite('localhost', prefix='prefix.').encode(make_batch()).decode('utf-8')
+    assert data.split('\n') == [
+        'prefix.some.metric;app=x;host=a_b 1 1',
+        'prefix.some.metric;app=x;host=a_b 2 2',
+        'prefix.float.metric 1.5 1',
+        'prefix.latency.count;app=x 3 3',
+        'prefix.latency.sum;app=x 6 3',
+        'prefix.latency.min;app=x 1 3',
+        'prefix.latency.max;app=x 3 3',
+        '',
+    ]
+
+
+def test_graphite_send():
+    server = socket.socket()
+    server.bind(('localhost', 0))
+    server.listen(1)
+    received = []
+
+    def accept():
+        connection, _ = server.accept()
+        while True:
+            data = connection.recv(4096)
+            if not data:
+                break
+            received.append(data)
+        connection.close()
+    thread = threading.Thread(target=accept)
+    thread.start()
+    graphite = Graphite(*server.getsockname())
+    graphite.write(point_batch('foobar', {}, 1000, 1), timeout=1)
+    graphite.close()
+    thread.join(1)
+    server.close()
+    assert b''.join(received) == b'foobar 1 1\n'
+    assert graphite.written == 1
+
+
+def prometheus_timeseries(batch):
+    data = snappy_decompress(PrometheusRemoteWrite('http://prometheus/api/v1/write').encode(batch))
+    timeseries = []
+    for number, series in parse_protobuf(data):
+        assert number == 1
+        labels, samples = [], []
+        for field, value in parse_protobuf(series):
+            if field == 1:
+                (_, name), (_, label_value) = parse_protobuf(value)
+                labels.append((name.decode('utf-8'), label_value.decode('utf-8')))
+            else:
+                sample = dict(parse_protobuf(value))
+                samples.append((sample[2], sample[1]))
+        timeseries.append((labels, samples))
+    return timeseries
+
+
+def test_prometheus_encode():
+    timeseries = prometheus_timeseries(make_batch())
+    assert timeseries[0] == ([('__name__', 'some_metric'), ('app', 'x'), ('host', 'a b')], [(1000, 1.0), (2000, 2.0)])
+    assert timeseries[1] == ([('__name__', 'float_metric')], [(1000, 1.5)])
+    assert [labels[0][1] for labels, _ in timeseries[2:]] == [
+        'latency_count', 'latency_max', 'latency_min', 'latency_sum']
+    assert timeseries[2][1] == [(3000, 3.0)]
+
+
+def test_prometheus_labels_are_sorted_and_unique():
+    buffer = MetricBuffer()
+    buffer.append('some.metric', {'Zone': 'eu', 'a.b': '1', 'a_b': '2', '__name__': 'tag'}, 1000, 1)
+    [(labels, _)] = prometheus_timeseries(buffer.drain())
+    assert labels == [('Zone', 'eu'), ('__name__', 'some_metric'), ('a_b', '1;2')]
+
+
+def test_snappy_literals():
+    for size in (0, 10, 100, 70000):
+        data = bytes(bytearray(i % 256 for i in range(size)))
+        assert snappy_decompress(snappy_compress(data)) == data
+    assert _varint(300) == b'\xac\x02'
+
+
+def test_http_backend_send():
+    backend = KairosDB('http://kairosdb/api/v1/datapoints', headers={'Authorization': 'Bearer x'})
+    assert backend.session.headers['Authorization'] == 'Bearer x'
+    backend.session = MagicMock()
+    backend.write(point_batch('foobar', {'foo': 'bar'}, 1000, 1), timeout=2)
+    backend.session.post.assert_called_once_with(
+        'http://kairosdb/api/v1/datapoints',
+        data=b'[{"name":"foobar","tags":{"foo":"bar"},"datapoints":[[1000,1]]}]', params=None, timeout=2)
+    backend.session.post.return_value.raise_for_status.assert_called_once_with()
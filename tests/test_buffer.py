@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+import pytest
+
+from metricz.buffer import (MetricBuffer, ShardedBuffer, series_overhead, DROP_OLDEST, DROP_NEWEST, BLOCK, SPILL,
+                            ORDERED_POINT_SIZE)
+from metricz.serialization import SERIALIZERS
+from metricz.values import HistogramValue
+
+
+def append(buffer, value, metric_name='foobar', tags=None):
+    return buffer.append(metric_name, tags or {'foo': 'bar'}, value, value)
+
+
+def values(points):
+    return [p['value'] for p in points]
+
+
+def test_unbounded():
+    buffer = MetricBuffer()
+    for i in range(1000):
+        append(buffer, i)
+    assert len(buffer) == 1000
+    assert buffer.dropped == 0
+
+
+def test_drain_groups_series():
+    buffer = MetricBuffer()
+    append(buffer, 1)
+    append(buffer, 2, tags={'foo': 'baz'})
+    append(buffer, 3)
+    batch = buffer.drain()
+    assert len(batch) == 3
+    assert len(buffer) == 0
+    assert batch.payload() == [
+        {'name': 'foobar', 'tags': {'foo': 'bar'}, 'datapoints': [[1, 1], [3, 3]]},
+        {'name': 'foobar', 'tags': {'foo': 'baz'}, 'datapoints': [[2, 2]]},
+    ]
+
+
+def test_tags_are_copied():
+    buffer = MetricBuffer()
+    tags = {'foo': 'bar'}
+    buffer.append('foobar', tags, 1, 1)
+    tags['foo'] = 'changed'
+    assert buffer.drain().payload()[0]['tags'] == {'foo': 'bar'}
+
+
+def test_values_out_of_range():
+    buffer = MetricBuffer()
+    append(buffer, 1)
+    # ints beyond longs turn the series into doubles
+    buffer.append('foobar', {'foo': 'bar'}, 2, 2 ** 63)
+    with pytest.raises(ValueError):
+        buffer.append('foobar', {'foo': 'bar'}, 3, 10 ** 400)
+    with pytest.raises(ValueError):
+        buffer.append('foobar', {'foo': 'baz'}, 2 ** 63, 1)
+    assert buffer.drain().payload() == [
+        {'name': 'foobar', 'tags': {'foo': 'bar'}, 'datapoints': [[1, 1.0], [2, 2.0 ** 63]]}]
+
+
+def test_drop_oldest():
+    buffer = MetricBuffer(max_points=3, overflow=DROP_OLDEST)
+    for i in range(5):
+        append(buffer, i, tags={'series': str(i % 2)})
+    assert values(buffer) == [2, 3, 4]
+    assert buffer.dropped == 2
+
+
+def test_drop_newest():
+    buffer = MetricBuffer(max_points=3, overflow=DROP_NEWEST)
+    for i in range(5):
+        append(buffer, i)
+    assert values(buffer) == [0, 1, 2]
+    assert buffer.dropped == 2
+
+
+def test_max_bytes():
+    buffer = MetricBuffer(max_bytes=series_overhead('foobar', {'foo': 'bar'}) + 2 * ORDERED_POINT_SIZE)
+    for i in range(5):
+        append(buffer, i)
+    assert values(buffer) == [3, 4]
+    buffer.drain()
+    assert buffer.size == 0
+
+
+def test_drop_oldest_compacts_columns():
+    buffer = MetricBuffer(max_points=10)
+    for i in range(10000):
+        append(buffer, i)
+    assert values(buffer) == list(range(9990, 10000))
+    series, = buffer._series.values()
+    assert len(series.timestamps) < 3000
+
+
+def test_spill():
+    spilled = []
+    buffer = MetricBuffer(max_points=2, overflow=SPILL, spill=spilled.extend)
+    for i in range(5):
+        append(buffer, i)
+    assert values(buffer) == [3, 4]
+    assert values(spilled) == [0, 1, 2]
+    assert spilled[0] == {'name': 'foobar', 'timestamp': 0, 'value': 0, 'tags': {'foo': 'bar'}}
+    assert buffer.spilled == 3
+    assert buffer.dropped == 0
+
+
+def test_block_waits_for_drain():
+    buffer = MetricBuffer(max_points=1, overflow=BLOCK)
+    append(buffer, 0)
+    thread = threading.Thread(target=append, args=(buffer, 1))
+    thread.start()
+    thread.join(0.05)
+    assert thread.is_alive()
+    assert values(buffer.drain()) == [0]
+    thread.join(1)
+    assert values(buffer) == [1]
+
+
+def test_block_timeout_drops():
+    buffer = MetricBuffer(max_points=1, overflow=BLOCK, block_timeout=0.01)
+    append(buffer, 0)
+    append(buffer, 1)
+    assert values(buffer) == [0]
+    assert buffer.dropped == 1
+
+
+def test_requeue():
+    buffer = MetricBuffer()
+    append(buffer, 0)
+    append(buffer, 1, tags={'foo': 'baz'})
+    batch = buffer.drain()
+    append(buffer, 2)
+    buffer.requeue(batch)
+    assert len(buffer) == 3
+    assert buffer.drain().payload() == [
+        {'name': 'foobar', 'tags': {'foo': 'bar'}, 'datapoints': [[0, 0], [2, 2]]},
+        {'name': 'foobar', 'tags': {'foo': 'baz'}, 'datapoints': [[1, 1]]},
+    ]
+
+
+def test_extend():
+    buffer = MetricBuffer(max_points=10)
+    append(buffer, 0)
+    append(buffer, 1, tags={'foo': 'baz'})
+    batch = buffer.drain()
+    other = MetricBuffer()
+    append(other, 2)
+    append(other, 3, metric_name='other')
+    batch.extend(other.drain())
+    assert len(batch) == 4
+    assert values(batch) == [0, 1, 2, 3]
+    assert batch.payload() == [
+        {'name': 'foobar', 'tags': {'foo': 'bar'}, 'datapoints': [[0, 0], [2, 2]]},
+        {'name': 'foobar', 'tags': {'foo': 'baz'}, 'datapoints': [[1, 1]]},
+        {'name': 'other', 'tags': {'foo': 'bar'}, 'datapoints': [[3, 3]]},
+    ]
+    buffer.requeue(batch)
+    assert values(buffer) == [0, 1, 2, 3]
+
+
+def test_requeue_respects_bounds():
+    buffer = MetricBuffer(max_points=3)
+    for i in range(3):
+        append(buffer, i, tags={'series': str(i % 2)})
+    batch = buffer.drain()
+    append(buffer, 3)
+    append(buffer, 4)
+    buffer.requeue(batch)
+    assert values(buffer) == [2, 3, 4]
+    assert buffer.dropped == 2
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        MetricBuffer(overflow='explode')
+    with pytest.raises(ValueError):
+        MetricBuffer(overflow=SPILL)
+
+
+def test_split():
+    buffer = MetricBuffer()
+    for i in range(5):
+        append(buffer, i)
+    for i in range(3):
+        append(buffer, i, tags={'foo': 'baz'})
+    chunks = list(buffer.drain().split(3))
+    assert [len(chunk) for chunk in chunks] == [3, 3, 2]
+    assert [chunk.payload() for chunk in chunks] == [
+        [{'name': 'foobar', 'tags': {'foo': 'bar'}, 'datapoints': [[0, 0], [1, 1], [2, 2]]}],
+        [{'name': 'foobar', 'tags': {'foo': 'bar'}, 'datapoints': [[3, 3], [4, 4]]},
+         {'name': 'foobar', 'tags': {'foo': 'baz'}, 'datapoints': [[0, 0]]}],
+        [{'name': 'foobar', 'tags': {'foo': 'baz'}, 'datapoints': [[1, 1], [2, 2]]}],
+    ]
+
+
+def test_split_by_bytes():
+    buffer = MetricBuffer()
+    for i in range(300):
+        append(buffer, i * 1001, tags={'series': str(i % 7), 'unicode': u'caf\xe9'})
+        buffer.append('float.metric', {}, i, i / 3.0)
+    buffer.append('latency', {}, 1000, HistogramValue.from_samples(range(20)))
+    batch = buffer.drain()
+    chunks = list(batch.split(max_bytes=1000))
+    for chunk in chunks:
+        for serializer in SERIALIZERS.values():
+            assert len(serializer(chunk.payload())) <= 1000
+    assert sum(len(chunk) for chunk in chunks) == len(batch)
+    assert chunks[0].payload()[0]['datapoints'][:3] == [[0, 0], [7007, 7007], [14014, 14014]]
+
+    # a point bigger than the limit is written on its own
+    chunks = list(batch.split(max_points=100, max_bytes=10))
+    assert len(chunks) == len(batch)
+
+
+def test_sharded_buffer():
+    buffer = ShardedBuffer(shards=4)
+    for i in range(100):
+        assert append(buffer, i, tags={'series': str(i % 10)}) == i + 1
+    assert len(buffer) == 100
+    batch = buffer.drain()
+    assert len(buffer) == 0
+    assert len(batch.series) == 10
+    for series in batch.payload():
+        assert [value for _, value in series['datapoints']] == list(range(int(series['tags']['series']), 100, 10))
+    buffer.requeue(batch)
+    assert sorted(values(buffer)) == list(range(100))
+
+
+def test_sharded_buffer_bounds():
+    buffer = ShardedBuffer(shards=4, max_points=8)
+    for i in range(100):
+        append(buffer, i, tags={'series': str(i % 10)})
+    assert len(buffer) <= 8
+    assert buffer.dropped == 100 - len(buffer)
+
+
+def test_sharded_buffer_threads():
+    buffer = ShardedBuffer(shards=4)
+
+    def produce(thread):
+        for i in range(1000):
+            append(buffer, i, tags={'thread': str(thread)})
+    threads = [threading.Thread(target=produce, args=(thread,)) for thread in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batch = buffer.drain()
+    assert len(batch) == 8000
+    assert all(series['datapoints'] == [[i, i] for i in range(1000)] for series in batch.payload())
@@ -1,23 +1,27 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import socket
+import time
 from mock import MagicMock
 
 import pytest
 from click.testing import CliRunner
 from metricz.cli import main
+from metricz.relay import Relay
+from metricz.values import HistogramValue
 
 FAKE_ENV = {
     'OAUTH2_ACCESS_TOKEN_URL': 'oauth.example.com',
     'CREDENTIALS_DIR': '/meta/credentials',
-    'METRICZ_DB_URL': 'kairosdb.example.com'
+    'METRICZ_DB_URL': 'kairosdb.example.com',
+    'METRICZ_RELAY': '/nonexistent/metricz.sock',
 }
 
 
 @pytest.fixture(autouse=True)
 def metric_writer(monkeypatch):
     metric_writer_instance = MagicMock(name="MetricWriter()")
-    monkeypatch.setattr('metricz.cli.MetricWriter', MagicMock(return_value=metric_writer_instance))
+    monkeypatch.setattr('metricz.metricz.MetricWriter', MagicMock(return_value=metric_writer_instance))
     return metric_writer_instance
 
 
@@ -94,3 +98,109 @@ def test_missing_configs_uses_defaults():
     result = runner.invoke(main, ['write', 'thing', '1'],
                            env=env_missing_envs, catch_exceptions=False)
     assert result.exit_code == 0
+
+
+def test_write_metric_value_types(runner, metric_writer, default_tags):
+    result = runner.invoke(main, ['write', 'latency', '1.5'], catch_exceptions=False)
+    assert result.exit_code == 0
+    metric_writer.write_metric.assert_called_once_with('latency', 1.5, default_tags)
+
+    metric_writer.reset_mock()
+    histogram = '{"bins": {"1.0": 2, "2.0": 1}, "min": 1, "max": 2, "sum": 4}'
+    result = runner.invoke(main, ['write', 'latency', histogram], catch_exceptions=False)
+    assert result.exit_code == 0
+    metric_writer.write_metric.assert_called_once_with(
+        'latency', HistogramValue.from_payload({"bins": {"1.0": 2, "2.0": 1}, "min": 1, "max": 2, "sum": 4}),
+        default_tags)
+
+    result = runner.invoke(main, ['write', 'latency', 'fast'], catch_exceptions=False)
+    assert result.exit_code == 2
+    assert 'fast is not a number or a JSON histogram' in result.output
+
+
+def test_write_metric_through_relay(runner, metric_writer, default_tags, tmpdir):
+    path = str(tmpdir.join('relay.sock'))
+    relay_writer = MagicMock()
+    with Relay(relay_writer, path) as relay:
+        result = runner.invoke(main, ['write', 'answer', '42', 'question=all.the.things'],
+                               env={'METRICZ_RELAY': path}, catch_exceptions=False)
+        assert result.exit_code == 0
+        deadline = time.time() + 2
+        while not relay.received and time.time() < deadline:
+            time.sleep(0.01)
+    expected_tags = {'question': 'all.the.things'}
+    expected_tags.update(default_tags)
+    (metric_name, value, tags, _), _ = relay_writer.defer_metric.call_args
+    assert (metric_name, value, tags) == ('answer', 42, expected_tags)
+    assert not metric_writer.write_metric.called
+
+
+def test_write_invalid_metric_through_relay(runner, metric_writer, default_tags, tmpdir):
+    path = str(tmpdir.join('relay.sock'))
+    relay_writer = MagicMock()
+    with Relay(relay_writer, path) as relay:
+        result = runner.invoke(main, ['write', 'answer', '42', 'env=prod east'], env={'METRICZ_RELAY': path},
+                               catch_exceptions=False)
+        time.sleep(0.1)
+        assert relay.received == relay.invalid == 0
+    # written directly, by a writer reporting why it is invalid
+    assert result.exit_code == 0
+    expected_tags = {'env': 'prod east'}
+    expected_tags.update(default_tags)
+    metric_writer.write_metric.assert_called_once_with('answer', 42, expected_tags)
+
+
+def test_write_metric_without_relay(runner, metric_writer, default_tags, tmpdir):
+    # a socket left by a relay that is not running anymore
+    path = str(tmpdir.join('relay.sock'))
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stale.bind(path)
+    stale.close()
+    result = runner.invoke(main, ['write', 'something', '1'], env={'METRICZ_RELAY': path}, catch_exceptions=False)
+    assert result.exit_code == 0
+    metric_writer.write_metric.assert_called_once_with('something', 1, default_tags)
+
+
+def test_relay_command(runner, metric_writer, monkeypatch):
+    relay = MagicMock(name='Relay()')
+    relay.is_alive.return_value = False
+    relay_class = MagicMock(return_value=relay)
+    monkeypatch.setattr('metricz.cli.Relay', relay_class)
+    result = runner.invoke(main, ['relay', '--udp', '8125', '--tcp', '0.0.0.0:4242'], catch_exceptions=False)
+    assert result.exit_code == 0
+    relay_class.assert_called_once_with(metric_writer, '/nonexistent/metricz.sock', ('localhost', 8125),
+                                        ('0.0.0.0', 4242))
+    relay.start.assert_called_once_with()
+    relay.stop.assert_called_once_with()
+    metric_writer.close.assert_called_once_with()
+
+    result = runner.invoke(main, ['relay', '--udp', 'localhost:port'])
+    assert result.exit_code == 2
+
+
+def test_import(runner, metric_writer, tmpdir):
+    metrics = tmpdir.join('metrics.txt')
+    metrics.write('put foobar 1000 1 foo=bar\n'
+                  '\n'
+                  '{"name": "foobar", "timestamp": 2000, "value": 1.5, "tags": {"foo": "bar"}}\n'
+                  'put foobar\n'
+                  '{"name": "foobar", "value": 3}\n')
+    result = runner.invoke(main, ['import', '--batch-size', '2', str(metrics)])
+    assert result.exit_code == 1
+    assert metric_writer.defer_metric.call_args_list == [
+        (('foobar', 1, {'foo': 'bar'}, 1000),),
+        (('foobar', 1.5, {'foo': 'bar'}, 2000),),
+        (('foobar', 3, {}, None),),
+    ]
+    assert metric_writer.write_deferred.call_count == 1
+    metric_writer.close.assert_called_once_with()
+    assert 'metrics.txt:4: Invalid metric line' in result.output
+    assert 'Imported 3 metrics' in result.output
+    assert '1 invalid lines' in result.output
+
+
+def test_import_stdin(runner, metric_writer):
+    result = runner.invoke(main, ['import', '--format', 'json'], input='{"name": "foobar", "value": 1}\n',
+                           catch_exceptions=False)
+    assert result.exit_code == 0
+    metric_writer.defer_metric.assert_called_once_with('foobar', 1, {}, None)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from metricz.guard import CardinalityError, CardinalityGuard, COLLAPSE
+from metricz.registry import SeriesRegistry
+
+
+def test_reject():
+    guard = CardinalityGuard(max_series=2)
+    for request in ('a', 'b'):
+        assert guard.admit('requests', {'request_id': request}) == {'request_id': request}
+    with pytest.raises(CardinalityError):
+        guard.admit('requests', {'request_id': 'c'})
+    assert guard.admit('requests', {'request_id': 'a'}) == {'request_id': 'a'}
+    assert guard.admit('other.metric', {'request_id': 'c'}) == {'request_id': 'c'}
+    assert guard.rejected_points == 1
+
+
+def test_collapse():
+    guard = CardinalityGuard(max_series=3, policy=COLLAPSE)
+    for request in ('a', 'b', 'c'):
+        guard.admit('requests', {'endpoint': 'users', 'request_id': request})
+    assert guard.admit('requests', {'endpoint': 'users', 'request_id': 'd'}) == {
+        'endpoint': 'users', 'request_id': 'other'}
+    assert guard.admit('requests', {'endpoint': 'users', 'request_id': 'c'}) == {
+        'endpoint': 'users', 'request_id': 'c'}
+    assert guard.collapsed_series == 1
+    with pytest.raises(CardinalityError):
+        guard.admit('requests', {})
+
+
+def test_invalid_policy():
+    with pytest.raises(ValueError):
+        CardinalityGuard(policy='ignore')
+
+
+def test_rate_limit(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr('metricz.guard.time.monotonic', lambda: now[0])
+    guard = CardinalityGuard(max_rate=2, burst=3)
+    series = SeriesRegistry().intern('foobar', {})
+    assert [guard.allow(series) for _ in range(4)] == [True, True, True, False]
+    now[0] += 1
+    assert [guard.allow(series) for _ in range(3)] == [True, True, False]
+    assert guard.rate_limited_points == 2
+    assert CardinalityGuard().allow(series)
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import subprocess
+import sys
+
+# Import time budgets in microseconds, generous to leave room for slow machines
+IMPORT_BUDGET = 50000
+CLI_OWN_BUDGET = 50000
+
+HEAVY_MODULES = ('requests', 'tokens', 'urllib3', 'concurrent.futures')
+
+
+def import_times(statement):
+    """
+    Imports modules in a new interpreter with ``-X importtime``.
+
+    :return: Dictionary of module name to (self, cumulative) import time in microseconds.
+    """
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            stderr=subprocess.PIPE, check=True, universal_newlines=True).stderr
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(own), int(cumulative)
+    return times
+
+
+def test_import_is_lazy():
+    times = import_times('import metricz')
+    assert not [module for module in HEAVY_MODULES if module in times]
+    assert times['metricz'][1] < IMPORT_BUDGET
+
+
+def test_cli_import_is_lazy():
+    times = import_times('import metricz.cli')
+    assert not [module for module in HEAVY_MODULES if module in times]
+    own = sum(own for name, (own, _) in times.items() if name.startswith('metricz'))
+    assert own < CLI_OWN_BUDGET
+
+
+def test_lazy_attributes():
+    import metricz
+    from metricz.metricz import MetricWriter
+    assert metricz.MetricWriter is MetricWriter
+    assert metricz.CREDENTIALS_DIR == '/meta/credentials'
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+from mock import MagicMock
+
+from metricz.instruments import Counter, Gauge, Histogram, Timer, InstrumentRegistry
+
+
+def test_counter():
+    counter = Counter('requests', {'foo': 'bar'})
+    threads = [threading.Thread(target=lambda: [counter.inc() for _ in range(1000)]) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    counter.inc(5)
+    assert counter.collect() == [('requests', 4005)]
+    # counters are reset and nothing is written for empty intervals
+    assert counter.collect() == []
+
+
+def test_gauge():
+    gauge = Gauge('queue.size', {})
+    assert gauge.collect() == []
+    gauge.set(3)
+    gauge.set(7)
+    assert gauge.collect() == [('queue.size', 7)]
+    assert gauge.collect() == [('queue.size', 7)]
+
+
+def test_histogram():
+    histogram = Histogram('latency', {})
+    for value in range(1, 101):
+        histogram.record(value)
+    assert dict(histogram.collect()) == {
+        'latency.count': 100,
+        'latency.min': 1,
+        'latency.max': 100,
+        'latency.mean': 50.5,
+        'latency.p50': 50,
+        'latency.p90': 90,
+        'latency.p99': 99,
+    }
+    assert histogram.collect() == []
+
+
+def test_histogram_samples_are_bounded():
+    histogram = Histogram('latency', {}, max_samples=10)
+    for value in range(1000):
+        histogram.record(value)
+    assert len(histogram.samples) == 10
+    summary = dict(histogram.collect())
+    assert summary['latency.count'] == 1000
+    assert summary['latency.max'] == 999
+
+
+def test_timer(monkeypatch):
+    clock = MagicMock(side_effect=[10.0, 10.25])
+    monkeypatch.setattr('metricz.instruments.time.time', clock)
+    timer = Timer('duration', {})
+    with timer:
+        pass
+    assert dict(timer.collect())['duration.max'] == 250
+
+
+def test_registry():
+    registry = InstrumentRegistry()
+    tags = {'foo': 'bar'}
+    counter = registry.get(Counter, 'requests', tags)
+    assert registry.get(Counter, 'requests', {'foo': 'bar'}) is counter
+    assert registry.get(Counter, 'requests', {'foo': 'baz'}) is not counter
+    assert registry.get(Gauge, 'requests', tags) is not counter
+    # the instrument keeps its own copy of the tags
+    tags['foo'] = 'changed'
+    counter.inc()
+    assert registry.collect() == [('requests', 1, {'foo': 'bar'})]
+
+
+def test_native_histogram():
+    histogram = Histogram('latency', {}, native=True)
+    for value in (1, 2, 2):
+        histogram.record(value)
+    (name, distribution), = histogram.collect()
+    assert name == 'latency'
+    assert distribution.payload()['bins'] == {'1.0': 1, '2.0': 2}
+    assert histogram.collect() == []
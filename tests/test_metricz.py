@@ -2,11 +2,25 @@
 # -*- coding: utf-8 -*-
 
 from metricz import MetricWriter
+from metricz.auth import TokenUnavailableError
+from metricz.guard import CardinalityGuard
 from metricz.metricz import KAIROSDB_URL
+from metricz.retry import RetryPolicy, CircuitBreaker, CircuitOpenError
+from metricz.sender import ConcurrentSender
+from metricz.spool import DiskSpool
+from metricz.stats import Tracer
+from metricz.values import HistogramValue
 
 import datetime
+import gc
+import gzip
+import json
+import threading
+import time
+import weakref
 from mock import MagicMock, ANY
 import pytest
+import requests
 
 
 @pytest.fixture(autouse=True)
@@ -30,6 +44,8 @@ def freeze_datetime(monkeypatch):
 def requests_mock(monkeypatch):
     mocked_requests = MagicMock(name='mocked requests')
     mocked_requests.session = MagicMock(return_value=mocked_requests)
+    # what Kairosdb answers to a successful write
+    mocked_requests.post.return_value.status_code = 204
     monkeypatch.setattr('metricz.metricz.requests', mocked_requests)
     return mocked_requests
 
@@ -64,3 +80,549 @@ def test_write_with_timeout(requests_mock):
         KAIROSDB_URL,
         data=ANY,
         timeout=5)
+
+
+def flatten(payload):
+    points = []
+    for metric in payload:
+        for timestamp, value in metric['datapoints']:
+            points.append({'name': metric['name'], 'timestamp': timestamp, 'value': value, 'tags': metric['tags']})
+    return points
+
+
+def posted_points(requests_mock):
+    points = []
+    for call in requests_mock.post.call_args_list:
+        points.extend(flatten(json.loads(call[1]['data'])))
+    return points
+
+
+def test_write_deferred_keeps_metrics_on_failure(requests_mock):
+    metric_writer = MetricWriter()
+    metric_writer._renew_token = MagicMock()
+    metric_writer.defer_metric('foobar', 1, {"foo": "bar"})
+    metric_writer.defer_metric('foobar', 2, {"foo": "bar"})
+
+    requests_mock.post.return_value.status_code = 503
+    metric_writer.write_deferred()
+    assert len(metric_writer.deferred_metrics) == 2
+
+    requests_mock.post.return_value.status_code = 204
+    metric_writer.write_deferred()
+    assert len(metric_writer.deferred_metrics) == 0
+    assert [point['value'] for point in flatten(json.loads(requests_mock.post.call_args[1]['data']))] == [1, 2]
+
+
+def test_flush_size_triggers_background_write(requests_mock):
+    requests_mock.post.return_value.status_code = 204
+    metric_writer = MetricWriter(flush_size=2)
+    metric_writer._renew_token = MagicMock()
+    metric_writer.defer_metric('foobar', 1, {"foo": "bar"})
+    metric_writer.defer_metric('foobar', 2, {"foo": "bar"})
+    for _ in range(100):
+        if requests_mock.post.called:
+            break
+        time.sleep(0.01)
+    assert [point['value'] for point in posted_points(requests_mock)] == [1, 2]
+    metric_writer.close()
+
+
+def test_close_writes_remaining_metrics(requests_mock):
+    requests_mock.post.return_value.status_code = 204
+    with MetricWriter(flush_interval=60) as metric_writer:
+        metric_writer._renew_token = MagicMock()
+        metric_writer.defer_metric('foobar', 1, {"foo": "bar"})
+        assert not requests_mock.post.called
+    assert [point['value'] for point in posted_points(requests_mock)] == [1]
+    assert not metric_writer.flusher
+
+
+def test_concurrent_defer_metric(requests_mock):
+    requests_mock.post.return_value.status_code = 204
+    metric_writer = MetricWriter(flush_interval=0.001, flush_size=10)
+    metric_writer._renew_token = MagicMock()
+
+    def produce():
+        for i in range(500):
+            metric_writer.defer_metric('foobar', i, {"foo": "bar"})
+
+    threads = [threading.Thread(target=produce) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    metric_writer.close()
+    assert len(posted_points(requests_mock)) == 8 * 500
+
+
+def test_bounded_buffer_counts_dropped_metrics(requests_mock):
+    metric_writer = MetricWriter(max_buffer_points=2)
+    for i in range(5):
+        metric_writer.defer_metric('foobar', i, {"foo": "bar"})
+    assert len(metric_writer.deferred_metrics) == 2
+    assert metric_writer.dropped_metrics == 3
+
+
+def test_block_overflow_waits_a_limited_time(requests_mock):
+    with pytest.raises(ValueError):
+        MetricWriter(max_buffer_points=2, overflow='block')
+
+    # Kairosdb is down, so the flusher never makes room
+    requests_mock.post.return_value.status_code = 503
+    metric_writer = MetricWriter(max_buffer_points=2, overflow='block', block_timeout=0.05, flush_interval=60)
+    metric_writer._renew_token = MagicMock()
+    start = time.time()
+    for i in range(3):
+        metric_writer.defer_metric('foobar', i, {"foo": "bar"})
+    assert time.time() - start < 1
+    assert metric_writer.dropped_metrics == 1
+    metric_writer.flusher.stop()
+
+
+def test_retry_on_server_errors(requests_mock, monkeypatch):
+    monkeypatch.setattr('metricz.metricz.time.sleep', MagicMock())
+    failure, success = MagicMock(status_code=503), MagicMock(status_code=204)
+    requests_mock.post.side_effect = [failure, failure, success]
+    metric_writer = MetricWriter(retry=RetryPolicy(retries=3))
+    metric_writer._renew_token = MagicMock()
+    metric_writer.defer_metric('foobar', 1, {"foo": "bar"})
+    metric_writer.write_deferred()
+    assert requests_mock.post.call_count == 3
+    assert len(metric_writer.deferred_metrics) == 0
+
+
+def test_retry_on_connection_errors(requests_mock, monkeypatch):
+    monkeypatch.setattr('metricz.metricz.time.sleep', MagicMock())
+    requests_mock.ConnectionError = requests.ConnectionError
+    requests_mock.Timeout = requests.Timeout
+    requests_mock.post.side_effect = requests.ConnectionError('boom')
+    metric_writer = MetricWriter(retry=RetryPolicy(retries=2))
+    metric_writer._renew_token = MagicMock()
+    metric_writer.defer_metric('foobar', 1, {"foo": "bar"})
+    with pytest.raises(requests.ConnectionError):
+        metric_writer.write_deferred()
+    assert requests_mock.post.call_count == 3
+    assert len(metric_writer.deferred_metrics) == 1
+
+
+def test_circuit_breaker_buffers_metrics(requests_mock):
+    requests_mock.post.return_value.status_code = 503
+    metric_writer = MetricWriter(circuit_breaker=CircuitBreaker(failure_threshold=1))
+    metric_writer._renew_token = MagicMock()
+    metric_writer.write_metric('foobar', 1, {"foo": "bar"})
+    metric_writer.write_metric('foobar', 2, {"foo": "bar"})
+    assert requests_mock.post.call_count == 1
+    assert [point['value'] for point in metric_writer.deferred_metrics] == [2]
+
+    metric_writer.fail_silently = False
+    with pytest.raises(CircuitOpenError):
+        metric_writer.write_deferred()
+    assert len(metric_writer.deferred_metrics) == 1
+
+
+def test_buffered_writes_are_rate_limited_once(requests_mock):
+    requests_mock.post.return_value.status_code = 503
+    guard = CardinalityGuard(max_rate=1, burst=2)
+    metric_writer = MetricWriter(circuit_breaker=CircuitBreaker(failure_threshold=1), guard=guard)
+    metric_writer._renew_token = MagicMock()
+    metric_writer.write_metric('foobar', 1, {"foo": "bar"})
+    metric_writer.write_metric('foobar', 2, {"foo": "bar"})
+    assert [point['value'] for point in metric_writer.deferred_metrics] == [2]
+    assert guard.rate_limited_points == 0
+
+
+def test_circuit_breaker_counts_any_request_error(requests_mock):
+    requests_mock.ConnectionError = requests.ConnectionError
+    requests_mock.Timeout = requests.Timeout
+    requests_mock.post.side_effect = requests.exceptions.ChunkedEncodingError('truncated')
+    metric_writer = MetricWriter(circuit_breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0))
+    metric_writer._renew_token = MagicMock()
+    metric_writer.defer_metric('foobar', 1, {"foo": "bar"})
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ChunkedEncodingError):
+            metric_writer.write_deferred()
+        assert metric_writer.circuit_breaker.state != CircuitBreaker.CLOSED
+
+    requests_mock.post.side_effect = None
+    requests_mock.post.return_value.status_code = 204
+    metric_writer.write_deferred()
+    assert metric_writer.circuit_breaker.state == CircuitBreaker.CLOSED
+    assert len(metric_writer.deferred_metrics) == 0
+
+
+def test_instruments_are_written_as_deferred_metrics(requests_mock):
+    requests_mock.post.return_value.status_code = 204
+    metric_writer = MetricWriter()
+    metric_writer._renew_token = MagicMock()
+    for _ in range(1000):
+        metric_writer.counter('requests', {"foo": "bar"}).inc()
+    metric_writer.gauge('queue.size', {"foo": "bar"}).set(3)
+    metric_writer.write_deferred()
+    points = posted_points(requests_mock)
+    assert sorted((point['name'], point['value']) for point in points) == [('queue.size', 3), ('requests', 1000)]
+
+
+def test_instruments_do_not_wait_for_room_in_the_buffer(requests_mock):
+    requests_mock.post.return_value.status_code = 204
+    metric_writer = MetricWriter(max_buffer_points=2, overflow='block', block_timeout=1, flush_interval=60,
+                                 self_metrics=True)
+    metric_writer._renew_token = MagicMock()
+    metric_writer.flusher.stop()
+    metric_writer.defer_metric('foobar', 1, {"foo": "bar"})
+    metric_writer.defer_metric('foobar', 2, {"foo": "bar"})
+    for name in ('a', 'b', 'c'):
+        metric_writer.counter(name, {"foo": "bar"}).inc()
+    start = time.time()
+    metric_writer.write_deferred()
+    assert time.time() - start < 1
+    assert metric_writer.dropped_metrics == 0
+    points = {point['name']: point['value'] for point in posted_points(requests_mock)}
+    assert points['foobar'] == 2
+    assert points['a'] == points['b'] == points['c'] == 1
+    # the depth before the buffer was drained
+    assert points['metricz.buffer.depth'] == 2
+
+
+def test_compress_large_payloads(requests_mock):
+    requests_mock.post.return_value.status_code = 204
+    metric_writer = MetricWriter(compress_threshold=256)
+    metric_writer._renew_token = MagicMock()
+    metric_writer.write_metric('foobar', 1, {"foo": "bar"})
+    requests_mock.post.assert_called_with(KAIROSDB_URL, data=ANY, timeout=4)
+
+    for i in range(100):
+        metric_writer.defer_metric('foobar', i, {"foo": "bar"})
+    metric_writer.write_deferred()
+    requests_mock.post.assert_called_with(KAIROSDB_URL, data=ANY, timeout=4, headers={'Content-Encoding': 'gzip'})
+    body = requests_mock.post.call_args[1]['data']
+    assert len(flatten(json.loads(gzip.decompress(body).decode('utf-8')))) == 100
+
+
+def test_write_deferred_groups_series(requests_mock):
+    requests_mock.post.return_value.status_code = 204
+    metric_writer = MetricWriter()
+    metric_writer._renew_token = MagicMock()
+    metric_writer.defer_metric('foobar', 1, {"foo": "bar", "a": "b"}, datetime.datetime(2016, 9, 29))
+    metric_writer.defer_metric('foobar', 2, {"foo": "baz"}, datetime.datetime(2016, 9, 29))
+    metric_writer.defer_metric('foobar', 3, {"a": "b", "foo": "bar"}, datetime.datetime(2016, 9, 30))
+    metric_writer.write_deferred()
+    assert json.loads(requests_mock.post.call_args[1]['data']) == [
+        {'name': 'foobar', 'tags': {"foo": "bar", "a": "b"}, 'datapoints': [[1475107200000, 1], [1475193600000, 3]]},
+        {'name': 'foobar', 'tags': {"foo": "baz"}, 'datapoints': [[1475107200000, 2]]},
+    ]
+
+
+def test_timestamp_forms(requests_mock, monkeypatch):
+    monkeypatch.setattr('metricz.metricz.time_ns', MagicMock(return_value=1475107200123456789))
+    requests_mock.post.return_value.status_code = 204
+    metric_writer = MetricWriter()
+    metric_writer._renew_token = MagicMock()
+    metric_writer.defer_metric('foobar', 1, {"foo": "bar"})
+    metric_writer.defer_metric('foobar', 2, {"foo": "bar"}, 1475107200000)
+    metric_writer.defer_metric('foobar', 3, {"foo": "bar"}, 1475107200.5)
+    metric_writer.defer_metric('foobar', 4, {"foo": "bar"}, datetime.datetime(2016, 9, 29))
+    metric_writer.write_deferred()
+    assert [point['timestamp'] for point in posted_points(requests_mock)] == [
+        1475107200123, 1475107200000, 1475107200500, 1475107200000]
+
+    metric_writer.write_metric('foobar', 1, {"foo": "bar"}, 1475107200.5)
+    assert json.loads(requests_mock.post.call_args[1]['data'])['timestamp'] == 1475107200500
+
+
+def test_value_types(requests_mock):
+    requests_mock.post.return_value.status_code = 204
+    metric_writer = MetricWriter()
+    metric_writer._renew_token = MagicMock()
+    metric_writer.defer_metric('count', 1, {"foo": "bar"}, 1)
+    metric_writer.defer_metric('latency', 1, {"foo": "bar"}, 1)
+    metric_writer.defer_metric('latency', 1.5, {"foo": "bar"}, 2)
+    metric_writer.defer_metric('latency', HistogramValue.from_samples([1, 2]), {"foo": "bar"}, 3)
+    metric_writer.write_deferred()
+    histogram = {'bins': {'1.0': 1, '2.0': 1}, 'min': 1, 'max': 2, 'sum': 3, 'precision': 7}
+    assert json.loads(requests_mock.post.call_args[1]['data']) == [
+        {'name': 'count', 'tags': {"foo": "bar"}, 'datapoints': [[1, 1]]},
+        {'name': 'latency', 'tags': {"foo": "bar"}, 'datapoints': [[1, 1.0], [2, 1.5]]},
+        {'name': 'latency', 'type': 'histogram', 'tags': {"foo": "bar"}, 'datapoints': [[3, histogram]]},
+    ]
+
+    metric_writer.write_metric('latency', HistogramValue.from_samples([1, 2]), {"foo": "bar"}, 3)
+    assert json.loads(requests_mock.post.call_args[1]['data']) == {
+        'name': 'latency', 'type': 'histogram', 'timestamp': 3, 'value': histogram, 'tags': {"foo": "bar"}}
+
+
+@pytest.mark.parametrize('serializer', ['json', 'orjson'])
+def test_write_metric_beyond_longs(requests_mock, serializer):
+    pytest.importorskip(serializer)
+    metric_writer = MetricWriter(serializer=serializer, fail_silently=False)
+    metric_writer._renew_token = MagicMock()
+    metric_writer.write_metric('big', 2 ** 64, {"foo": "bar"}, 1)
+    assert json.loads(requests_mock.post.call_args[1]['data'])['value'] == float(2 ** 64)
+    with pytest.raises(ValueError):
+        metric_writer.write_metric('big', 10 ** 400, {"foo": "bar"}, 1)
+    assert requests_mock.post.call_count == 1
+
+
+def test_write_deferred_splits_requests(requests_mock):
+    ok, failure = MagicMock(status_code=204), MagicMock(status_code=413)
+    requests_mock.post.side_effect = [ok, failure]
+    metric_writer = MetricWriter(max_request_points=4)
+    metric_writer._renew_token = MagicMock()
+    for i in range(10):
+        metric_writer.defer_metric('foobar', i, {"foo": "bar"}, i)
+    metric_writer.write_deferred()
+    assert requests_mock.post.call_count == 2
+    # the failed request and the ones not sent after it are kept
+    assert [point['value'] for point in metric_writer.deferred_metrics] == list(range(4, 10))
+
+    requests_mock.post.side_effect = None
+    requests_mock.post.return_value = ok
+    metric_writer.max_request_points = None
+    metric_writer.max_request_bytes = 100
+    metric_writer.write_deferred()
+    assert len(metric_writer.deferred_metrics) == 0
+    sizes = [len(call[1]['data']) for call in requests_mock.post.call_args_list[2:]]
+    assert len(sizes) > 1 and max(sizes) <= 100
+
+
+def test_large_batches_are_streamed(requests_mock):
+    requests_mock.post.return_value.status_code = 204
+    metric_writer = MetricWriter(stream_threshold=10, serializer='json')
+    metric_writer._renew_token = MagicMock()
+    for i in range(5):
+        metric_writer.defer_metric('foobar', i, {"foo": "bar"}, i)
+    metric_writer.write_deferred()
+    assert requests_mock.post.call_args[1]['data'] == b'[{"name":"foobar","tags":{"foo":"bar"},"datapoints":' \
+                                                      b'[[0,0],[1,1],[2,2],[3,3],[4,4]]}]'
+
+    for i in range(20):
+        metric_writer.defer_metric('foobar', i, {"foo": "bar"}, i)
+    metric_writer.write_deferred()
+    body = requests_mock.post.call_args[1]['data']
+    assert not isinstance(body, bytes)
+    assert [point['value'] for point in flatten(json.loads(b''.join(body)))] == list(range(20))
+
+
+def test_series_handles(requests_mock):
+    requests_mock.post.return_value.status_code = 204
+    metric_writer = MetricWriter()
+    metric_writer._renew_token = MagicMock()
+    tags = {"foo": "bar"}
+    series = metric_writer.series('foobar', tags)
+    for i in range(3):
+        series.record(i, i)
+    metric_writer.defer_metric('foobar', 3, tags, 3)
+    # the tags are copied, later changes do not affect deferred metrics
+    tags['foo'] = 'baz'
+    series.record(4, 4)
+    metric_writer.write_deferred()
+    assert json.loads(requests_mock.post.call_args[1]['data']) == [
+        {'name': 'foobar', 'tags': {'foo': 'bar'}, 'datapoints': [[0, 0], [1, 1], [2, 2], [3, 3], [4, 4]]}]
+
+
+def test_invalid_metrics(requests_mock):
+    requests_mock.post.return_value.status_code = 204
+    metric_writer = MetricWriter()
+    metric_writer._renew_token = MagicMock()
+    metric_writer.defer_metric('foobar', 1, {"foo": "two words"})
+    metric_writer.write_metric('foo bar', 1, {})
+    assert metric_writer.invalid_metrics == 2
+    assert len(metric_writer.deferred_metrics) == 0
+    assert not requests_mock.post.called
+    metric_writer.defer_metric('foobar', 10 ** 400, {"foo": "bar"})
+    assert metric_writer.invalid_metrics == 3
+    metric_writer.defer_metric('foobar', 1, {"foo": ["bar"]})
+    assert metric_writer.invalid_metrics == 4
+    metric_writer.defer_metric('foobar', 2 ** 63, {"foo": "bar"})
+    assert len(metric_writer.deferred_metrics) == 1
+
+    metric_writer.fail_silently = False
+    with pytest.raises(ValueError):
+        metric_writer.defer_metric('foobar', 1, {"foo": "two words"})
+    with pytest.raises(ValueError):
+        metric_writer.series('foobar', {"foo": ""})
+
+
+def test_cardinality_guard(requests_mock):
+    requests_mock.post.return_value.status_code = 204
+    guard = CardinalityGuard(max_series=2, policy='collapse', max_rate=5)
+    metric_writer = MetricWriter(guard=guard)
+    metric_writer._renew_token = MagicMock()
+    for i in range(10):
+        metric_writer.defer_metric('requests', 1, {"request_id": str(i)}, i)
+    metric_writer.write_deferred()
+    assert sorted((point['tags']['request_id'], point['timestamp']) for point in posted_points(requests_mock)) == [
+        ('0', 0), ('1', 1), ('other', 2), ('other', 3), ('other', 4), ('other', 5), ('other', 6)]
+    assert guard.collapsed_series == 8
+    assert guard.rate_limited_points == 3
+
+    guard.policy = 'reject'
+    metric_writer.defer_metric('requests', 1, {"request_id": "10"})
+    assert len(metric_writer.deferred_metrics) == 0
+    assert guard.rejected_points == 1
+    assert metric_writer.invalid_metrics == 0
+
+
+def test_failed_writes_are_spooled(requests_mock, tmpdir):
+    spool = DiskSpool(str(tmpdir))
+    metric_writer = MetricWriter(spool=spool)
+    metric_writer._renew_token = MagicMock()
+    metric_writer.defer_metric('foobar', 1, {"foo": "bar"}, 1)
+
+    requests_mock.post.return_value.status_code = 503
+    metric_writer.write_deferred()
+    assert len(metric_writer.deferred_metrics) == 0
+    assert len(spool) == 1
+
+    requests_mock.post.return_value.status_code = 204
+    metric_writer.defer_metric('foobar', 2, {"foo": "bar"}, 2)
+    metric_writer.write_deferred()
+    assert len(spool) == 0
+    assert [point['value'] for point in posted_points(requests_mock)] == [1, 2, 1]
+
+
+def test_concurrent_sender_keeps_failed_chunks(requests_mock):
+    ok, failure = MagicMock(status_code=204), MagicMock(status_code=503)
+
+    def post(url, data, timeout):
+        return failure if b'"series":"0"' in data else ok
+    requests_mock.post.side_effect = post
+    metric_writer = MetricWriter(sender=ConcurrentSender(workers=4, chunk_points=10))
+    metric_writer._renew_token = MagicMock()
+    for i in range(10):
+        for series in range(8):
+            metric_writer.defer_metric('foobar', i, {"series": str(series)}, i)
+    metric_writer.write_deferred()
+    written = [point for call in requests_mock.post.call_args_list if b'"series":"0"' not in call[1]['data']
+               for point in flatten(json.loads(call[1]['data']))]
+    kept = list(metric_writer.deferred_metrics)
+    assert len(written) + len(kept) == 80
+    assert len([point for point in kept if point['tags'] == {"series": "0"}]) == 10
+    metric_writer.sender.close()
+
+
+def test_sharded_buffer(requests_mock):
+    requests_mock.post.return_value.status_code = 204
+    metric_writer = MetricWriter(buffer_shards=4)
+    metric_writer._renew_token = MagicMock()
+    for i in range(20):
+        metric_writer.defer_metric('foobar', i, {"series": str(i % 5)}, i)
+    metric_writer.write_deferred()
+    assert len(metric_writer.deferred_metrics) == 0
+    assert sorted(point['value'] for point in posted_points(requests_mock)) == list(range(20))
+
+
+def test_backends_receive_written_metrics(requests_mock):
+    ok, failure = MagicMock(status_code=204), MagicMock(status_code=503)
+
+    def post(url, data, timeout):
+        return failure if b'"series":"3"' in data else ok
+    requests_mock.post.side_effect = post
+    backend, broken = MagicMock(name='backend'), MagicMock(name='broken backend', failures=0)
+    broken.write.side_effect = IOError('unreachable')
+    # a single lane, so the series are written in order and only the last one fails
+    metric_writer = MetricWriter(sender=ConcurrentSender(workers=1, chunk_points=5), backends=[broken, backend])
+    metric_writer._renew_token = MagicMock()
+    for i in range(5):
+        for series in range(4):
+            metric_writer.defer_metric('foobar', i, {"series": str(series)}, i)
+    metric_writer.write_deferred()
+    (batch, _), _ = backend.write.call_args
+    assert len(batch) == 15 and len(metric_writer.deferred_metrics) == 5
+    assert all(series.tags != {"series": "3"} for series in batch.series)
+    assert broken.failures == 1
+
+    metric_writer.write_metric('foobar', 1, {"series": "1"})
+    (batch, _), _ = backend.write.call_args
+    assert batch.payload() == [{'name': 'foobar', 'tags': {'series': '1'}, 'datapoints': [[ANY, 1]]}]
+    assert broken.failures == 2
+    metric_writer.close()
+    backend.close.assert_called_once_with()
+
+
+def test_token_is_fetched_in_the_background(requests_mock, mock_token):
+    fetched = threading.Event()
+
+    def get(token_name):
+        fetched.wait(5)
+        return 'ABCabc'
+    mock_token.get.side_effect = get
+    requests_mock.structures = requests.structures
+    requests_mock.headers = requests.structures.CaseInsensitiveDict({'User-Agent': 'test'})
+    requests_mock.post.return_value.status_code = 204
+    start = time.time()
+    metric_writer = MetricWriter()
+    assert time.time() - start < 1
+
+    # failing silently, deferred writes keep the metrics until there is a token
+    metric_writer.defer_metric('foobar', 1, {"foo": "bar"})
+    metric_writer.write_deferred()
+    assert not requests_mock.post.called
+    assert len(metric_writer.deferred_metrics) == 1
+
+    # while write_metric waits for it
+    original_headers = requests_mock.headers
+    threading.Timer(0.1, fetched.set).start()
+    metric_writer.write_metric('foobar', 2, {"foo": "bar"})
+    assert json.loads(requests_mock.post.call_args[1]['data'])['value'] == 2
+    assert requests_mock.headers['Authorization'] == 'Bearer ABCabc'
+    assert requests_mock.headers['User-Agent'] == 'test'
+    # the headers are replaced, never updated in place
+    assert 'Authorization' not in original_headers
+    metric_writer.write_deferred()
+    assert [point['value'] for point in flatten(json.loads(requests_mock.post.call_args[1]['data']))] == [1]
+    metric_writer.close()
+
+
+def test_writers_that_are_not_closed_are_collected(requests_mock):
+    threads = threading.active_count()
+    writers = [weakref.ref(MetricWriter()) for _ in range(20)]
+    gc.collect()
+    assert not any(writer() for writer in writers)
+    for _ in range(100):
+        if threading.active_count() <= threads:
+            break
+        time.sleep(0.01)
+    assert threading.active_count() <= threads
+
+
+def test_first_write_waits_for_token_when_not_failing_silently(requests_mock, mock_token):
+    mock_token.get.side_effect = lambda token_name: time.sleep(0.1) or 'ABCabc'
+    requests_mock.post.return_value.status_code = 204
+    metric_writer = MetricWriter(fail_silently=False)
+    metric_writer.write_metric('foobar', 1, {"foo": "bar"})
+    assert requests_mock.post.called
+
+    mock_token.get.side_effect = Exception('no credentials')
+    metric_writer = MetricWriter(fail_silently=False, timeout=0.1)
+    with pytest.raises(TokenUnavailableError):
+        metric_writer.write_metric('foobar', 1, {"foo": "bar"})
+    metric_writer.token_refresher.stop()
+
+
+def test_stats_self_metrics_and_tracing(requests_mock):
+    spans = []
+
+    class RecordingTracer(Tracer):
+        def span(self, name, attributes):
+            spans.append(name)
+            return super(RecordingTracer, self).span(name, attributes)
+
+    metric_writer = MetricWriter(self_metrics=True, tracer=RecordingTracer())
+    metric_writer._renew_token = MagicMock()
+    metric_writer.defer_metric('foobar', 1, {"foo": "bar"})
+    metric_writer.defer_metric('foobar', 2, {"foo": "bar"})
+    metric_writer.write_deferred()
+    stats = metric_writer.stats()
+    assert stats['requests'] == stats['http.204'] == stats['flushes'] == 1
+    # with the gauges of the writer's state, written as self metrics
+    assert stats['points.written'] == stats['batch.points']['max'] > 2
+    assert stats['flush.latency']['count'] == 1
+    assert stats['buffer.depth'] == 0
+    # the token is fetched in the background, whenever it is
+    assert [span for span in spans if span != 'metricz.token'] == ['metricz.write_deferred', 'metricz.request']
+
+    # the stats of the previous writes are written with the next ones
+    metric_writer.write_deferred()
+    names = {point['name'] for point in flatten(json.loads(requests_mock.post.call_args[1]['data']))}
+    assert {'metricz.requests', 'metricz.points.written', 'metricz.buffer.depth'} <= names
+    assert not MetricWriter().stats().get('requests')
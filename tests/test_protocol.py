@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from metricz.protocol import encode, decode, decode_json, decode_any
+from metricz.values import HistogramValue
+
+
+def test_encode():
+    assert encode('foobar', {'foo': 'bar'}, 1000, 1) == 'put foobar 1000 1 foo=bar'
+    assert encode('foobar', {}, 1000, 1.5) == 'put foobar 1000 1.5'
+
+
+@pytest.mark.parametrize('metric_name, tags', [
+    ('', {}),
+    ('foo bar', {}),
+    ('foobar', {'env': 'prod east'}),
+    ('foobar', {'env': ''}),
+    ('foobar', {'env\n': 'prod'}),
+    ('foobar', {'a=b': 'c'}),
+    ('foobar', {'': 'prod'}),
+])
+def test_encode_invalid(metric_name, tags):
+    with pytest.raises(ValueError):
+        encode(metric_name, tags, 1000, 1)
+
+
+def test_roundtrip():
+    histogram = HistogramValue.from_samples([1, 2, 3])
+    for value in (1, 1.5, 1e20, histogram):
+        line = encode('foobar', {'foo': 'bar', 'baz': 'qux'}, 1000, value)
+        assert ' ' not in line.split(' ', 3)[3].split(' ')[0]
+        assert decode(line + '\n') == ('foobar', {'foo': 'bar', 'baz': 'qux'}, 1000, value)
+
+
+@pytest.mark.parametrize('line', [
+    '',
+    'get foobar 1000 1',
+    'put foobar 1000',
+    'put foobar now 1',
+    'put foobar 1000 one',
+    'put foobar 1000 1 foo',
+    'put foobar 1000 {"bins":1}',
+])
+def test_decode_invalid(line):
+    with pytest.raises(ValueError):
+        decode(line)
+
+
+def test_decode_json():
+    assert decode_json('{"name": "foobar", "timestamp": 1000, "value": 1, "tags": {"foo": "bar"}}') == (
+        'foobar', {'foo': 'bar'}, 1000, 1)
+    assert decode_json('{"name": "foobar", "value": 1.5}') == ('foobar', {}, None, 1.5)
+    histogram = HistogramValue.from_samples([1, 2])
+    assert decode_any(json.dumps({'name': 'foobar', 'value': histogram.payload()}))[3] == histogram
+    assert decode_any('put foobar 1000 1') == ('foobar', {}, 1000, 1)
+
+
+@pytest.mark.parametrize('line', [
+    '[]',
+    '{"value": 1}',
+    '{"name": "foobar"}',
+    '{"name": "foobar", "value": "1"}',
+    '{"name": "foobar", "value": 1, "tags": []}',
+    '{"name": "foobar", "value": {"bins": 1}}',
+])
+def test_decode_json_invalid(line):
+    with pytest.raises(ValueError):
+        decode_json(line)
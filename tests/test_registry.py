@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from metricz.buffer import series_key
+from metricz.registry import SeriesRegistry
+
+
+def test_intern():
+    registry = SeriesRegistry()
+    tags = {'foo': 'bar', 'port': 8080}
+    series = registry.intern('foobar', tags)
+    assert series.name == 'foobar'
+    assert series.tags == {'foo': 'bar', 'port': '8080'}
+    assert series.key == series_key('foobar', {'foo': 'bar', 'port': '8080'})
+    tags['foo'] = 'baz'
+    assert series.tags['foo'] == 'bar'
+    assert registry.intern('foobar', {'foo': 'bar', 'port': 8080}) is series
+    assert registry.intern('foobar', {'port': '8080', 'foo': 'bar'}) is series
+    assert registry.intern('foobar', {}).id != series.id
+
+
+def test_equal_tags_of_different_types():
+    registry = SeriesRegistry()
+    assert registry.intern('foobar', {'ok': True}).tags == {'ok': 'True'}
+    assert registry.intern('foobar', {'ok': 1}).tags == {'ok': '1'}
+    assert registry.intern('foobar', {'ok': 1.0}).tags == {'ok': '1.0'}
+    assert registry.intern('foobar', {True: 'ok'}).tags == {'True': 'ok'}
+    assert registry.intern('foobar', {1: 'ok'}).tags == {'1': 'ok'}
+
+
+def test_least_recently_used_series_are_forgotten():
+    registry = SeriesRegistry(max_series=2)
+    first = registry.intern('first', {})
+    second = registry.intern('second', {})
+    assert registry.intern('first', {}) is first
+    registry.intern('third', {})
+    assert len(registry) == 2
+    assert registry.intern('first', {}) is first
+    # series still in use, e.g. by handles, keep their id
+    assert registry.intern('second', {}) is second
+    second_id = second.id
+    del second
+    registry.intern('fourth', {})
+    registry.intern('fifth', {})
+    assert registry.intern('second', {}).id != second_id
+
+
+@pytest.mark.parametrize('metric_name, tags', [
+    ('', {}),
+    ('some metric', {}),
+    ('foobar', {'': 'bar'}),
+    ('foobar', {'foo': ''}),
+    ('foobar', {'foo': 'bar=baz'}),
+    ('foobar', {'foo:bar': 'baz'}),
+    ('foobar\n', {}),
+    ('foobar', {'foo': 'bar\n'}),
+    ('caf\xe9', {}),
+    ('foobar', {'foo': '\u0661'}),
+    (None, {}),
+])
+def test_validation(metric_name, tags):
+    registry = SeriesRegistry()
+    with pytest.raises(ValueError):
+        registry.intern(metric_name, tags)
+    assert not len(registry)
+    assert SeriesRegistry(validate=False).intern(metric_name, tags).name == metric_name
+
+
+def test_valid_names():
+    registry = SeriesRegistry()
+    registry.intern('some.metric_name-1/total', {'host': 'host-1.example.org', 'Zone_1': 'eu/west'})
+
+
+def test_unhashable_tags():
+    for registry in (SeriesRegistry(), SeriesRegistry(validate=False)):
+        with pytest.raises(ValueError):
+            registry.intern('foobar', {'foo': ['bar']})
+        assert not len(registry)
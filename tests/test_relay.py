@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import socket
+import time
+
+import pytest
+from mock import MagicMock
+
+from metricz.relay import Relay, RelayClient
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+
+
+def test_relay(tmpdir):
+    path = str(tmpdir.join('relay.sock'))
+    writer = MagicMock()
+    with Relay(writer, path) as relay, RelayClient(path) as client:
+        client.defer_metric('foobar', 1, {'foo': 'bar'}, 1000)
+        client.defer_metric('foobar', 1.5, {'foo': 'bar'}, 2.0)
+        client.flush()
+        wait_for(lambda: relay.received == 2)
+    writer.defer_metric.assert_any_call('foobar', 1, {'foo': 'bar'}, 1000)
+    writer.defer_metric.assert_any_call('foobar', 1.5, {'foo': 'bar'}, 2000)
+    assert client.dropped == 0
+    assert not tmpdir.join('relay.sock').exists()
+
+
+def test_receive_skips_invalid_lines(tmpdir):
+    relay = Relay(MagicMock(), str(tmpdir.join('relay.sock')))
+    relay.receive(b'put foobar 1000 1 foo=bar\nfoobar\n\nput foobar 2000 2\n')
+    assert relay.received == 2
+    assert relay.invalid == 1
+    assert relay.writer.defer_metric.call_count == 2
+    relay.stop()
+
+
+def test_only_stale_sockets_are_replaced(tmpdir):
+    path = str(tmpdir.join('relay.sock'))
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    stale.bind(path)
+    stale.close()
+    relay = Relay(MagicMock(), path)
+    # a relay is listening on it
+    with pytest.raises(OSError):
+        Relay(MagicMock(), path)
+    assert relay.addresses == [path]
+    relay.stop()
+
+    tmpdir.join('file').write('data')
+    with pytest.raises(OSError):
+        Relay(MagicMock(), str(tmpdir.join('file')))
+    assert tmpdir.join('file').read() == 'data'
+
+
+def test_client_without_relay(tmpdir):
+    with RelayClient(str(tmpdir.join('missing.sock'))) as client:
+        client.defer_metric('foobar', 1, {'foo': 'bar'})
+    assert client.dropped == 1
+
+
+def test_client_batches_metrics(tmpdir):
+    path = str(tmpdir.join('relay.sock'))
+    writer = MagicMock()
+    with Relay(writer, path) as relay, RelayClient(path, datagram_size=100) as client:
+        for i in range(10):
+            client.defer_metric('foobar', i, {'foo': 'bar'}, 1000)
+        assert relay.received < 10
+        client.flush()
+        wait_for(lambda: relay.received == 10)
+    assert [call[0][1] for call in writer.defer_metric.call_args_list] == list(range(10))
+
+
+def test_relay_udp_and_tcp():
+    writer = MagicMock()
+    with Relay(writer, None, ('localhost', 0), ('localhost', 0)) as relay:
+        udp_address, tcp_address = relay.addresses
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+            udp.sendto(b'put foobar 1000 1 transport=udp\n', udp_address)
+        with socket.create_connection(tcp_address) as tcp:
+            tcp.sendall(b'put foobar 1000 2 transport=tcp\nput foobar 20')
+            time.sleep(0.05)
+            # the last line is complete when the connection is closed
+            tcp.sendall(b'00 3 transport=tcp')
+        wait_for(lambda: relay.received == 3)
+    writer.defer_metric.assert_any_call('foobar', 1, {'transport': 'udp'}, 1000)
+    writer.defer_metric.assert_any_call('foobar', 2, {'transport': 'tcp'}, 1000)
+    writer.defer_metric.assert_any_call('foobar', 3, {'transport': 'tcp'}, 2000)
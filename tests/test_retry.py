@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from metricz.retry import RetryPolicy, CircuitBreaker
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_backoff_is_exponential_and_capped():
+    policy = RetryPolicy(backoff=0.1, max_backoff=1, jitter=False)
+    assert [policy.delay(attempt) for attempt in range(5)] == [0.1, 0.2, 0.4, 0.8, 1]
+
+
+def test_backoff_jitter():
+    policy = RetryPolicy(backoff=0.1, max_backoff=1)
+    for attempt in range(5):
+        assert 0 <= policy.delay(attempt) <= min(1, 0.1 * 2 ** attempt)
+
+
+def test_should_retry():
+    policy = RetryPolicy()
+    assert policy.should_retry(503)
+    assert policy.should_retry(429)
+    assert not policy.should_retry(400)
+    assert not policy.should_retry(204)
+
+
+def test_circuit_breaker():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    clock.now = 10
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow()
+    # only a single trial is allowed
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    clock.now = 20
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_circuit_breaker_trial_expires():
+    clock = FakeClock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    breaker.record_failure()
+    clock.now = 10
+    assert breaker.allow()
+    # the trial write never recorded a result
+    clock.now = 15
+    assert not breaker.allow()
+    clock.now = 20
+    assert breaker.allow()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+
+from metricz.buffer import MetricBuffer
+from metricz.sender import ConcurrentSender
+
+
+def make_batch(series, points):
+    buffer = MetricBuffer()
+    for i in range(points):
+        for s in range(series):
+            buffer.append('foobar', {'series': str(s)}, i, i)
+    return buffer.drain()
+
+
+def test_send_keeps_series_order():
+    sender = ConcurrentSender(workers=4, chunk_points=7)
+    written = []
+    lock = threading.Lock()
+
+    def write(chunk):
+        with lock:
+            written.extend(chunk.points())
+
+    results = sender.send(make_batch(10, 20), write)
+    sender.close()
+    assert all(error is None for _, error in results)
+    assert len(written) == 200
+    for s in range(10):
+        timestamps = [point['timestamp'] for point in written if point['tags'] == {'series': str(s)}]
+        assert timestamps == list(range(20))
+
+
+def test_failed_chunk_stops_its_lane():
+    sender = ConcurrentSender(workers=1, chunk_points=5)
+
+    def write(chunk):
+        if any(point['timestamp'] == 7 for point in chunk.points()):
+            return 'boom'
+
+    results = sender.send(make_batch(1, 20), write)
+    assert [error for _, error in results] == [None, 'boom', 'boom', 'boom']
+    assert sum(len(chunk) for chunk, error in results if error) == 15
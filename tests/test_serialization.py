@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+
+import pytest
+
+from metricz.buffer import MetricBuffer
+from metricz.serialization import SERIALIZERS, StreamingPayload, dumps, encode_batch, get_serializer
+from metricz.values import HistogramValue
+
+
+def make_batch():
+    buffer = MetricBuffer()
+    for i in range(25):
+        buffer.append('some.metric', {'host': 'a'}, i, i)
+        buffer.append('float.metric', {}, i, i / 2.0)
+    buffer.append('latency', {'app': 'x'}, 3000, HistogramValue.from_samples([1, 2, 3]))
+    buffer.append('unicode.metric', {'name': u'caf\xe9/bar'}, 4000, 1)
+    return buffer.drain()
+
+
+@pytest.mark.parametrize('name', sorted(SERIALIZERS))
+def test_serializers(name):
+    batch = make_batch()
+    serializer = get_serializer(name)
+    assert json.loads(serializer(batch.payload()).decode('utf-8')) == batch.payload()
+    assert json.loads(b''.join(encode_batch(batch, serializer, chunk_points=10)).decode('utf-8')) == batch.payload()
+
+
+def test_default_serializer():
+    assert get_serializer() is dumps
+    with pytest.raises(ValueError):
+        get_serializer('pickle')
+
+
+def test_encode_empty_batch():
+    assert b''.join(encode_batch(MetricBuffer().drain())) == b'[]'
+
+
+def test_streaming_payload():
+    batch = make_batch()
+    payload = StreamingPayload(batch, chunk_points=10)
+    assert payload.headers is None
+    assert json.loads(b''.join(payload).decode('utf-8')) == batch.payload()
+    # the body is encoded again when a request is retried
+    assert json.loads(b''.join(payload).decode('utf-8')) == batch.payload()
+
+    payload = StreamingPayload(batch, compress=True)
+    assert payload.headers == {'Content-Encoding': 'gzip'}
+    assert json.loads(gzip.decompress(b''.join(payload)).decode('utf-8')) == batch.payload()
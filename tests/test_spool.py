@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from metricz.spool import DiskSpool
+
+
+def payload(*values):
+    return [{'name': 'foobar', 'tags': {'foo': 'bar'}, 'datapoints': [[value, value] for value in values]}]
+
+
+def replayed_values(spool, max_points=10000, max_bytes=None):
+    batches = []
+
+    def send(data):
+        batches.append([timestamp for series in json.loads(data.decode('utf-8'))
+                        for timestamp, _ in series['datapoints']])
+        return True
+    spool.replay(send, max_points, max_bytes)
+    return batches
+
+
+def test_append_and_replay(tmpdir):
+    spool = DiskSpool(str(tmpdir))
+    spool.append(payload(1, 2))
+    spool.append(payload(3))
+    assert len(spool) == 3
+    assert replayed_values(spool) == [[1, 2, 3]]
+    assert len(spool) == 0
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_replay_batches(tmpdir):
+    spool = DiskSpool(str(tmpdir))
+    for value in range(5):
+        spool.append(payload(value * 2, value * 2 + 1))
+    assert replayed_values(spool, max_points=4) == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+
+def test_replay_batches_by_bytes(tmpdir):
+    spool = DiskSpool(str(tmpdir))
+    for value in range(5):
+        spool.append(payload(value))
+    # a record is 61 bytes, 60 more in a batch
+    sizes = []
+    spool.replay(lambda data: sizes.append(len(data)) or True, max_points=None, max_bytes=121)
+    assert sizes == [121, 121, 61]
+
+
+def test_failed_replay_is_kept(tmpdir):
+    spool = DiskSpool(str(tmpdir))
+    spool.append(payload(1))
+    spool.append(payload(2))
+    assert spool.replay(lambda data: b'2' not in data, max_points=1) == 1
+    assert len(spool) == 1
+    assert replayed_values(spool) == [[2]]
+
+
+def test_concurrent_replays(tmpdir):
+    spool = DiskSpool(str(tmpdir))
+    for value in range(10):
+        spool.append(payload(value))
+    sent = []
+
+    def send(data):
+        time.sleep(0.01)
+        sent.extend(timestamp for series in json.loads(data.decode('utf-8')) for timestamp, _ in series['datapoints'])
+        return True
+    threads = [threading.Thread(target=spool.replay, args=(send, 2)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sent == list(range(10))
+    assert len(spool) == 0
+
+
+def test_segment_deleted_while_replayed(tmpdir):
+    spool = DiskSpool(str(tmpdir), segment_bytes=100, max_bytes=200)
+    for value in range(3):
+        spool.append(payload(value))
+    appended = [3]
+    sent = []
+
+    def send(data):
+        sent.extend(timestamp for series in json.loads(data.decode('utf-8')) for timestamp, _ in series['datapoints'])
+        # new failures fill the spool, which deletes the segment being replayed
+        for value in range(100, 105):
+            spool.append(payload(value))
+        appended[0] += 5
+        return True
+    assert spool.replay(send, max_points=1) == len(sent)
+    assert len(sent) + spool.dropped + len(spool) == appended[0]
+
+
+def test_survives_restart(tmpdir):
+    spool = DiskSpool(str(tmpdir))
+    spool.append(payload(1))
+    spool.close()
+    spool = DiskSpool(str(tmpdir))
+    spool.append(payload(2))
+    assert replayed_values(spool) == [[1], [2]]
+
+
+def test_torn_write_is_discarded(tmpdir):
+    spool = DiskSpool(str(tmpdir))
+    spool.append(payload(1))
+    spool.append(payload(2))
+    spool.close()
+    segment, = tmpdir.listdir()
+    size = segment.size()
+    with open(str(segment), 'r+b') as segment_file:
+        segment_file.truncate(size - 3)
+
+    spool = DiskSpool(str(tmpdir))
+    assert len(spool) == 1
+    spool.append(payload(3))
+    assert replayed_values(spool) == [[1], [3]]
+
+
+def test_segments_rotate_and_size_is_capped(tmpdir):
+    spool = DiskSpool(str(tmpdir), segment_bytes=100, max_bytes=400)
+    for value in range(20):
+        spool.append(payload(value))
+    assert spool.size <= 400
+    assert len(tmpdir.listdir()) > 1
+    assert spool.dropped + len(spool) == 20
+    values = sum(replayed_values(spool), [])
+    assert values == list(range(20 - len(values), 20))
+
+
+def test_invalid_fsync_policy(tmpdir):
+    with pytest.raises(ValueError):
+        DiskSpool(str(tmpdir), fsync='sometimes')
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from metricz.instruments import InstrumentRegistry
+from metricz.stats import Distribution, Tracer, WriterStats
+
+
+def test_distribution_summary():
+    distribution = Distribution(window=100)
+    assert distribution.summary()['p50'] is None
+    for value in range(1, 201):
+        distribution.observe(value)
+    summary = distribution.summary()
+    assert (summary['count'], summary['min'], summary['max'], summary['mean']) == (200, 1, 200, 100.5)
+    # percentiles of the most recent values only
+    assert (summary['p50'], summary['p99']) == (150, 199)
+
+
+def test_writer_stats_snapshot():
+    stats = WriterStats()
+    stats.count('requests')
+    stats.count('requests', 2)
+    stats.observe('request.latency', 10)
+    snapshot = stats.snapshot()
+    assert snapshot['requests'] == 3
+    assert snapshot['request.latency']['max'] == 10
+
+
+def test_writer_stats_record_instruments():
+    instruments = InstrumentRegistry()
+    stats = WriterStats(instruments, tags={'hostname': 'test'})
+    stats.count('requests')
+    stats.observe('request.latency', 10)
+    names = {name for name, value, tags in instruments.collect()}
+    assert 'metricz.requests' in names
+    assert any(name.startswith('metricz.request.latency') for name in names)
+
+
+def test_tracer_spans_do_nothing():
+    with Tracer().span('metricz.request', {}) as span:
+        span.set_attribute('http.status_code', 204)
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import decimal
+
+import pytest
+
+from metricz.values import HistogramValue, normalize_value
+
+
+def test_normalize_value():
+    assert normalize_value(1) == 1
+    assert normalize_value(1.5) == 1.5
+    assert isinstance(normalize_value(True), int)
+    assert normalize_value(decimal.Decimal('1.5')) == 1.5
+    assert normalize_value('3') == 3
+    assert normalize_value('1.5') == 1.5
+    histogram = HistogramValue()
+    assert normalize_value(histogram) is histogram
+    assert normalize_value(2 ** 63 - 1) == 2 ** 63 - 1
+    assert isinstance(normalize_value(2 ** 63), float)
+    assert isinstance(normalize_value(-2 ** 63 - 1), float)
+    assert isinstance(normalize_value(decimal.Decimal(2 ** 64)), float)
+    with pytest.raises(ValueError):
+        normalize_value(10 ** 400)
+
+
+def test_histogram():
+    histogram = HistogramValue.from_samples([1, 1, 2, 3.5])
+    assert histogram.payload() == {
+        'bins': {'1.0': 2, '2.0': 1, '3.5': 1},
+        'min': 1,
+        'max': 3.5,
+        'sum': 7.5,
+        'precision': 7,
+    }
+
+
+def test_histogram_bins_have_bounded_error():
+    histogram = HistogramValue.from_samples(range(1, 100001), precision=7)
+    # 2 ** 7 bins per power of two
+    assert len(histogram.bins) < 17 * 2 ** 7
+    for bin_value in histogram.bins:
+        assert bin_value > 0
+    assert histogram.count == 100000
+
+
+def test_histogram_from_payload():
+    payload = {'bins': {'1.0': 2, '2.0': 1}, 'min': 1, 'max': 2, 'sum': 4, 'precision': 7}
+    histogram = HistogramValue.from_payload(payload)
+    assert histogram.count == 3
+    assert histogram.payload() == {'bins': {'1.0': 2, '2.0': 1}, 'min': 1.0, 'max': 2.0, 'sum': 4.0, 'precision': 7}
+    with pytest.raises(ValueError):
+        HistogramValue.from_payload({'bins': []})